@@ -95,6 +95,42 @@ class ShellCommandExecutor {
     }
 }
 
+/**
+ * Reads the Engine's shared memory status block (statusBlock.py) - Layout must match STATUS_FORMAT there
+ */
+class EngineStatusReader {
+    private const PATH = '/dev/shm/Dynamic_RDS_status';
+    private const SIZE = 628;
+    private const VERSION = 1;
+    private const SEQUENCE_OFFSET = 12;
+    private const HEARTBEAT_STALE = 10;
+    private const FORMAT = 'a4magic/vversion/vstate/Vpid/Vsequence/Vreserved/' .
+        'estartTime/eheartbeat/eerrorTime/PrdsGroups/VrdsStalls/Vi2cErrors/VtransmitterResets/Vreserved2/' .
+        'Z16transmitter/Z32psFragment/Z256rtFragment/Z256lastError';
+
+    public static function read(): ?array {
+        // Retry while the Engine is mid update (odd sequence) or it changed during the read
+        for ($attempt = 0; $attempt < 10; $attempt++) {
+            $data = @file_get_contents(self::PATH, false, null, 0, self::SIZE);
+            if ($data === false || strlen($data) < self::SIZE) {
+                return null;
+            }
+            $sequence = unpack('V', $data, self::SEQUENCE_OFFSET)[1];
+            $check = @file_get_contents(self::PATH, false, null, self::SEQUENCE_OFFSET, 4);
+            if ($sequence % 2 === 0 && $check !== false && unpack('V', $check)[1] === $sequence) {
+                $status = unpack(self::FORMAT, $data);
+                if ($status['magic'] !== 'DRDS' || $status['version'] !== self::VERSION) {
+                    return null;
+                }
+                $status['running'] = ($status['state'] & 1) && (time() - $status['heartbeat']) < self::HEARTBEAT_STALE;
+                return $status;
+            }
+            usleep(1000);
+        }
+        return null;
+    }
+}
+
 class I2CDetector {
     private int $bus;
 
@@ -160,6 +196,11 @@ class DependencyChecker {
     }
 
     public static function isEngineRunning(): bool {
+        // The status block heartbeat answers without running ps, which is only needed for an Engine without one
+        $engineStatus = EngineStatusReader::read();
+        if ($engineStatus !== null) {
+            return $engineStatus['running'];
+        }
         $output = ShellCommandExecutor::execute('ps -ef | grep python.*Dynamic_RDS_Engine.py | grep -v grep');
         if (!ShellCommandExecutor::isEmpty($output))
             return !ShellCommandExecutor::isEmpty($output);
@@ -220,8 +261,13 @@ class ZipDownloader {
 
         try {
             $this->addFileToZip($zip, $this->dynRDSDir . "/Dynamic_RDS_callbacks.log", "Dynamic_RDS_callbacks.log");
+            $this->addFileToZip($zip, $this->dynRDSDir . "/Dynamic_RDS_callbacks.log.1", "Dynamic_RDS_callbacks.log.1");
             $this->addFileToZip($zip, $this->dynRDSDir . "/Dynamic_RDS_Engine.log", "Dynamic_RDS_Engine.log");
+            $this->addFileToZip($zip, $this->dynRDSDir . "/Dynamic_RDS_Engine.log.1", "Dynamic_RDS_Engine.log.1");
+            $this->addFileToZip($zip, $this->dynRDSDir . "/Dynamic_RDS_trace.log", "Dynamic_RDS_trace.log");
+            $this->addFileToZip($zip, $this->dynRDSDir . "/Dynamic_RDS_commands.rec", "Dynamic_RDS_commands.rec");
             $this->addFileToZip($zip, $this->configDirectory . "/plugin.Dynamic_RDS", "plugin.Dynamic_RDS");
+            $this->addFileToZip($zip, $this->configDirectory . "/Dynamic_RDS_transmitters.ini", "Dynamic_RDS_transmitters.ini");
             $this->addFileToZip($zip, "/boot/firmware/config.txt", "config.txt");
             $this->addFileToZip($zip, "/boot/uEnv.txt", "uEnv.txt");
 
@@ -333,6 +379,17 @@ function renderDynamicRDSStatus(
     // Add success messages
     if ($engineRunning) {
         $status->addSuccess('Dynamic RDS Engine is running');
+        $engineStatus = EngineStatusReader::read();
+        if ($engineStatus !== null) {
+            if ($engineStatus['state'] & 2) {
+                $status->addSuccess('Transmitting PS <code>' . htmlspecialchars($engineStatus['psFragment'], ENT_QUOTES, 'UTF-8') .
+                    '</code> RT <code>' . htmlspecialchars($engineStatus['rtFragment'], ENT_QUOTES, 'UTF-8') . '</code>');
+            }
+            if ($engineStatus['lastError'] !== '') {
+                $status->addWarning('Last Engine error at ' . date('Y-m-d H:i:s', (int)$engineStatus['errorTime']) . ': ' .
+                    htmlspecialchars($engineStatus['lastError'], ENT_QUOTES, 'UTF-8'));
+            }
+        }
     }
 
     if ($transmitterType !== TransmitterType::NONE) {
@@ -346,6 +403,10 @@ function renderDynamicRDSStatus(
     // Display all status messages
     $status->displayMessages();
 
+    if ($engineRunning) {
+        displayStatsSection($dynRDSDir . '/Dynamic_RDS_stats.json');
+    }
+
     // Output JavaScript
     outputJavaScript($transmitterType);
 
@@ -583,11 +644,17 @@ Values from File Tags or Track Info
 Main Playlist Section Values
 <ul><li>{C} = Item count in Main Playlist section</li>
 <li>{P} = Item position or number in Main Playlist section</li>
-<ul><li>Note: {P} is set empty when it and {C} are both 1 to prevent &quot;Track 1 of 1&quot; messages</li></ul></ul>
+<ul><li>Note: {P} is set empty when it and {C} are both 1 to prevent &quot;Track 1 of 1&quot; messages</li></ul>
+<li>{X} = Next item's name (media or sequence) in Main Playlist section</li></ul>
+Values that change while a track plays
+<ul><li>{R} = Track Time Remaining as 0:00, updated every second</li>
+<li>{K} = Clock as 7:30 PM, updated every minute</li>
+<li>{E} = Time until the Show End Time as 0:00 (hours:minutes), updated every minute</li></ul>
 Any static text can be used<br />
 | (pipe) will split between RDS groups, like a line break<br />
 [ ] creates a subgroup such that if <b>ANY</b> substitution in the subgroup is empty, the entire subgroup is omitted<br />
 Use a \ in front of | { } [ or ] to display those characters<br />
+With RadioText Plus enabled, {T} and {A} in the RT Style Text are tagged as Title and Artist when all of it fits in one RT update<br />
 End of the style text will implicitly function as a line break</div>
 HTML;
 }
@@ -613,6 +680,44 @@ function displayMQTTSection(array $settings): void {
     }
 }
 
+/**
+ * Display Engine stats exported to Dynamic_RDS_stats.json
+ */
+function displayStatsSection(string $statsFile): void {
+    if (!is_file($statsFile)) {
+        return;
+    }
+    $stats = json_decode(file_get_contents($statsFile), true);
+    if (!is_array($stats)) {
+        return;
+    }
+
+    echo '<h2>Engine Stats</h2>';
+    echo '<div class="container-fluid settingsTable settingsGroupTable">';
+    echo '<p>As of ' . htmlspecialchars($stats['time'] ?? '', ENT_QUOTES, 'UTF-8') .
+         ' - Up ' . intval($stats['uptime'] ?? 0) . 's - ' .
+         htmlspecialchars((string)($stats['groupsPerSecond'] ?? 0), ENT_QUOTES, 'UTF-8') . ' RDS groups/s</p>';
+
+    echo '<table class="fppSelectableRowTable"><tr><th>Stage (&mu;s)</th><th>Count</th><th>p50</th><th>p90</th><th>p99</th><th>Max</th></tr>';
+    foreach ($stats['histograms'] ?? [] as $name => $hist) {
+        echo '<tr><td>' . htmlspecialchars($name, ENT_QUOTES, 'UTF-8') . '</td>';
+        foreach (['count', 'p50', 'p90', 'p99', 'max'] as $key) {
+            echo '<td>' . intval($hist[$key] ?? 0) . '</td>';
+        }
+        echo '</tr>';
+    }
+    echo '</table>';
+
+    $counters = [];
+    foreach ($stats['counters'] ?? [] as $name => $value) {
+        $counters[] = htmlspecialchars($name, ENT_QUOTES, 'UTF-8') . ': ' . intval($value);
+    }
+    if (!empty($counters)) {
+        echo '<p>' . implode(' - ', $counters) . '</p>';
+    }
+    echo '</div><br />';
+}
+
 /**
  * Display logs section
  */
@@ -651,7 +756,7 @@ function displayReportIssueSection(): void {
 <p>Increase the Log Levels to Debug, then create a new issue at <a href="https://github.com/ShadowLight8/Dynamic_RDS/issues"><b>https://github.com/ShadowLight8/Dynamic_RDS/issues</b></a>, describe what you're seeing, and attach the zip file.</p>
 Zip file includes:
 <ul>
-<li>Logs - <code>Dynamic_RDS_callbacks.log</code> and <code>Dynamic_RDS_Engine.log</code></li>
+<li>Logs - <code>Dynamic_RDS_callbacks.log</code> and <code>Dynamic_RDS_Engine.log</code>, plus their previous rotated <code>.1</code> files</li>
 <li>Config - <code>plugin.Dynamic_RDS</code></li>
 <li>Version from <code>git rev-parse --short HEAD</code></li>
 <li>Pi/BBB boot config - <code>/boot/firmware/config.txt</code> or <code>/boot/uEnv.txt</code></li>
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import types
+
+from basicI2C import basicI2C
+from simulatedI2C import simulatedBus, simulatedSi4713
+
+# ======================
+# Dynamic RDS Benchmarks
+# ======================
+# Headless benchmarks of the RDS hot paths against simulated i2c buses - No transmitter, FPP, or smbus2 needed
+# Each benchmark reports microseconds per operation (median of several rounds) or a command count, lower is better
+# The QN8066 per group sleep is patched out, so transmitRDS times are Python and bus overhead only, not the 87.6ms on air
+#
+# Run:    python3 Dynamic_RDS_Benchmark.py
+# Record: python3 Dynamic_RDS_Benchmark.py --save   (baselines are per machine, record on the hardware being compared)
+# Budget: python3 Dynamic_RDS_Benchmark.py --budget (startup budget only, no timings - Run by CI on every push)
+# Exits with 1 if any result is worse than the saved baseline by more than the tolerance, or over the startup budget
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+basicI2C.busFactory = simulatedBus
+import Dynamic_RDS_Engine as engine # pylint: disable=wrong-import-position
+import QN8066 as QN8066Module # pylint: disable=wrong-import-position
+from Si4713 import Si4713 # pylint: disable=wrong-import-position
+
+# Engine memory budget for Pi Zero class boards (512MB shared with fppd), in modules loaded and resident KB
+# startup is after the Engine imports, steady is after INIT and a track with a QN8066 - Both are close to the same on any
+# machine, so they are checked against these limits instead of the baseline (64-bit Python uses the most)
+STARTUP_BUDGET = {
+  'startupModules': 125,
+  'startupRSSKB': 16384,
+  'steadyModules': 145,
+  'steadyRSSKB': 20480
+}
+
+# Run in a fresh interpreter, so nothing the benchmarks load is counted
+STARTUP_PROFILE = '''
+import json, sys, time
+import Dynamic_RDS_Engine as engine
+from engineStats import residentMemory
+profile = {'startupMs': time.process_time() * 1000, 'startupModules': len(sys.modules), 'startupRSSKB': residentMemory()}
+
+from basicI2C import basicI2C
+from simulatedI2C import simulatedBus
+basicI2C.busFactory = simulatedBus
+readConfigFromFile = engine.read_config_from_file
+def profileReadConfigFromFile():
+  readConfigFromFile()
+  engine.config.update(DynRDSTransmitter='QN8066', DynRDSQN8066PIPWM='0', DynRDSmqttEnable='0', DynRDSmpcEnable='0',
+                       DynRDSAdvRecordCommands='0', DynRDSEngineLogLevel='WARNING')
+engine.read_config_from_file = profileReadConfigFromFile
+for line in ('INIT', 'MAINLIST', 'P1', 'TTitle', 'AArtist', 'L180'):
+  engine.processLine(line)
+engine.updateRDSData()
+for _ in range(10):
+  engine.transmitter.sendNextRDSGroup()
+profile.update(steadyModules=len(sys.modules), steadyRSSKB=residentMemory())
+print(json.dumps(profile))
+'''
+
+def profileStartup():
+  result = subprocess.run([sys.executable, '-c', STARTUP_PROFILE], cwd=script_dir, capture_output=True, text=True, check=True)
+  return json.loads(result.stdout.splitlines()[-1])
+
+def checkBudget(profile):
+  overBudget = []
+  for name, limit in STARTUP_BUDGET.items():
+    over = profile[name] > limit
+    print(f'{name:24} {profile[name]:12.0f}  budget   {limit:12.0f}{"  OVER BUDGET" if over else ""}')
+    if over:
+      overBudget.append(name)
+  return overBudget
+
+def timeIt(func, iterations, rounds):
+  # Median microseconds per call over rounds, each of iterations calls
+  results = []
+  for _ in range(rounds):
+    startTime = time.perf_counter_ns()
+    for _ in range(iterations):
+      func()
+    results.append((time.perf_counter_ns() - startTime) / 1000 / iterations)
+  results.sort()
+  return results[len(results) // 2]
+
+def setValues(values):
+  engine.rdsValues.update(values)
+
+def renderAll(corpus, groupSize, styleKey):
+  for values in corpus['values']:
+    setValues(values)
+    for style in corpus[styleKey]:
+      engine.rdsStyleToString(style, groupSize)
+
+def renderedData(corpus):
+  rtSize = int(engine.config['DynRDSRTSize'])
+  rendered = []
+  for values in corpus['values']:
+    setValues(values)
+    for psStyle, rtStyle in zip(corpus['ps'], corpus['rt']):
+      rendered.append((engine.rdsStyleToString(psStyle, 8), engine.rdsStyleToString(rtStyle, rtSize)))
+  return rendered
+
+def runBenchmarks(corpus, rounds):
+  results = {}
+  rtSize = int(engine.config['DynRDSRTSize'])
+  renders = len(corpus['values']) * len(corpus['ps'])
+
+  results['renderPS'] = timeIt(lambda: renderAll(corpus, 8, 'ps'), 50, rounds) / renders
+  results['renderRT'] = timeIt(lambda: renderAll(corpus, rtSize, 'rt'), 50, rounds) / renders
+  rendered = renderedData(corpus)
+
+  transmitter = QN8066Module.QN8066()
+
+  def updateAll():
+    for psData, rtData in rendered:
+      transmitter.PS.updateData(psData)
+      transmitter.RT.updateData(rtData)
+  results['updateData'] = timeIt(updateAll, 20, rounds) / len(rendered)
+
+  # sendNextGroup alone, with transmitRDS replaced on the instance
+  transmitter.transmitRDS = lambda rdsBytes: None
+  transmitter.updateRDSData(*rendered[0])
+  results['sendNextGroupPS'] = timeIt(transmitter.PS.sendNextGroup, 2000, rounds)
+  results['sendNextGroupRT'] = timeIt(transmitter.RT.sendNextGroup, 2000, rounds)
+  del transmitter.transmitRDS
+
+  # Full group cycle through the simulated bus, without the on air wait
+  QN8066Module.sleep = lambda seconds: None
+  QN8066Module.scheduler = types.SimpleNamespace(sleepUntil=lambda deadline: None)
+  results['transmitRDSCycle'] = timeIt(transmitter.sendNextRDSGroup, 1000, rounds)
+
+  # Si4713 loads RT into the chip buffers, so the cost that matters is i2c commands per RT update
+  si4713 = Si4713()
+  si4713.totalCircularBuffers = simulatedSi4713.CIRCULAR_BUFFERS
+  commands = 0
+  for _, rtData in rendered:
+    si4713.I2C.bus.writes = 0
+    si4713._updateRT(rtData) # pylint: disable=protected-access
+    commands += si4713.I2C.bus.writes
+  results['si4713UpdateRTCommands'] = commands / len(rendered)
+  results['si4713UpdateRT'] = timeIt(lambda: si4713._updateRT(rendered[0][1]), 100, rounds) # pylint: disable=protected-access
+
+  return {name: round(value, 3) for name, value in results.items()}
+
+def compare(results, baseline, tolerance):
+  regressions = []
+  for name, value in results.items():
+    base = baseline.get(name)
+    if base is None:
+      print(f'{name:24} {value:12.3f}  (no baseline)')
+      continue
+    change = (value - base) / base if base else 0
+    regressed = change > tolerance
+    print(f'{name:24} {value:12.3f}  baseline {base:12.3f}  {change:+7.1%}{"  REGRESSION" if regressed else ""}')
+    if regressed:
+      regressions.append(name)
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description='Dynamic RDS offline benchmarks')
+  parser.add_argument('--corpus', default=script_dir + '/benchmarks/corpus.json', help='Styles and track values to render')
+  parser.add_argument('--baseline', default=script_dir + '/benchmarks/baseline.json', help='Baseline results to compare against')
+  parser.add_argument('--save', action='store_true', help='Save results as the new baseline')
+  parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed fractional regression before failing (default 0.25)')
+  parser.add_argument('--rounds', type=int, default=7, help='Rounds per benchmark, the median is reported')
+  parser.add_argument('--budget', action='store_true', help='Only check the startup budget, which needs no baseline')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(message)s')
+
+  if args.budget:
+    overBudget = checkBudget(profileStartup())
+    if overBudget:
+      print(f'Over the startup budget: {", ".join(overBudget)}')
+    return 1 if overBudget else 0
+
+  with open(args.corpus, 'r', encoding='UTF-8') as f:
+    corpus = json.load(f)
+
+  results = runBenchmarks(corpus, args.rounds)
+  profile = profileStartup()
+  results['startupMs'] = round(profile['startupMs'], 3)
+  overBudget = checkBudget(profile)
+
+  if args.save:
+    with open(args.baseline, 'w', encoding='UTF-8') as f:
+      json.dump({'machine': platform.node(), 'python': platform.python_version(), 'results': results}, f, indent=2)
+    compare(results, {}, args.tolerance)
+    print(f'Baseline saved to {args.baseline}')
+    return 1 if overBudget else 0
+
+  try:
+    with open(args.baseline, 'r', encoding='UTF-8') as f:
+      baseline = json.load(f)
+  except FileNotFoundError:
+    compare(results, {}, args.tolerance)
+    print('No baseline found, run with --save to record one')
+    return 1 if overBudget else 0
+
+  if baseline.get('machine') != platform.node():
+    print(f'Note: baseline was recorded on {baseline.get("machine")}, timings may not be comparable')
+  regressions = compare(results, baseline['results'], args.tolerance)
+  if regressions:
+    print(f'Regressed beyond {args.tolerance:.0%}: {", ".join(regressions)}')
+  if overBudget:
+    print(f'Over the startup budget: {", ".join(overBudget)}')
+  return 1 if regressions or overBudget else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
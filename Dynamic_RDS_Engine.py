@@ -1,30 +1,37 @@
 #!/usr/bin/env python3
 
 import logging
-import json
 import os
+import queue
+import re
 import errno
+import json
 import atexit
 import socket
 import sys
-import subprocess
+import threading
 import time
 import unicodedata
 
-from datetime import date, datetime, timedelta
-from urllib.request import urlopen
-from urllib.parse import quote
+from datetime import date
+from functools import lru_cache
 
 from config import config, read_config_from_file
-from QN8066 import QN8066
-from Si4713 import Si4713
-from basicMQTT import basicMQTT, pahoMQTT
+from playlistIndex import playlistIndex
+from basicMQTT import basicMQTT
+from traceBuffer import trace
+from logSetup import setupLogging
+from engineStats import stats, residentMemory
+from latencyTracker import latencyTracker
+from rtSchedule import scheduler
+from transmitterUnit import loadUnits
+from statusBlock import statusBlock, statusErrorHandler, STATE_RUNNING, STATE_TRANSMITTING, STATE_PLAYLIST
 
 def logUnhandledException(eType, eValue, eTraceback):
   logging.error("Unhandled exception", exc_info=(eType, eValue, eTraceback))
-sys.excepthook = logUnhandledException
+  # The Engine is about to exit, so this one is written before a background dump could finish
+  trace.dump()
 
-@atexit.register
 def cleanup():
   try:
     logging.debug('Cleaning up fifo')
@@ -37,7 +44,24 @@ def cleanup():
       mqtt.disconnect()
   except:
     pass
+  try:
+    if mpd is not None:
+      mpd.stop()
+    if recorder is not None:
+      recorder.close()
+    if monitor is not None:
+      monitor.stop()
+    for unit in units:
+      unit.stop()
+    if status is not None:
+      status.close()
+    if fpp is not None:
+      fpp.shutdown()
+  except:
+    pass
   logging.info('Exiting')
+  if logListener is not None:
+    logListener.stop()
 
 # ==================================
 # Configuration defaults and loading
@@ -45,47 +69,351 @@ def cleanup():
 
 def read_config():
   read_config_from_file()
-
-  # TODO: Move this QN8066 specific code to that class? Like a config tweak in QN8066?
-  # Convert DynRDSQN8066Gain into DynRDSQN8066InputImpedance, DynRDSQN8066DigitalGain, and DynRDSQN8066BufferGain
-  totalGain = int(config['DynRDSQN8066Gain']) + 15
-  config['DynRDSQN8066DigitalGain'] = totalGain % 3
-
-  if totalGain < 24:
-    config['DynRDSQN8066InputImpedance'] = 3 - totalGain // 6
-    config['DynRDSQN8066BufferGain'] = totalGain % 6 // 3
-  else:
-    config['DynRDSQN8066InputImpedance'] = 0
-    config['DynRDSQN8066BufferGain'] = totalGain % 18 // 3
-
-  if not (os.path.exists('/bin/mpc') or os.path.exists('/usr/bin/mpc')):
-    config['DynRDSmpcEnable'] = 0
-
   logging.getLogger().setLevel(config['DynRDSEngineLogLevel'])
   logging.info('Config %s', config)
 
+def updateMPD():
+  # MPD client runs only while mpc support is enabled, so it can be toggled live
+  global mpd
+  if config['DynRDSmpcEnable'] == '1' and mpd is None:
+    from basicMPD import basicMPD
+    mpd = basicMPD()
+    mpd.start()
+  elif config['DynRDSmpcEnable'] != '1' and mpd is not None:
+    mpd.stop()
+    mpd = None
+
+def updateRecorder():
+  # Command recording for Dynamic_RDS_Replay.py, toggled live like the MPD client
+  global recorder
+  if config['DynRDSAdvRecordCommands'] == '1' and recorder is None:
+    from commandRecorder import commandRecorder
+    recorder = commandRecorder(script_dir + '/Dynamic_RDS_commands.rec')
+  elif config['DynRDSAdvRecordCommands'] != '1' and recorder is not None:
+    recorder.close()
+    recorder = None
+
+def updateRealtime():
+  # Scheduling is per thread, so this has to run on the main loop thread that sends the RDS groups
+  if config['DynRDSAdvRealtime'] == '1':
+    scheduler.enable(int(config['DynRDSAdvRealtimePriority']), int(config['DynRDSAdvRealtimeCPU']))
+  elif scheduler.realtime:
+    scheduler.disable()
+
+def updateAudioMonitor():
+  # Audio level sampling follows the transmitter, so a new one at INIT gets a new monitor
+  global monitor
+  if monitor is not None and (config['DynRDSAudioMonitor'] != '1' or monitor.transmitter is not transmitter):
+    monitor.stop()
+    monitor = None
+  if config['DynRDSAudioMonitor'] == '1' and transmitter is not None:
+    interval = float(config['DynRDSAudioSampleInterval'])
+    autoGain = config['DynRDSQN8066AutoGain'] == '1'
+    if monitor is None:
+      from audioMonitor import audioMonitor
+      monitor = audioMonitor(transmitter, interval, autoGain)
+      monitor.start()
+    else:
+      monitor.interval = interval
+      monitor.autoGain = autoGain
+
+def queueCommand(line):
+  # Commands from other threads (like MQTT) skip the FIFO and go straight to the main loop
+  commandQueue.put(line)
+  commandReady.set()
+
+def exportStats():
+  global nextStatsTime
+  nextStatsTime = time.monotonic() + STATS_INTERVAL
+  payload = stats.export(stats_path)
+  if mqtt is not None:
+    mqtt.publish('stats', payload, 0, False)
+
+def fppClient():
+  # Only MQTT needs the FPP API, and http.client is one of the slowest imports, so it is created the first time MQTT starts
+  global fpp
+  if fpp is None:
+    from fppAPI import fppAPI
+    fpp = fppAPI()
+  return fpp
+
+def startMQTT(newMQTT):
+  global mqtt
+  mqtt = newMQTT
+  mqtt.setCommandHandler(queueCommand)
+  if mqttRole() == 'Follower':
+    mqtt.setContentHandler(lambda payload: queueCommand('SYNCCONTENT' + payload))
+  mqtt.connect()
+  mqtt.publish('ready', '1')
+  mqtt.publishConfig(config)
+
+def mqttRole():
+  # Leader publishes every render for its followers, a follower sends what the leader rendered instead of its own
+  return config['DynRDSmqttRole'] if config['DynRDSmqttEnable'] == '1' else 'Standalone'
+
+def applyContent(payload):
+  # Content from the leader is versioned by (epoch, seq) - epoch changes when the leader restarts and
+  # seq with every render, so retained, repeated, or out of order messages can't replace newer content
+  # The epoch is the leader's wall clock start time, which can go backwards, so any other epoch is taken as a restart
+  global contentVersion
+  try:
+    content = json.loads(payload)
+    version = (int(content['epoch']), int(content['seq']))
+    PSdata, RTdata = str(content['ps']), str(content['rt'])
+    tags = [(int(contentType), int(start), int(length)) for contentType, start, length in content.get('rtPlus', [])]
+  except (ValueError, KeyError, TypeError):
+    logging.warning('Invalid sync content %s', payload[:100])
+    return
+  if transmitter is None:
+    # A re-INIT with a bad transmitter type leaves MQTT running
+    logging.warning('Sync content without a transmitter')
+    return
+  if contentVersion is not None and version[0] == contentVersion[0] and version[1] <= contentVersion[1]:
+    logging.debug('Skipping sync content %s, already at %s', version, contentVersion)
+    stats.count('contentStale')
+    return
+  if contentVersion is None or version[0] != contentVersion[0]:
+    logging.info('Following leader content epoch %s', version[0])
+    if str(content.get('rtSize')) != config['DynRDSRTSize']:
+      logging.warning('Leader RT Size %s differs from %s, RT fragments will not line up', content.get('rtSize'), config['DynRDSRTSize'])
+  contentVersion = version
+  stats.count('contentApplied')
+  # Dynamic field ticks from the leader are patched in, like the leader's own transmitter does
+  updateFunc = 'patchRDSData' if content.get('patch') else 'updateRDSData'
+  # RT+ follows each transmitter's own setting
+  transmitter.updateRTPlus(RTdata, tags if config['DynRDSRTPlus'] == '1' else [])
+  getattr(transmitter, updateFunc)(PSdata, RTdata)
+  for unit in units:
+    unit.call(unit.transmitter.updateRTPlus, RTdata, tags if unit.config['DynRDSRTPlus'] == '1' else [])
+    unit.call(getattr(unit.transmitter, updateFunc), PSdata, RTdata)
+
 # ===============================
 # Processing FPP Data to RDS Data
 # ===============================
 
+def renderStyle(style, groupSize, rendered):
+  # Transmitters with the same styles share one render, kept with where each value landed for RT+
+  key = (style, groupSize)
+  if key not in rendered:
+    positions = {}
+    rendered[key] = (rdsStyleToString(style, groupSize, positions), positions)
+  return rendered[key][0]
+
+def renderStyles(settings, rendered):
+  return (renderStyle(settings['DynRDSPSStyle'], 8, rendered),
+          renderStyle(settings['DynRDSRTStyle'], int(settings['DynRDSRTSize']), rendered))
+
+# RT+ content types for values - ITEM.TITLE and ITEM.ARTIST
+RTPLUS_TYPES = {'{T}': 1, '{A}': 4}
+
+def rtPlusTags(settings, rendered):
+  # (content type, start, length) of the title and artist in the rendered RT, for transmitters with RT+ enabled
+  if settings['DynRDSRTPlus'] != '1':
+    return []
+  positions = rendered[(settings['DynRDSRTStyle'], int(settings['DynRDSRTSize']))][1]
+  return [(RTPLUS_TYPES[field], start, length) for field, (start, length) in positions.items() if field in RTPLUS_TYPES and length]
+
 def updateRDSData():
   # Take the data from FPP and the configuration to build the actual RDS string
+  global ingestTime
+  if mqttRole() == 'Follower':
+    # RDS data comes from the leader
+    ingestTime = None
+    return
+  updateDynamicValues()
   logging.debug('RDS Values %s', rdsValues)
+  startTime = time.perf_counter_ns()
 
   # TODO: DynRDSRTSize functionally works, but I think this should source from the RTBuffer class post initialization
   # TODO: Check if transmitter is active?
-  transmitter.updateRDSData(rdsStyleToString(config['DynRDSPSStyle'], 8), rdsStyleToString(config['DynRDSRTStyle'], int(config['DynRDSRTSize'])))
+  rendered = {}
+  PSdata, RTdata = renderStyles(config, rendered)
+  # Marked before the transmitter gets the data - The Si4713 reports its frames sent from within updateRDSData
+  latency.rendered()
+  transmitter.updateRTPlus(RTdata, rtPlusTags(config, rendered))
+  transmitter.updateRDSData(PSdata, RTdata)
+  for unit in units:
+    PSdata, RTdata = renderStyles(unit.config, rendered)
+    unit.call(unit.transmitter.updateRTPlus, RTdata, rtPlusTags(unit.config, rendered))
+    unit.call(unit.transmitter.updateRDSData, PSdata, RTdata)
+  endTime = time.perf_counter_ns()
+  stats.record('updateRDSData', (endTime - startTime) // 1000)
+  if ingestTime is not None:
+    stats.record('ingestToRender', (endTime - ingestTime) // 1000)
+    ingestTime = None
+
+  if mqttRole() == 'Leader':
+    publishContent()
+  scheduleDynamic()
 
   if config['DynRDSmqttEnable'] == '1':
-    mqttStatus = {}
-    mqttStatus['PStext'] = transmitter.PStext
-    mqttStatus['RTtext'] = transmitter.RTtext
-    mqttStatus['PSfragments'] = transmitter.PS.fragments
-    mqttStatus['RTfragments'] = transmitter.RT.fragments
-    mqttStatus['RDSValues'] = rdsValues
-    mqtt.publish('status', json.dumps(mqttStatus, indent=8))
-
-def rdsStyleToString(rdsStyle, groupSize):
+    mqtt.publishStatus({
+      'PStext': transmitter.PStext,
+      'RTtext': transmitter.RTtext,
+      'PSfragments': transmitter.PS.fragments,
+      'RTfragments': transmitter.RT.fragments,
+      'RDSValues': rdsValues
+    })
+
+def publishContent(patch=False):
+  # Sent to followers, patch when only dynamic fields changed
+  global contentSequence
+  contentSequence += 1
+  mqtt.publishContent({
+    'epoch': contentEpoch,
+    'seq': contentSequence,
+    'ps': transmitter.PStext,
+    'rt': transmitter.RTtext,
+    'rtSize': config['DynRDSRTSize'],
+    'rtPlus': transmitter.RTplus,
+    'patch': patch
+  })
+
+# ==============
+# Dynamic Fields
+# ==============
+# Values that change by themselves while a track plays, each with the seconds between changes
+# Only styles that use one are re-rendered, on ticks at that granularity, and the result is patched into the transmit
+# buffers - A clock in the RT doesn't restart the PS and RT rotations or toggle the RT A/B flag every minute
+
+def remainingTime():
+  if trackEnd is None:
+    return ''
+  remaining = max(int(trackEnd - time.monotonic()), 0)
+  return f'{remaining//60}:{remaining%60:02d}'
+
+def clockTime():
+  return time.strftime('%I:%M %p', time.localtime()).lstrip('0')
+
+def showEndCountdown():
+  # Hours and minutes until DynRDSShowEndTime (HH:MM) today, empty without one or once it has passed
+  try:
+    hour, minute = config['DynRDSShowEndTime'].split(':')
+    endMinutes = int(hour) * 60 + int(minute)
+  except ValueError:
+    return ''
+  now = time.localtime()
+  remaining = endMinutes - (now.tm_hour * 60 + now.tm_min)
+  if remaining <= 0:
+    return ''
+  return f'{remaining//60}:{remaining%60:02d}'
+
+DYNAMIC_FIELDS = {
+  '{R}': (remainingTime, 1),
+  '{K}': (clockTime, 60),
+  '{E}': (showEndCountdown, 60)
+}
+
+@lru_cache(maxsize=64)
+def styleFields(style):
+  # Dynamic fields used by a style
+  return frozenset(re.findall(r'\{.\}', style)).intersection(DYNAMIC_FIELDS)
+
+def updateDynamicValues():
+  # Returns the fields whose values changed
+  changed = set()
+  for field, (valueFunc, _) in DYNAMIC_FIELDS.items():
+    value = valueFunc()
+    if value != rdsValues[field]:
+      rdsValues[field] = value
+      changed.add(field)
+  return changed
+
+def scheduleDynamic():
+  # Next tick is on the wall clock boundary of the shortest granularity used by any style, None when none are used
+  global nextDynamicTime
+  fields = set()
+  for settings in [config] + [unit.config for unit in units]:
+    fields.update(styleFields(settings['DynRDSPSStyle']), styleFields(settings['DynRDSRTStyle']))
+  if not fields:
+    nextDynamicTime = None
+    return
+  granularity = min(DYNAMIC_FIELDS[field][1] for field in fields)
+  nextDynamicTime = time.monotonic() + granularity - time.time() % granularity
+
+def refreshDynamic():
+  scheduleDynamic()
+  if transmitter is None or mqttRole() == 'Follower':
+    return
+  changed = updateDynamicValues()
+  if not changed:
+    return
+  startTime = time.perf_counter_ns()
+  rendered = {}
+  for target, settings, unit in [(transmitter, config, None)] + [(unit.transmitter, unit.config, unit) for unit in units]:
+    if not target.active:
+      continue
+    # None leaves that text as it is, so only styles using a changed field are rendered
+    PSdata, RTdata = None, None
+    if styleFields(settings['DynRDSPSStyle']) & changed:
+      PSdata = renderStyle(settings['DynRDSPSStyle'], 8, rendered)
+    if styleFields(settings['DynRDSRTStyle']) & changed:
+      RTdata = renderStyle(settings['DynRDSRTStyle'], int(settings['DynRDSRTSize']), rendered)
+    if PSdata is None and RTdata is None:
+      continue
+    if unit is None:
+      if RTdata is not None:
+        target.updateRTPlus(RTdata, rtPlusTags(settings, rendered))
+      target.patchRDSData(PSdata, RTdata)
+    else:
+      if RTdata is not None:
+        unit.call(target.updateRTPlus, RTdata, rtPlusTags(settings, rendered))
+      unit.call(target.patchRDSData, PSdata, RTdata)
+  if not rendered:
+    return
+  stats.record('dynamicRender', (time.perf_counter_ns() - startTime) // 1000)
+  if mqttRole() == 'Leader' and transmitter.active:
+    publishContent(True)
+
+def startInterrupt(payload):
+  # {"ps": "...", "rt": "...", "ta": true, "seconds": 60} - ps and rt are style text, without one that part stays as it is
+  # Sent until seconds (Interrupt Duration by default, 0 for no limit) have passed or RESTORE
+  global interruptEnd
+  try:
+    message = json.loads(payload)
+    PSstyle, RTstyle = message.get('ps'), message.get('rt')
+    seconds = float(message.get('seconds', config['DynRDSInterruptDuration']))
+    trafficAnnouncement = bool(message.get('ta', False))
+  except (ValueError, AttributeError, TypeError):
+    logging.warning('Invalid interrupt %s', payload[:100])
+    return
+  if (PSstyle is None and RTstyle is None) or transmitter is None:
+    logging.warning('Interrupt without ps or rt, or no transmitter')
+    return
+
+  logging.info('Processing interrupt for %ss', seconds)
+  stats.count('interrupts')
+  rendered = {}
+  for target, settings, unit in [(transmitter, config, None)] + [(unit.transmitter, unit.config, unit) for unit in units]:
+    PSdata = None if PSstyle is None else renderStyle(str(PSstyle), 8, rendered)
+    RTdata = None if RTstyle is None else renderStyle(str(RTstyle), int(settings['DynRDSRTSize']), rendered)
+    if unit is None:
+      target.interrupt(PSdata, RTdata, trafficAnnouncement)
+    else:
+      unit.call(target.interrupt, PSdata, RTdata, trafficAnnouncement)
+  interruptEnd = time.monotonic() + seconds if seconds > 0 else None
+
+def endInterrupt():
+  global interruptEnd
+  interruptEnd = None
+  if transmitter is None:
+    return
+  transmitter.restore()
+  for unit in units:
+    unit.call(unit.transmitter.restore)
+
+def nextTrackName(position):
+  # Name of the playlist entry after position (1 based), from the media file or sequence without its extension
+  if not playlistName or '.' in playlistName:
+    return ''
+  for entry in playlists.entries(playlistName)[position:]:
+    if entry.get('enabled', 1) and (entry.get('mediaName') or entry.get('sequenceName')):
+      return os.path.splitext(entry.get('mediaName') or entry['sequenceName'])[0]
+  return ''
+
+def rdsStyleToString(rdsStyle, groupSize, positions=None):
+  # positions, when given, gets the (start, length) in the output of the first place each value is used
+  startTime = time.perf_counter_ns()
   outputRDS = []
   squStart = -1
   skip = 0
@@ -108,13 +436,20 @@ def rdsStyleToString(rdsStyle, groupSize):
           outputRDS.append(' ' * chunkLength)
       elif v == '{' and i < len(rdsStyle) - 2 and rdsStyle[i+2] == '}':
         if squStart != -1 and not rdsValues.get(rdsStyle[i:i+3],''): # In square brackets and value is empty?
+          if positions:
+            cut = sum(len(s) for s in outputRDS[:squStart])
+            for field in [field for field, (start, _) in positions.items() if start >= cut]:
+              del positions[field]
           del outputRDS[squStart:] # Remove output back to start of square bracket group
           skip += rdsStyle.index(']', i + 3) - i - 1 # Using index to throw if no ] by the end of rdsStyle - Done building in this case
         else:
           skip += 2
           # Normalize Unicode characters to their nearest ascii characters
           # Other character substitutions could be done here
-          outputRDS.append(unicodedata.normalize('NFKD', rdsValues.get(rdsStyle[i:i+3], '')).encode('ascii', 'ignore').decode())
+          value = unicodedata.normalize('NFKD', rdsValues.get(rdsStyle[i:i+3], '')).encode('ascii', 'ignore').decode()
+          if positions is not None:
+            positions.setdefault(rdsStyle[i:i+3], (sum(len(s) for s in outputRDS), len(value)))
+          outputRDS.append(value)
       else:
         outputRDS.append(v)
   except ValueError:
@@ -123,217 +458,435 @@ def rdsStyleToString(rdsStyle, groupSize):
     logging.exception('rdsStyleToString')
 
   outputRDS = ''.join(outputRDS) or ' '
+  stats.record('render', (time.perf_counter_ns() - startTime) // 1000)
   logging.debug('RDS Data [%s]', outputRDS)
   return outputRDS
 
-# ===============
-# Main code start
-# ===============
-
-# Setup logging
-script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
+# ==================
+# Processing Commands
+# ==================
+
+def processLine(line): # pylint: disable=too-many-branches,too-many-statements
+  # Handles a single command line from the FIFO or the command queue
+  global transmitter, units, mqtt, pendingMQTT, activePlaylist, pendingPlaylistUpdate, pendingMediaUpdate, lastUpdateTime, ingestTime
+  global playlistName, trackEnd, contentVersion
+  logging.debug('line %s', line)
+  if line == 'EXIT':
+    logging.info('Processing exit')
+    transmitter.shutdown() # TODO: Can fail if transmitter wasn't set - Can fix with an if statement or look into using Transmitter base class initially
+    for unit in units:
+      unit.call(unit.transmitter.shutdown)
+      unit.stop()
+    mqtt.disconnect()
+    sys.exit()
+
+  elif line == 'RESET':
+    logging.info('Processing reset')
+    read_config()
+    updateRealtime()
+    mqtt.publishConfig(config)
+    transmitter.reset()
+    if config['DynRDSStart'] == "FPPDStart":
+      transmitter.startup()
+    for unit in units:
+      unit.call(unit.transmitter.reset)
+
+  elif line == 'INIT': # From --list with callback.py
+    logging.info('Processing init')
+    read_config()
+    updateMPD()
+    updateRecorder()
+    updateRealtime()
+
+    # Only the configured transmitter's module is loaded
+    transmitter = None
+    if config['DynRDSTransmitter'] == "QN8066":
+      from QN8066 import QN8066
+      transmitter = QN8066()
+    elif config['DynRDSTransmitter'] == "Si4713":
+      from Si4713 import Si4713
+      transmitter = Si4713()
+
+    if transmitter is None:
+      logging.error('Transmitter not set. Check Transmitter Type.')
+      return
+    transmitter.frameCallback = latency.frameSent
+    updateAudioMonitor()
+
+    # Additional transmitters are only read at INIT, each runs on its own thread
+    stopping = [unit.name for unit in units if not unit.stop()]
+    units = loadUnits(stopping)
+    for unit in units:
+      unit.start()
+
+    # The previous client's network loop and subscriptions would keep queuing commands
+    if mqtt is not None:
+      mqtt.disconnect()
+    if config['DynRDSmqttEnable'] == "1":
+      mqtt = basicMQTT()
+      from basicMQTT import pahoMQTT
+      client = fppClient()
+      pendingMQTT = client.submit(pahoMQTT, client)
+    else:
+      startMQTT(basicMQTT())
+
+    updateRDSData()
+    if mqttRole() == 'Follower':
+      # Nothing is rendered here until the leader's content arrives, so the new buffers get placeholders to send
+      # and the leader's retained content is applied again whatever version was last seen
+      contentVersion = None
+      transmitter.updateRDSData(' ', ' ')
+      for unit in units:
+        unit.call(unit.transmitter.updateRDSData, ' ', ' ')
+
+    # After an Engine restart the chip may still be transmitting, attaching to it avoids dropping the carrier
+    if config['DynRDSStart'] == "FPPDStart" and not transmitter.attach():
+      transmitter.startup()
+    if config['DynRDSStart'] == "FPPDStart":
+      for unit in units:
+        unit.call(unit.startTransmitter)
+
+  elif line == 'UPDATE':
+    read_config()
+    updateMPD()
+    updateRecorder()
+    updateRealtime()
+    updateAudioMonitor()
+    mqtt.publishConfig(config)
+    if (transmitter is not None and transmitter.active):
+      for key in rdsValues:
+        rdsValues[key] = ''
+      updateRDSData()
+      transmitter.update()
+    for unit in units:
+      if unit.transmitter.active:
+        unit.call(unit.transmitter.update)
+
+  elif line.startswith('SPAN'): # Correlation ID and start time from callbacks.py
+    try:
+      spanId, callbackNs = line[4:].split(' ', 1)
+      latency.begin(spanId, int(callbackNs))
+    except ValueError:
+      logging.warning('Invalid span %s', line)
+
+  elif line.startswith('SYNCCONTENT'): # Rendered RDS data from the MQTT leader - Not CONTENT, a C line is a value
+    if mqttRole() == 'Follower':
+      applyContent(line[11:])
+    else:
+      logging.warning('Sync content ignored, not an MQTT follower')
+
+  elif line.startswith('INTERRUPT'): # Urgent message in place of the current RDS data
+    startInterrupt(line[9:])
+
+  elif line == 'RESTORE':
+    logging.info('Processing restore')
+    endInterrupt()
+
+  elif line == 'STATS':
+    logging.info('Processing stats')
+    exportStats()
+
+  elif line == 'DUMPTRACE': # Command words can't start with a value letter, a T line would be a title
+    logging.info('Processing trace dump')
+    trace.dump()
+
+  elif line == 'RENDER': # Re-render with current values and styles, without re-reading config
+    logging.info('Processing render')
+    if transmitter is not None:
+      updateRDSData()
 
-#logging.basicConfig(stream=sys.stderr, level=logging.DEBUG, format='%(asctime)s %(levelname)s %(message)s', datefmt='%H:%M:%S')
-logging.basicConfig(filename=script_dir + '/Dynamic_RDS_Engine.log', level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s', datefmt='%H:%M:%S')
+  elif line.startswith('STYLEPS'):
+    logging.info('Processing PS style')
+    config['DynRDSPSStyle'] = line[7:]
+
+  elif line.startswith('STYLERT'):
+    logging.info('Processing RT style')
+    config['DynRDSRTStyle'] = line[7:]
+
+  elif line == 'START':
+    logging.info('Processing start')
+    if (config['DynRDSStart'] == "PlaylistStart" or not transmitter.active) and not transmitter.attach():
+      transmitter.startup()
+    for unit in units:
+      if config['DynRDSStart'] == "PlaylistStart" or not unit.transmitter.active:
+        unit.call(unit.startTransmitter)
+    activePlaylist = True
+
+  elif line == 'STOP':
+    logging.info('Processing stop')
+    for key in rdsValues:
+      rdsValues[key] = ''
+    trackEnd = None
+    updateRDSData()
+    activePlaylist = False
+    if mpd is not None:
+      mpd.refresh()
+
+    if config['DynRDSStop'] == "PlaylistStop":
+      transmitter.shutdown()
+      for unit in units:
+        unit.call(unit.transmitter.shutdown)
+      logging.info('Transmitter stopped')
+
+  elif line.startswith('MAINLIST'):
+    logging.info('Processing MainPlaylist')
+    if ingestTime is None:
+      ingestTime = time.perf_counter_ns()
+    playlist_name = line[8:]
+    playlistName = playlist_name
+    if playlist_name != '':
+      logging.debug('Playlist Name: %s', playlist_name)
+      playlist_length = 1
+      if '.' not in playlist_name: # Case where a sequence is directly run from the scheduler or status page, it ends in .fseq and . is not allowed in regular playlist names
+        playlist_count = playlists.count(playlist_name)
+        if playlist_count is not None:
+          playlist_length = playlist_count
+      logging.debug('Playlist Length: %s', playlist_length)
+      rdsValues['{C}'] = str(playlist_length)
+    else:
+      rdsValues['{C}'] = ''
+
+  elif line[0] == 'P':
+    logging.debug('Processing playlist position')
+    if ingestTime is None:
+      ingestTime = time.perf_counter_ns()
+    rdsValues['{P}'] = line[1:]
+    try:
+      rdsValues['{X}'] = nextTrackName(int(line[1:]))
+    except ValueError:
+      rdsValues['{X}'] = ''
+    if rdsValues['{P}'] == '1' and rdsValues['{C}'] == '1':
+      rdsValues['{P}'] = ''
+    if pendingPlaylistUpdate:
+      stats.count('updatesMerged')
+    pendingPlaylistUpdate = True
+    lastUpdateTime = time.monotonic()
+
+  # rdsValues that need additional parsing
+  elif line[0] == 'L':
+    logging.debug('Processing length')
+    if ingestTime is None:
+      ingestTime = time.perf_counter_ns()
+    if line[1:] != '0':
+      rdsValues['{L}'] = f'{int(line[1:])//60}:{int(line[1:])%60:02d}'
+      trackEnd = time.monotonic() + int(line[1:])
+    else:
+      rdsValues['{L}'] = ''
+      trackEnd = None
+    #tracklength = max(int(line[1:10]) - max(int(config['DynRDSPSUpdateRate']), int(config['DynRDSRTUpdateRate'])), 1)
+    #logging.debug('Length %s', int(tracklength))
+
+    # TANL is always sent together with L being last item, so we only need to update the RDS Data once with the new values
+    # TODO: This will likely change as more data is added, so a new way will have to be determined
+    if pendingMediaUpdate:
+      stats.count('updatesMerged')
+    pendingMediaUpdate = True
+    lastUpdateTime = time.monotonic()
+    transmitter.status()
+    for unit in units:
+      unit.call(unit.transmitter.status)
+    if monitor is not None:
+      audio = monitor.newTrack()
+      if audio is not None and config['DynRDSmqttEnable'] == '1':
+        mqtt.publishStatus({'audio': audio})
+
+  # All of the rdsValues that are stored as is
+  else:
+    rdsValues['{'+line[0]+'}'] = line[1:]
+    if ingestTime is None:
+      ingestTime = time.perf_counter_ns()
+
+def processPending():
+  # Work that is due regardless of what the next command is
+  global pendingMQTT, pendingPlaylistUpdate, pendingMediaUpdate, lastUpdateTime
+  if ((pendingPlaylistUpdate and pendingMediaUpdate) or
+     ((pendingPlaylistUpdate or pendingMediaUpdate) and (lastUpdateTime is not None and (time.monotonic() - lastUpdateTime) >= 0.3))):
+    logging.info('Updating pending RDS Data: playlist=%s, media=%s', pendingPlaylistUpdate, pendingMediaUpdate)
+    updateRDSData()
+    pendingPlaylistUpdate = False
+    pendingMediaUpdate = False
+    lastUpdateTime = None
+
+  # MQTT setup needs the FPP API, so it is created in the background during INIT and swapped in when ready
+  if pendingMQTT is not None and pendingMQTT.done():
+    try:
+      startMQTT(pendingMQTT.result())
+    except Exception:
+      logging.exception('Unable to initialize pahoMQTT')
+      startMQTT(basicMQTT())
+    pendingMQTT = None
+
+def updateStatus():
+  # Heartbeat and current state for the status page, once per STATUS_INTERVAL
+  global nextStatusTime
+  nextStatusTime = time.monotonic() + STATUS_INTERVAL
+  state = STATE_RUNNING | (STATE_PLAYLIST if activePlaylist else 0)
+  psFragment, rtFragment = '', ''
+  if transmitter is not None:
+    state |= STATE_TRANSMITTING if transmitter.active else 0
+    psFragment, rtFragment = transmitter.currentFragments()
+  status.update(state=state, heartbeat=time.time(), transmitter=config['DynRDSTransmitter'],
+                psFragment=psFragment, rtFragment=rtFragment.replace('\r', ''),
+                rdsGroups=stats.counters.get('rdsGroups', 0), rdsStalls=stats.counters.get('rdsStalls', 0),
+                i2cErrors=stats.counters.get('i2cErrors', 0), transmitterResets=stats.counters.get('transmitterResets', 0))
+
+def processIdle():
+  # Song changes are pushed by MPD, so this only picks up what the client thread has already received
+  if not activePlaylist and transmitter is not None and transmitter.active and mpd is not None:
+    mpdSong = mpd.latest()
+    if mpdSong is not None:
+      logging.debug('Processing mpd')
+      rdsValues.update(mpdSong)
+      updateRDSData()
 
-# Adding in excessive log level below debug for very noisy items
-# Allow for debug to be reasonable
-# Debug is as deep as most people would want
-EXCESSIVE = 5
+  if time.monotonic() >= nextStatsTime:
+    exportStats()
 
-def excessive(msg, *args, **kwargs):
-  if logging.getLogger().isEnabledFor(EXCESSIVE):
-    logging.log(EXCESSIVE, msg, *args, **kwargs)
+  if status is not None and time.monotonic() >= nextStatusTime:
+    updateStatus()
 
-logging.addLevelName(5, 'EXCESSIVE')
-logging.EXCESSIVE = EXCESSIVE
-logging.excessive = excessive
-logging.Logger.excessive = excessive
+  if nextDynamicTime is not None and time.monotonic() >= nextDynamicTime:
+    refreshDynamic()
 
-logging.info('--- %s', date.today())
+  if interruptEnd is not None and time.monotonic() >= interruptEnd:
+    logging.info('Interrupt expired')
+    endInterrupt()
 
-# Establish lock via socket or exit if failed
-try:
-  lock_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-  lock_socket.bind('\0Dynamic_RDS_Engine')
-  logging.debug('Lock created')
-except:
-  logging.error('Unable to create lock. Another instance of Dynamic_RDS_Engine.py running?')
-  sys.exit(1)
+  # Threads started since real-time was enabled have inherited the RDS core
+  scheduler.unpinThreads()
 
-# Setup fifo
+# ============
+# Engine State
+# ============
+script_dir = os.path.dirname(os.path.abspath(__file__))
 fifo_path = script_dir + "/Dynamic_RDS_FIFO"
-try:
-  logging.debug('Setting up read side of fifo %s', fifo_path)
-  os.mkfifo(fifo_path)
-except OSError as oe:
-  if oe.errno != errno.EEXIST:
-    raise
-  logging.debug('Fifo already exists')
+stats_path = script_dir + "/Dynamic_RDS_stats.json"
+logListener = None
+
+# Playlist metadata read directly from the FPP playlists directory
+playlists = playlistIndex()
+
+# Shared FPP API client - Slow calls are run on its worker pool so they can't block RDS, created by fppClient
+fpp = None
+
+# Commands queued by other threads, processed ahead of the FIFO
+commandQueue = queue.SimpleQueue()
+commandReady = threading.Event()
+
+# Track change latency from callbacks.py to on air
+latency = latencyTracker()
 
 # Global RDS Values
-rdsValues = {'{T}': '', '{A}': '', '{B}': '', '{G}': '', '{N}': '','{L}': '', '{C}': '', '{P}': ''}
+rdsValues = {'{T}': '', '{A}': '', '{B}': '', '{G}': '', '{N}': '','{L}': '', '{C}': '', '{P}': '', '{X}': '',
+             '{R}': '', '{K}': '', '{E}': ''}
 
 # TODO: Check for existance of After Hours plugin by dir
 # TODO: Check for existance of mpc program to get status
 
-# =========
-# Main Loop
-# =========
 transmitter = None
+# Additional transmitters from Dynamic_RDS_transmitters.ini
+units = []
 mqtt = None
+pendingMQTT = None
+mpd = None
+recorder = None
+monitor = None
 activePlaylist = False
-nextMPCUpdate = datetime.now()
 pendingPlaylistUpdate = False
 pendingMediaUpdate = False
 lastUpdateTime = None
+ingestTime = None
+# Version of the content published as MQTT leader or last applied as follower
+contentEpoch = time.time_ns()
+contentSequence = 0
+contentVersion = None
+STATS_INTERVAL = 30
+nextStatsTime = time.monotonic() + STATS_INTERVAL
+# Shared memory status block, read by the PHP status page
+status = None
+STATUS_INTERVAL = 1
+nextStatusTime = 0
+# Dynamic fields - Next tick, track end for {R}, and the playlist for {X}
+nextDynamicTime = None
+trackEnd = None
+playlistName = ''
+# Interrupt message expiry, None when there isn't one or it has no limit
+interruptEnd = None
 
-# Check if new information is in the FIFO and process accordingly
-with open(fifo_path, 'r', encoding='UTF-8') as fifo:
-  while True:
-    if ((pendingPlaylistUpdate and pendingMediaUpdate) or
-       ((pendingPlaylistUpdate or pendingMediaUpdate) and (lastUpdateTime is not None and (time.monotonic() - lastUpdateTime) >= 0.3))):
-      logging.info('Updating pending RDS Data: playlist=%s, media=%s', pendingPlaylistUpdate, pendingMediaUpdate)
-      updateRDSData()
-      pendingPlaylistUpdate = False
-      pendingMediaUpdate = False
-      lastUpdateTime = None
-
-    line = fifo.readline().rstrip()
-    if len(line) > 0:
-      logging.debug('line %s', line)
-      if line == 'EXIT':
-        logging.info('Processing exit')
-        transmitter.shutdown() # TODO: Can fail if transmitter wasn't set - Can fix with an if statement or look into using Transmitter base class initially
-        mqtt.disconnect()
-        sys.exit()
-
-      elif line == 'RESET':
-        logging.info('Processing reset')
-        read_config()
-        mqtt.publish('config', json.dumps(config, indent=8))
-        transmitter.reset()
-        if config['DynRDSStart'] == "FPPDStart":
-          transmitter.startup()
-
-      elif line == 'INIT': # From --list with callback.py
-        logging.info('Processing init')
-        read_config()
-
-        transmitter = None
-        if config['DynRDSTransmitter'] == "QN8066":
-          transmitter = QN8066()
-        elif config['DynRDSTransmitter'] == "Si4713":
-          transmitter = Si4713()
-
-        if transmitter is None:
-          logging.error('Transmitter not set. Check Transmitter Type.')
-          continue
-
-        if config['DynRDSmqttEnable'] == "1":
-          try:
-            mqtt = pahoMQTT()
-          except Exception:
-            logging.exception('Unable to initialize pahoMQTT')
-            mqtt = basicMQTT()
-        else:
-          mqtt = basicMQTT()
-        mqtt.connect()
-        mqtt.publish('ready', '1')
-        mqtt.publish('config', json.dumps(config, indent=8))
-
-        updateRDSData()
-
-        if config['DynRDSStart'] == "FPPDStart":
-          transmitter.startup()
-
-      elif line == 'UPDATE':
-        read_config()
-        mqtt.publish('config', json.dumps(config, indent=8))
-        if (transmitter is not None and transmitter.active):
-          for key in rdsValues:
-            rdsValues[key] = ''
-          updateRDSData()
-          transmitter.update()
-
-      elif line == 'START':
-        logging.info('Processing start')
-        if config['DynRDSStart'] == "PlaylistStart" or not transmitter.active:
-          transmitter.startup()
-        activePlaylist = True
-
-      elif line == 'STOP':
-        logging.info('Processing stop')
-        for key in rdsValues:
-          rdsValues[key] = ''
-        updateRDSData()
-        activePlaylist = False
-
-        if config['DynRDSStop'] == "PlaylistStop":
-          transmitter.shutdown()
-          logging.info('Transmitter stopped')
-
-      elif line.startswith('MAINLIST'):
-        logging.info('Processing MainPlaylist')
-        playlist_name = line[8:] # TODO: Need to keep track of last playlist name to reduce overhead?
-        if playlist_name != '':
-          logging.debug('Playlist Name: %s', playlist_name)
-          playlist_length = 1
-          if '.' not in playlist_name: # Case where a sequence is directly run from the scheduler or status page, it ends in .fseq and . is not allowed in regular playlist names
-            try:
-              with urlopen(f'http://localhost/api/playlist/{quote(playlist_name)}') as response:
-                data = response.read()
-                playlist_length = len(json.loads(data)['mainPlaylist'])
-            except Exception:
-              logging.exception("Playlist Length")
-          logging.debug('Playlist Length: %s', playlist_length)
-          rdsValues['{C}'] = str(playlist_length)
-        else:
-          rdsValues['{C}'] = ''
-
-      elif line[0] == 'P':
-        logging.debug('Processing playlist position')
-        rdsValues['{P}'] = line[1:]
-        if rdsValues['{P}'] == '1' and rdsValues['{C}'] == '1':
-          rdsValues['{P}'] = ''
-        pendingPlaylistUpdate = True
-        lastUpdateTime = time.monotonic()
-
-      # rdsValues that need additional parsing
-      elif line[0] == 'L':
-        logging.debug('Processing length')
-        if line[1:] != '0':
-          rdsValues['{L}'] = f'{int(line[1:])//60}:{int(line[1:])%60:02d}'
-        else:
-          rdsValues['{L}'] = ''
-        #tracklength = max(int(line[1:10]) - max(int(config['DynRDSPSUpdateRate']), int(config['DynRDSRTUpdateRate'])), 1)
-        #logging.debug('Length %s', int(tracklength))
+# ===============
+# Main code start
+# ===============
 
-        # TANL is always sent together with L being last item, so we only need to update the RDS Data once with the new values
-        # TODO: This will likely change as more data is added, so a new way will have to be determined
-        pendingMediaUpdate = True
-        lastUpdateTime = time.monotonic()
-        transmitter.status()
+def main():
+  global logListener, status
+  sys.excepthook = logUnhandledException
+  atexit.register(cleanup)
 
-      # All of the rdsValues that are stored as is
-      else:
-        rdsValues['{'+line[0]+'}'] = line[1:]
-
-    elif transmitter is not None and transmitter.active and config['DynRDSEnableRDS'] == "1":
-      transmitter.sendNextRDSGroup()
-      # TODO: Determine when track length is done to reset RDS
-      # TODO: Could add 1 sec to length, so normally track change will update data rather than time expiring. Reset should only happen when playlist is stopped?
-
-    if not activePlaylist and transmitter is not None and transmitter.active and config['DynRDSmpcEnable'] == "1" and datetime.now() > nextMPCUpdate:
-      logging.debug('Processing mpc')
-      nextMPCUpdate = datetime.now() + timedelta(seconds=12)
-      # TODO: Error handling might be needed here if the mpc execution has an issue
-      # TODO: Future idea to handle multiple fields from mpc, but I've not seen them used yet. [{A}%artist%][{T}%title%][{N}%track%]
-      mpcLatest = subprocess.run(['mpc', 'current', '-f', '%title%'], stdout=subprocess.PIPE, check=False).stdout.decode('utf-8').strip()
-      if rdsValues['{T}'] != mpcLatest:
-        rdsValues['{T}'] = mpcLatest
-        updateRDSData()
-
-    if transmitter is None or not transmitter.active:
-      logging.debug('Sleeping...')
-      time.sleep(3)
+  # Log records are queued and written by a background thread, so the RDS loop never touches the filesystem
+  logListener = setupLogging(script_dir + '/Dynamic_RDS_Engine.log')
+
+  logging.info('--- %s', date.today())
+  # Process CPU time so far is interpreter startup and imports - Only what the config uses is loaded later
+  stats.startup = {'importMs': round(time.process_time() * 1000), 'modules': len(sys.modules), 'rssKB': residentMemory()}
+  logging.info('Startup - %sms, %s modules, %sKB resident', stats.startup['importMs'], stats.startup['modules'], stats.startup['rssKB'])
+
+  # Establish lock via socket or exit if failed
+  try:
+    lock_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) # pylint: disable=consider-using-with
+    lock_socket.bind('\0Dynamic_RDS_Engine')
+    logging.debug('Lock created')
+  except:
+    logging.error('Unable to create lock. Another instance of Dynamic_RDS_Engine.py running?')
+    sys.exit(1)
+
+  try:
+    status = statusBlock()
+    logging.getLogger().addHandler(statusErrorHandler(status))
+  except OSError:
+    logging.exception('Unable to create status block')
+
+  # I2C and RDS trace records are written here on request or after an error
+  trace.dumpPath = script_dir + '/Dynamic_RDS_trace.log'
+
+  # Setup fifo
+  try:
+    logging.debug('Setting up read side of fifo %s', fifo_path)
+    os.mkfifo(fifo_path)
+  except OSError as oe:
+    if oe.errno != errno.EEXIST:
+      raise
+    logging.debug('Fifo already exists')
+
+  # =========
+  # Main Loop
+  # =========
+  # Check if new information is in the FIFO and process accordingly
+  with open(fifo_path, 'r', encoding='UTF-8') as fifo:
+    while True:
+      processPending()
+
+      try:
+        line = commandQueue.get_nowait()
+      except queue.Empty:
+        line = fifo.readline().rstrip()
+      if len(line) > 0:
+        receivedTime = time.monotonic()
+        processLine(line)
+        # Recorded after processing so the INIT that turns recording on is included
+        if recorder is not None:
+          recorder.record(line, receivedTime)
+
+      elif transmitter is not None and transmitter.active and config['DynRDSEnableRDS'] == "1":
+        transmitter.sendNextRDSGroup()
+        # TODO: Determine when track length is done to reset RDS
+        # TODO: Could add 1 sec to length, so normally track change will update data rather than time expiring. Reset should only happen when playlist is stopped?
+
+      processIdle()
+
+      if transmitter is None or not transmitter.active:
+        logging.debug('Sleeping...')
+        commandReady.wait(3)
+        commandReady.clear()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+from basicI2C import basicI2C
+from simulatedI2C import simulatedBus
+from commandRecorder import readRecording
+
+# ==================
+# Dynamic RDS Replay
+# ==================
+# Feeds a command recording (Record Engine Commands in Advanced Options) back through the Engine with a simulated QN8066
+# Runs at recorded speed (--speed 1), faster (--speed 10), or as fast as possible (--speed 0)
+# The Engine and transmitter run on a replay clock, so merge windows, fragment rotation, and latencies scale with the speed
+# and at --speed 0 they are computed in virtual time - A whole season of show data replays in minutes
+# Stats are exported to Dynamic_RDS_stats.replay.json (--stats), so a replay never overwrites the live Engine stats
+# Extra transmitters from Dynamic_RDS_transmitters.ini are not loaded, only the simulated QN8066 runs
+#
+# Run: python3 Dynamic_RDS_Replay.py Dynamic_RDS_commands.rec --speed 0
+
+basicI2C.busFactory = simulatedBus
+import Dynamic_RDS_Engine as engine # pylint: disable=wrong-import-position
+import QN8066 as QN8066Module # pylint: disable=wrong-import-position
+import Transmitter as TransmitterModule # pylint: disable=wrong-import-position
+import latencyTracker as latencyTrackerModule # pylint: disable=wrong-import-position
+from engineStats import stats # pylint: disable=wrong-import-position
+
+# Settings forced after every config read so replay never touches hardware, MQTT, or MPD
+REPLAY_CONFIG = {
+  'DynRDSTransmitter': 'QN8066',
+  'DynRDSQN8066PIPWM': '0',
+  'DynRDSmqttEnable': '0',
+  'DynRDSmqttRole': 'Standalone',
+  'DynRDSmpcEnable': '0',
+  'DynRDSAdvRecordCommands': '0',
+  'DynRDSAdvRealtime': '0',
+  'DynRDSAudioMonitor': '0'
+}
+
+class replayClock:
+  # Stands in for the time module in the Engine and transmitter modules
+  # speed 0 only advances when something sleeps, otherwise time runs at speed times real time
+  def __init__(self, speed):
+    self.speed = speed
+    self.realStart = time.monotonic()
+    self.virtual = 0.0
+    self.epoch = time.time()
+
+  def monotonic(self):
+    if self.speed == 0:
+      return self.virtual
+    return (time.monotonic() - self.realStart) * self.speed
+
+  def perf_counter_ns(self):
+    return int(self.monotonic() * 1e9)
+
+  def monotonic_ns(self):
+    return int(self.monotonic() * 1e9)
+
+  def time(self):
+    return self.epoch + self.monotonic()
+
+  def time_ns(self):
+    return int(self.time() * 1e9)
+
+  def localtime(self, seconds=None):
+    return time.localtime(self.time() if seconds is None else seconds)
+
+  def strftime(self, fmt, t=None):
+    return time.strftime(fmt, self.localtime() if t is None else t)
+
+  def sleep(self, seconds):
+    if self.speed == 0:
+      self.virtual += max(seconds, 0)
+    elif seconds > 0:
+      time.sleep(seconds / self.speed)
+
+  def sleepUntil(self, deadline):
+    self.sleep(deadline - self.monotonic())
+
+def installClock(clock, overrides, statsPath):
+  engine.time = clock
+  latencyTrackerModule.time = clock
+  QN8066Module.sleep = clock.sleep
+  QN8066Module.monotonic = clock.monotonic
+  QN8066Module.scheduler = clock
+  TransmitterModule.monotonic = clock.monotonic
+  # Set on the real clock when the Engine was imported
+  engine.nextStatsTime = clock.monotonic() + engine.STATS_INTERVAL
+  engine.stats_path = statsPath
+  engine.loadUnits = lambda skip=(): []
+
+  readConfigFromFile = engine.read_config_from_file
+  def replayReadConfigFromFile():
+    readConfigFromFile()
+    engine.config.update(overrides)
+  engine.read_config_from_file = replayReadConfigFromFile
+
+def replay(events, clock, tail):
+  # Mirrors the Engine main loop, with commands taken from the recording when their time comes
+  commands = 0
+  if not events or events[0][1] != 'INIT':
+    engine.processLine('INIT')
+  endTime = (events[-1][0] if events else 0) + tail
+
+  i = 0
+  while clock.monotonic() < endTime:
+    engine.processPending()
+
+    if i < len(events) and events[i][0] <= clock.monotonic():
+      line = events[i][1]
+      i += 1
+      if line == 'EXIT':
+        continue
+      if line.startswith('SPAN'):
+        # Callback start time is rewritten to the replay clock, so latency covers the Engine side only
+        line = f"{line.split(' ', 1)[0]} {clock.time_ns()}"
+      engine.processLine(line)
+      commands += 1
+
+    elif engine.transmitter is not None and engine.transmitter.active and engine.config['DynRDSEnableRDS'] == '1':
+      engine.transmitter.sendNextRDSGroup()
+
+    else:
+      nextTime = events[i][0] if i < len(events) else endTime
+      clock.sleep(min(nextTime - clock.monotonic(), 3))
+
+    # Dynamic field ticks, interrupt expiry, and stats export
+    engine.processIdle()
+
+  return commands
+
+def report(commands, clock, realTime):
+  snapshot = stats.snapshot()
+  counters = snapshot['counters']
+  histograms = snapshot['histograms']
+  virtualTime = clock.monotonic()
+
+  print(f'Commands replayed     {commands}')
+  print(f'Show time             {virtualTime:.1f}s in {realTime:.1f}s ({virtualTime / realTime if realTime else 0:.1f}x)')
+  print(f'RDS groups sent       {counters.get("rdsGroups", 0)}')
+  print(f'Renders               {histograms.get("updateRDSData", {}).get("count", 0)}')
+  print(f'Dynamic renders       {histograms.get("dynamicRender", {}).get("count", 0)}')
+  print(f'Merged updates        {counters.get("updatesMerged", 0)}')
+  print(f'Superseded changes    {counters.get("trackChangeSuperseded", 0)}')
+  print(f'Timed out changes     {counters.get("trackChangeTimeouts", 0)}')
+  for stage in ('Render', 'FirstPS', 'FirstRT'):
+    hist = histograms.get('trackChange' + stage)
+    if hist is not None:
+      print(f'Track change {stage:8} p50 {hist["p50"] / 1000:8.1f}ms  p90 {hist["p90"] / 1000:8.1f}ms  '
+            f'p99 {hist["p99"] / 1000:8.1f}ms  max {hist["max"] / 1000:8.1f}ms  ({hist["count"]})')
+  return snapshot
+
+def main():
+  parser = argparse.ArgumentParser(description='Replay a Dynamic RDS command recording against a simulated transmitter')
+  parser.add_argument('recording', help='Recording file, usually Dynamic_RDS_commands.rec')
+  parser.add_argument('--speed', type=float, default=0, help='1 for recorded speed, N for N times faster, 0 for as fast as possible (default)')
+  parser.add_argument('--tail', type=float, default=30, help='Seconds to keep running after the last command (default 30)')
+  parser.add_argument('--stats', default=engine.script_dir + '/Dynamic_RDS_stats.replay.json', help='Stats export file during replay (default Dynamic_RDS_stats.replay.json)')
+  parser.add_argument('--json', help='Also write the final stats snapshot to this file')
+  parser.add_argument('--log-level', default='WARNING', help='Engine log level during replay (default WARNING)')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=args.log_level, format='%(levelname)s %(message)s')
+
+  events = list(readRecording(args.recording))
+  clock = replayClock(args.speed)
+  installClock(clock, dict(REPLAY_CONFIG, DynRDSEngineLogLevel=args.log_level), args.stats)
+
+  realStart = time.monotonic()
+  commands = replay(events, clock, args.tail)
+  snapshot = report(commands, clock, time.monotonic() - realStart)
+
+  if args.json:
+    with open(args.json, 'w', encoding='UTF-8') as f:
+      json.dump(snapshot, f, indent=2)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,24 +1,51 @@
 import logging
 import sys
-from time import sleep
-from datetime import datetime
+from threading import Thread, current_thread
+from time import sleep, monotonic, perf_counter_ns
 
-from config import config
 from basicI2C import basicI2C
 from basicPWM import createPWM
-from Transmitter import Transmitter
+from Transmitter import Transmitter, GROUP_PERIOD, RTPLUS_AID, RTPLUS_GROUP, rtPlusBlocks, fragmentTags
+from traceBuffer import trace, TRACE_RDS_GROUP, TRACE_RDS_STALL
+from engineStats import stats
+from rtSchedule import scheduler
+
+# RDS stall recovery escalates through these on consecutive stalls, resetting to the first after a group is sent
+# Re-toggle is done in place, the rest run on a background thread while RDS sending is held
+RECOVERY_LEVELS = ('Retoggle', 'RdsCycle', 'TxCycle', 'Reset')
+RESET_BACKOFF_MIN = 1
+RESET_BACKOFF_MAX = 60
+# With RT+ tags, one RT+ group is added after this many PS and RT group pairs, alternating 3A and 11A
+RTPLUS_INTERVAL = 8
+
+def gainRegisters(gain):
+  # Splits a gain of -15 to +20 into the 0x28 (InputImpedance, DigitalGain, BufferGain) settings
+  totalGain = gain + 15
+  if totalGain < 24:
+    return 3 - totalGain // 6, totalGain % 3, totalGain % 6 // 3
+  return 0, totalGain % 3, totalGain % 18 // 3
 
 class QN8066(Transmitter):
-  def __init__(self):
+  def __init__(self, settings=None, bus=None):
     logging.info('Initializing QN8066 transmitter')
-    super().__init__()
-    self.I2C = basicI2C(0x21)
-    self.PS = self.PSBuffer(self, ' ', int(config['DynRDSPSUpdateRate']))
-    self.RT = self.RTBuffer(self, ' ', int(config['DynRDSRTUpdateRate']))
-    self.basicPWM = createPWM()
+    super().__init__(settings)
+    self.i2cBus = bus
+    self.I2C = basicI2C(0x21, bus)
+    self.stallCount = 0
+    self.recovery = None
+    self.resetBackoff = RESET_BACKOFF_MIN
+    self.nextResetTime = 0
+    # On air deadline of the last group sent, see transmitRDS
+    self.groupDeadline = 0
+    self.gain = int(self.config['DynRDSQN8066Gain'])
+    self.rtPlusCycle = 0
+    self.PS = self.PSBuffer(self, ' ', int(self.config['DynRDSPSUpdateRate']))
+    self.RT = self.RTBuffer(self, ' ', int(self.config['DynRDSRTUpdateRate']))
+    self.basicPWM = createPWM(self.config)
 
   def startup(self):
     logging.info('Starting QN8066 transmitter')
+    self.startPhases()
 
     tempReadValue = self.I2C.read(0x06, 1)[0]>>2
     if tempReadValue != 0b1101:
@@ -29,9 +56,11 @@ class QN8066(Transmitter):
     #if (tempReadvalue != 0): # TO TEST
     #  logging.warning('Chip state is {} instead of 0 (Standby). Was startup already run?'.format(tempReadValue))
 
-    # Reset everything
+    # Reset everything - Reset bit clears itself once done
     self.I2C.write(0x00, [0b11100011], True)
-    sleep(0.2)
+    if not self.waitUntil(lambda: not self.I2C.read(0x00, 1)[0] & 0b10000000, 0.2):
+      logging.warning('QN8066 reset did not complete within 200ms')
+    self.markPhase('reset')
 
     # Setup expected clock source and div
     self.I2C.write(0x02, [0b00010000], True)
@@ -39,30 +68,91 @@ class QN8066(Transmitter):
 
     # Set frequency from config
     # (Frequency - 60) / 0.05
-    tempFreq = int((float(config['DynRDSFrequency'])-60)/0.05)
+    tempFreq = int((float(self.config['DynRDSFrequency'])-60)/0.05)
     self.I2C.write(0x19, [0b00100000 | tempFreq>>8], True)
     self.I2C.write(0x1b, [0b11111111 & tempFreq], True)
+    self.markPhase('configure')
 
     # Enable RDS TX and set pre-emphasis
-    if config['DynRDSPreemphasis'] == "50us":
-      self.I2C.write(0x01, [0b00000000 | int(config['DynRDSEnableRDS'])<<6])
+    if self.config['DynRDSPreemphasis'] == "50us":
+      self.I2C.write(0x01, [0b00000000 | int(self.config['DynRDSEnableRDS'])<<6])
     else:
-      self.I2C.write(0x01, [0b00000001 | int(config['DynRDSEnableRDS'])<<6])
+      self.I2C.write(0x01, [0b00000001 | int(self.config['DynRDSEnableRDS'])<<6])
 
-    # Exit standby, enter TX
+    # Exit standby, enter TX - FSM state 10 is transmitting
     self.I2C.write(0x00, [0b00001011], True)
-    sleep(0.2)
+    if not self.waitUntil(lambda: self.I2C.read(0x0a, 1)[0] >> 4 == 10, 0.5):
+      logging.warning('QN8066 did not enter TX state within 500ms')
+    self.markPhase('transmit')
 
     # Reset aud_pk
-    self.I2C.write(0x24, [0b10000000 | int(max(24,(int(config['DynRDSQN8066ChipPower']) - 70.2) // 0.91))])
-    self.I2C.write(0x24, [0b00000000 | int(max(24,(int(config['DynRDSQN8066ChipPower']) - 70.2) // 0.91))])
+    self.I2C.write(0x24, [0b10000000 | int(max(24,(int(self.config['DynRDSQN8066ChipPower']) - 70.2) // 0.91))])
+    self.I2C.write(0x24, [0b00000000 | int(max(24,(int(self.config['DynRDSQN8066ChipPower']) - 70.2) // 0.91))])
 
     self.update()
     super().startup()
 
-    self.basicPWM.startup(dutyCycle=int(config['DynRDSQN8066AmpPower']))
+    self.basicPWM.startup(dutyCycle=int(self.config['DynRDSQN8066AmpPower']))
+    self.markPhase('amp')
+    self.logPhases('qn8066Startup')
+
+  def attach(self):
+    # Chip keeps transmitting while it has power, so after an Engine restart check its registers against the config
+    # and take it over without the reset - Only registers that differ are written, a different frequency needs a full startup
+    probe = self.I2C.read(0x06, 1, attempts=1)
+    if not probe or probe[0]>>2 != 0b1101:
+      return False
+    fsm = self.I2C.read(0x0a, 1)[0]>>4
+    if fsm != 10:
+      logging.info('QN8066 state is %s instead of 10 (Transmitting), full startup needed', fsm)
+      return False
+
+    self.startPhases()
+    changes = []
+    for register, value, mask in self._configRegisters():
+      current = self.I2C.read(register, 1)[0]
+      if (current ^ value) & mask:
+        if register in (0x19, 0x1b):
+          logging.info('QN8066 frequency registers differ, full startup needed')
+          return False
+        changes.append((register, current & ~mask | value & mask))
+    for register, value in changes:
+      logging.info('QN8066 register 0x%02x set to 0x%02x', register, value)
+      self.I2C.write(register, [value], True)
+    self.markPhase('compare')
+
+    logging.info('Attached to running QN8066 - %s register(s) updated', len(changes))
+    super().startup()
+    self.basicPWM.startup(dutyCycle=int(self.config['DynRDSQN8066AmpPower']))
+    self.markPhase('amp')
+    self.logPhases('qn8066Attach')
+    stats.count('warmAttaches')
+    return True
+
+  def _configRegisters(self):
+    # Config driven registers as (register, value, mask) matching what startup and update write
+    # Masks leave out the RDS send toggle in 0x01 and the aud_pk reset in 0x24
+    tempFreq = int((float(self.config['DynRDSFrequency'])-60)/0.05)
+    registers = [
+      (0x02, 0b00010000, 0xff),
+      (0x07, 0b11101000, 0xff),
+      (0x08, 0b00001011, 0xff),
+      (0x19, 0b00100000 | tempFreq>>8, 0xff),
+      (0x1b, 0b11111111 & tempFreq, 0xff),
+      (0x01, (0 if self.config['DynRDSPreemphasis'] == "50us" else 1) | int(self.config['DynRDSEnableRDS'])<<6, 0b11111101),
+      (0x24, int(max(24,(int(self.config['DynRDSQN8066ChipPower']) - 70.2) // 0.91)), 0b01111111),
+      (0x27, 0b00111010, 0xff),
+      (0x28, self._gainRegister(int(self.config['DynRDSQN8066Gain'])), 0xff)
+    ]
+    if self.config['DynRDSQN8066AGC'] == '0':
+      registers.append((0x6e, 0b10110111, 0xff))
+    return registers
 
   def update(self):
+    if self.recovering():
+      # The recovery's startup applies the current config when it runs update
+      logging.info('Update - Skipped during RDS recovery')
+      return
     # Try without 0x25 0b01111101 - TX Freq Dev of 86.25KHz
     # Try without 0x26 0b00111100 - RDS Freq Dev of 21KHz
 
@@ -70,16 +160,17 @@ class QN8066(Transmitter):
     self.I2C.write(0x27, [0b00111010], True)
 
     # Stop Auto Gain Correction (AGC), which introduces obvious poor sounding audio changes
-    if config['DynRDSQN8066AGC'] == '0':
+    if self.config['DynRDSQN8066AGC'] == '0':
       self.I2C.write(0x6e, [0b10110111], True)
     # TODO: Else if it is re-enabled
 
-    # TX gain changes and input impedance
-    self.I2C.write(0x28, [int(config['DynRDSQN8066SoftClipping'])<<7 | int(config['DynRDSQN8066BufferGain'])<<4 | int(config['DynRDSQN8066DigitalGain'])<<2 | int(config['DynRDSQN8066InputImpedance'])], True)
+    # TX gain changes and input impedance - Undoes any auto gain reduction
+    self.gain = int(self.config['DynRDSQN8066Gain'])
+    self.I2C.write(0x28, [self._gainRegister(self.gain)], True)
     #self.I2C.write(0x28, [0b01011011])
 
     # PWM get updated
-    self.basicPWM.update(int(config['DynRDSQN8066AmpPower']))
+    self.basicPWM.update(int(self.config['DynRDSQN8066AmpPower']))
 
   def shutdown(self):
     logging.info('Stopping QN8066 transmitter')
@@ -90,126 +181,318 @@ class QN8066(Transmitter):
     # With everything stopped, shutdown PWM
     self.basicPWM.shutdown()
 
-  def reset(self, resetdelay=1):
-    # Used to restart the transmitter
+  def reset(self, resetdelay=0):
+    # Used to restart the transmitter - startup waits for the chip itself, so no delay is needed by default
+    stats.count('transmitterResets')
     self.shutdown()
-    del self.I2C
-    self.I2C = basicI2C(0x21)
-    sleep(resetdelay)
+    # Recovery resets run on a background thread, so self.I2C is replaced in one step and never missing
+    self.I2C = basicI2C(0x21, self.i2cBus)
+    if resetdelay:
+      sleep(resetdelay)
     self.startup()
 
   def status(self):
+    if self.recovering():
+      logging.info('Status - Skipped during RDS recovery')
+      return
     aud_pk = self.I2C.read(0x1a, 1)[0]>>3 & 0b1111
     fsm = self.I2C.read(0x0a,1)[0]>>4
     # TODO: Check frequency? 0x19 1:0 + 0x1b
     # TODO: Add PWM status if active - Might move elsewhere if PWM gets located to a single file
 
-    logging.info('Status - State %s (expect 10) - Audio Peak %s (target <= 14)', fsm, aud_pk)
-
-    # Reset aud_pk
-    self.I2C.write(0x24, [0b10000000 | int(max(24,(int(config['DynRDSQN8066ChipPower']) - 70.2) // 0.91))])
-    self.I2C.write(0x24, [0b00000000 | int(max(24,(int(config['DynRDSQN8066ChipPower']) - 70.2) // 0.91))])
+    if self.audioMonitored:
+      # The monitor resets aud_pk with every sample and logs the track's peak itself
+      logging.info('Status - State %s (expect 10)', fsm)
+    else:
+      logging.info('Status - State %s (expect 10) - Audio Peak %s (target <= 14)', fsm, aud_pk)
+      self._resetAudioPeak()
     super().status()
 
+  def _resetAudioPeak(self):
+    # aud_pk holds the highest level since it was last reset
+    with self.I2C.lock:
+      self.I2C.write(0x24, [0b10000000 | int(max(24,(int(self.config['DynRDSQN8066ChipPower']) - 70.2) // 0.91))])
+      self.I2C.write(0x24, [0b00000000 | int(max(24,(int(self.config['DynRDSQN8066ChipPower']) - 70.2) // 0.91))])
+
+  def audioLevel(self):
+    # Peak since the previous sample, 15 is over the target
+    if self.recovering():
+      return None
+    aud_pk = self.I2C.read(0x1a, 1)[0]>>3 & 0b1111
+    self._resetAudioPeak()
+    return aud_pk, aud_pk > 14
+
+  def reduceGain(self, maxReduction):
+    floor = max(int(self.config['DynRDSQN8066Gain']) - maxReduction, -15)
+    if self.gain <= floor:
+      return False
+    self.gain -= 1
+    logging.warning('Sustained audio overload - Gain reduced to %s (configured %s)', self.gain, self.config['DynRDSQN8066Gain'])
+    self.I2C.write(0x28, [self._gainRegister(self.gain)])
+    return True
+
+  def _gainRegister(self, gain):
+    # 0x28 - Soft clipping, then the gain split into BufferGain, DigitalGain, and InputImpedance
+    inputImpedance, digitalGain, bufferGain = gainRegisters(gain)
+    return int(self.config['DynRDSQN8066SoftClipping'])<<7 | bufferGain<<4 | digitalGain<<2 | inputImpedance
+
   def updateRDSData(self, PSdata='', RTdata=''):
     logging.debug('QN8066 updateRDSData')
     super().updateRDSData(PSdata, RTdata)
     self.PS.updateData(PSdata)
     self.RT.updateData(RTdata)
 
+  def patchRDSData(self, PSdata=None, RTdata=None):
+    # Changed fragments are replaced in place - The RT A/B flag stays, so receivers overwrite the text instead of clearing it
+    PSdata = self.PStext if PSdata is None else PSdata
+    RTdata = self.RTtext if RTdata is None else RTdata
+    for buffer, data, text in ((self.PS, PSdata, self.PStext), (self.RT, RTdata, self.RTtext)):
+      if data != text and not buffer.patchData(data):
+        buffer.updateData(data)
+    super().updateRDSData(PSdata, RTdata)
+
+  def currentFragments(self):
+    PS, RT = (self.PS, self.RT) if self.interruption is None else self.interruption[:2]
+    # Buffers are empty until the first RDS data is loaded
+    if not PS.fragments or not RT.fragments:
+      return '', ''
+    return PS.fragments[PS.currentFragment], RT.fragments[RT.currentFragment]
+
+  def interrupt(self, PSdata=None, RTdata=None, trafficAnnouncement=False):
+    # The message gets its own PS and RT buffers, built once here and sent instead of self.PS and self.RT
+    # Those are left as they are (and still take updates), so restore goes back to the same fragments
+    # TP has to match on every group sent during the message, so it is set on whichever buffers are sent
+    PS, RT = self.PS, self.RT
+    sentRT = self.RT if self.interruption is None else self.interruption[1]
+    if PSdata is not None:
+      PS = self.PSBuffer(self, PSdata, int(self.config['DynRDSPSUpdateRate']))
+      PS.updateData(PSdata)
+      # Not a track change, so no frame callback for the latency tracking
+      PS.newData = False
+    if RTdata is not None:
+      RT = self.RTBuffer(self, RTdata, int(self.config['DynRDSRTUpdateRate']))
+      RT.updateData(RTdata)
+      # Opposite A/B flag of the RT being sent, so receivers clear it for the message
+      RT.ab = not sentRT.ab
+      RT.newData = False
+    else:
+      self._leaveRT(sentRT)
+    PS.trafficAnnouncement = RT.trafficAnnouncement = trafficAnnouncement
+    startTime = self.interruption[2] if self.interruption is not None else monotonic()
+    self.interruption = (PS, RT, startTime)
+    logging.info('Interrupt started%s', ' with TA' if trafficAnnouncement else '')
+
+  def restore(self):
+    if self.interruption is None:
+      return
+    PS, RT, startTime = self.interruption
+    paused = monotonic() - startTime
+    self.interruption = None
+    for buffer, sent in ((self.PS, PS), (self.RT, RT)):
+      if sent is not buffer:
+        buffer.resume(paused)
+    self._leaveRT(RT)
+    self.PS.trafficAnnouncement = self.RT.trafficAnnouncement = False
+    logging.info('Interrupt ended after %.1fs', paused)
+
+  def _leaveRT(self, sentRT):
+    # Going back from a message's RT, the current RT needs a different A/B flag than was last sent so receivers clear the message
+    if sentRT is not self.RT and sentRT.ab == self.RT.ab:
+      self.RT.ab = not self.RT.ab
+
   def sendNextRDSGroup(self):
     # If more advanced mixing of RDS groups is needed, this is where it would occur
     logging.excessive('QN8066 sendNextRDSGroup')
+    if self.interruption is not None:
+      self.interruption[0].sendNextGroup()
+      self.interruption[1].sendNextGroup()
+      return
     self.PS.sendNextGroup()
     self.RT.sendNextGroup()
+    if self.RTplus:
+      self.rtPlusCycle += 1
+      if self.rtPlusCycle % RTPLUS_INTERVAL == 0:
+        self.sendRTPlusGroup(self.rtPlusCycle // RTPLUS_INTERVAL % 2)
+
+  def sendRTPlusGroup(self, tagGroup):
+    # 3A registers the RT+ ODA, 11A has the title and artist positions in the RT fragment on air
+    pi, pty = [self.PS.pi_byte1, self.PS.pi_byte2], self.PS.pty
+    if tagGroup:
+      tags = fragmentTags(self.RTplus, self.RT.currentFragment * self.RT.frag_size, self.RT.frag_size)
+      groupBits, blockC, blockD = rtPlusBlocks(self.RTplusToggle, int(bool(tags)), tags)
+      groupType = 0b1011
+    else:
+      groupBits, blockC, blockD = RTPLUS_GROUP, 0, RTPLUS_AID
+      groupType = 0b0011
+    self.transmitRDS(pi + [groupType<<4 | pty>>3, (0b00111 & pty)<<5 | groupBits, blockC >> 8, blockC & 0xff, blockD >> 8, blockD & 0xff])
 
   def transmitRDS(self, rdsBytes):
     # Specific to QN 8036 and 8066 chips
+    if self.recovering():
+      # Hold RDS while the chip is being recovered, at the group rate so the main loop keeps its pace
+      sleep(GROUP_PERIOD)
+      return
+    startTime = perf_counter_ns()
     rdsStatusByte = self.I2C.read(0x01, 1)[0]
     rdsSendToggleBit = rdsStatusByte >> 1 & 0b1
     rdsSentStatusToggleBit = self.I2C.read(0x1a, 1)[0] >> 2 & 0b1
-    logging.excessive('Transmit %s - Send Bit %s - Status Bit %s', ' '.join(f'0x{a:02x}' for a in rdsBytes), rdsSendToggleBit, rdsSentStatusToggleBit)
+    trace.record(TRACE_RDS_GROUP, rdsSendToggleBit << 1 | rdsSentStatusToggleBit, rdsBytes)
     self.I2C.write(0x1c, rdsBytes)
     self.I2C.write(0x01, [rdsStatusByte ^ 0b10])
     # RDS specifications indicate 87.6ms to send a group
-    # sleep is a bit less, plus time to read the status toggle bit
-    sleep(0.087)
-    if (self.I2C.read(0x1a, 1)[0] >> 2 & 1) == rdsSentStatusToggleBit:
-      i = 0
-      while (self.I2C.read(0x1a, 1)[0] >> 2 & 1) == rdsSentStatusToggleBit:
-        logging.excessive('Waiting for rdsSentStatusToggleBit to flip')
+    # Each deadline is chained from the last one, so the I2C time between groups doesn't add up as drift and a group that
+    # starts late is counted as a deadline miss - After a gap of more than a group (idle, recovery) the chain starts again
+    now = monotonic()
+    if now - self.groupDeadline > GROUP_PERIOD:
+      self.groupDeadline = now
+    self.groupDeadline += GROUP_PERIOD
+    scheduler.sleepUntil(self.groupDeadline)
+    # Allow up to ~2 more group times for the sent status toggle bit to flip
+    if self.waitUntil(lambda: (self.I2C.read(0x1a, 1)[0] >> 2 & 1) != rdsSentStatusToggleBit, 0.2, 0.01):
+      if self.stallCount:
+        logging.info('RDS recovered after %s stall(s)', self.stallCount)
+        stats.count('rdsRecovered')
+        self.stallCount = 0
+        self.resetBackoff = RESET_BACKOFF_MIN
+    else:
+      logging.error('rdsSentStatusToggleBit failed to flip')
+      trace.record(TRACE_RDS_STALL, rdsSentStatusToggleBit, rdsBytes)
+      trace.dumpOnError()
+      stats.count('rdsStalls')
+      self.recover(rdsBytes)
+    stats.record('rdsGroup', (perf_counter_ns() - startTime) // 1000)
+    stats.count('rdsGroups')
+
+  def recovering(self):
+    # True while a recovery step runs on its own thread, when only that thread may use the chip
+    return self.recovery is not None and self.recovery.is_alive() and self.recovery is not current_thread()
+
+  def recover(self, rdsBytes):
+    # Escalates one level per consecutive stall, so a glitch costs a group time and only a stuck chip gets a full reset
+    level = min(self.stallCount, len(RECOVERY_LEVELS) - 1)
+    self.stallCount += 1
+    if RECOVERY_LEVELS[level] == 'Reset' and monotonic() < self.nextResetTime:
+      logging.warning('RDS stall %s - Waiting %.0fs before another reset', self.stallCount, self.nextResetTime - monotonic())
+      return
+    logging.warning('RDS stall %s - Recovery %s', self.stallCount, RECOVERY_LEVELS[level])
+    stats.count('rdsRecovery' + RECOVERY_LEVELS[level])
+
+    if level == 0:
+      # Send the same group again with a fresh toggle
+      rdsStatusByte = self.I2C.read(0x01, 1)[0]
+      self.I2C.write(0x1c, rdsBytes)
+      self.I2C.write(0x01, [rdsStatusByte ^ 0b10])
+      return
+    self.recovery = Thread(target=self.recoveryStep, args=(level,), daemon=True)
+    self.recovery.start()
+
+  def recoveryStep(self, level):
+    try:
+      if level == 1:
+        # Cycle the RDS enable bit
+        rdsStatusByte = self.I2C.read(0x01, 1)[0]
+        self.I2C.write(0x01, [rdsStatusByte & 0b10111111])
         sleep(0.01)
-        i += 1
-        if i > 50:
-          logging.error('rdsSentStatusToggleBit failed to flip')
-          # RDS has failed to update, reset the QN8066
-          self.reset()
-          break
+        self.I2C.write(0x01, [rdsStatusByte | 0b01000000])
+      elif level == 2:
+        # Standby then back to TX, without a register reset
+        self.I2C.write(0x00, [0b00100011])
+        self.waitUntil(lambda: self.I2C.read(0x0a, 1)[0] >> 4 != 10, 0.2)
+        self.I2C.write(0x00, [0b00001011])
+        if not self.waitUntil(lambda: self.I2C.read(0x0a, 1)[0] >> 4 == 10, 0.5):
+          logging.warning('QN8066 did not return to TX state within 500ms')
+      else:
+        self.nextResetTime = monotonic() + self.resetBackoff
+        self.resetBackoff = min(self.resetBackoff * 2, RESET_BACKOFF_MAX)
+        self.reset()
+    except (Exception, SystemExit):
+      # startup exits when the chip can't be found, which would only end this thread
+      logging.exception('RDS recovery %s', RECOVERY_LEVELS[level])
 
   class PSBuffer(Transmitter.RDSBuffer):
     # Sends RDS type 0B groups - Program Service
     # Fragment size of 8, Groups send 2 characters at a time
     def __init__(self, outer, data, delay=4):
-      super().__init__(data, 8, 2, delay)
+      # PS and RT groups alternate, so each buffer sends every other group
+      super().__init__(data, 8, 2, delay, GROUP_PERIOD * 2, outer.config)
       # Include outer for the common transmitRDS function that both PSBuffer and RTBuffer use
       self.outer = outer
+      # Sets TP and TA, for interrupt messages
+      self.trafficAnnouncement = False
 
     def updateData(self, data):
       super().updateData(data)
-      # Adjust last fragment to make all 8 characters long
-      self.fragments[-1] = self.fragments[-1].ljust(self.frag_size)
       logging.info('PS %s', self.fragments)
 
+    def makeFragments(self, data):
+      fragments = super().makeFragments(data)
+      # Adjust last fragment to make all 8 characters long
+      fragments[-1] = fragments[-1].ljust(self.frag_size)
+      return fragments
+
     def sendNextGroup(self):
-      if self.currentGroup == 0 and (datetime.now() - self.lastFragmentTime).total_seconds() >= self.delay:
+      if self.currentGroup == 0 and self.fragmentDue():
         self.currentFragment = (self.currentFragment + 1) % len(self.fragments)
-        self.lastFragmentTime = datetime.now()
         logging.debug('Send PS Fragment \'%s\'', self.fragments[self.currentFragment])
 
-      rdsBytes = [self.pi_byte1, self.pi_byte2, 0b10<<2 | self.pty>>3, (0b00111 & self.pty)<<5 | self.currentGroup, self.pi_byte1, self.pi_byte2]
+      rdsBytes = [self.pi_byte1, self.pi_byte2, 0b10<<2 | self.trafficAnnouncement<<2 | self.pty>>3,
+                  (0b00111 & self.pty)<<5 | self.trafficAnnouncement<<4 | self.currentGroup, self.pi_byte1, self.pi_byte2]
       rdsBytes.append(ord(self.fragments[self.currentFragment][self.currentGroup * self.group_size]))
       rdsBytes.append(ord(self.fragments[self.currentFragment][self.currentGroup * self.group_size + 1]))
 
       self.outer.transmitRDS(rdsBytes)
+      self.fragmentGroups += 1
       self.currentGroup = (self.currentGroup + 1) % (self.frag_size // self.group_size)
+      if self.currentGroup == 0 and self.newData:
+        self.newData = False
+        self.outer.frameSent('PS')
 
   class RTBuffer(Transmitter.RDSBuffer):
     # Sends RDS type 2A groups - RadioText
     # Max fragment size of 64, Groups send 4 characters at a time
     def __init__(self, outer, data, delay=7):
       self.ab = 0
-      super().__init__(data, int(config['DynRDSRTSize']), 4, delay)
+      super().__init__(data, int(outer.config['DynRDSRTSize']), 4, delay, GROUP_PERIOD * 2, outer.config)
       self.outer = outer
+      # Sets TP, 2A groups have no TA
+      self.trafficAnnouncement = False
 
     def updateData(self, data):
       super().updateData(data)
-      # Add 0x0d to end of last fragment to indicate RT is done
-      # TODO: This isn't quite correct - Should put 0x0d where a break is indicated in the rdsStyleText
-      if len(self.fragments[-1]) < self.frag_size:
-        self.fragments[-1] += chr(0x0d)
       self.ab = not self.ab
       logging.info('RT %s', self.fragments)
 
+    def makeFragments(self, data):
+      fragments = super().makeFragments(data)
+      # Add 0x0d to end of last fragment to indicate RT is done
+      # TODO: This isn't quite correct - Should put 0x0d where a break is indicated in the rdsStyleText
+      if len(fragments[-1]) < self.frag_size:
+        fragments[-1] += chr(0x0d)
+      return fragments
+
     def sendNextGroup(self):
       # Will block for ~80-90ms for RDS Group to be sent
       # Check time, if it has been long enough AND a full RT fragment has been sent, move to next fragment
       # Flip A/B bit, send next group, if last group set full RT sent flag
       # Need to make sure full RT group has been sent at least once before moving on
-      if self.currentGroup == 0 and (datetime.now() - self.lastFragmentTime).total_seconds() >= self.delay:
+      if self.currentGroup == 0 and self.fragmentDue():
         self.currentFragment = (self.currentFragment + 1) % len(self.fragments)
-        self.lastFragmentTime = datetime.now()
         self.ab = not self.ab
         # Change \r (0x0d) to be [0d] for logging so it is visible in case of debugging
         logging.debug('Send RT Fragment \'%s\'', self.fragments[self.currentFragment].replace('\r','<0d>'))
 
       # TODO: Seems like this could be improved
-      rdsBytes = [self.pi_byte1, self.pi_byte2, 0b1000<<2 | self.pty>>3, (0b00111 & self.pty)<<5 | self.ab<<4 | self.currentGroup]
+      rdsBytes = [self.pi_byte1, self.pi_byte2, 0b1000<<2 | self.trafficAnnouncement<<2 | self.pty>>3, (0b00111 & self.pty)<<5 | self.ab<<4 | self.currentGroup]
       rdsBytes.append(ord(self.fragments[self.currentFragment][self.currentGroup * self.group_size]))
       rdsBytes.append(ord(self.fragments[self.currentFragment][self.currentGroup * self.group_size + 1]) if len(self.fragments[self.currentFragment]) - self.currentGroup * self.group_size >= 2 else 0x20)
       rdsBytes.append(ord(self.fragments[self.currentFragment][self.currentGroup * self.group_size + 2]) if len(self.fragments[self.currentFragment]) - self.currentGroup * self.group_size >= 3 else 0x20)
       rdsBytes.append(ord(self.fragments[self.currentFragment][self.currentGroup * self.group_size + 3]) if len(self.fragments[self.currentFragment]) - self.currentGroup * self.group_size >= 4 else 0x20)
 
       self.outer.transmitRDS(rdsBytes)
+      self.fragmentGroups += 1
       self.currentGroup += 1
       if self.currentGroup * self.group_size >= len(self.fragments[self.currentFragment]):
         self.currentGroup = 0
+        if self.newData:
+          self.newData = False
+          self.outer.frameSent('RT')
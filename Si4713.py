@@ -1,19 +1,27 @@
 import logging
 import sys
 from threading import Timer
-from time import sleep
-from gpiozero import DigitalOutputDevice
+from time import sleep, monotonic
 
-from config import config
 from basicI2C import basicI2C
-from Transmitter import Transmitter
+from Transmitter import Transmitter, GROUP_PERIOD, RTPLUS_AID, RTPLUS_GROUP, rtPlusBlocks, fragmentTags
+from engineStats import stats
+
+# Share of RDS groups sent from the circular buffer with PS mix 0x05 (87.5% PS)
+RT_SHARE = 0.125
 
 class Si4713(Transmitter):
-  def __init__(self):
+  def __init__(self, settings=None, bus=None, address=0x63):
     logging.info('Initializing Si4713 transmitter')
-    super().__init__()
-    self.I2C = basicI2C(0x63)  # Si4713 default I2C address
+    super().__init__(settings)
+    self.i2cBus = bus
+    self.address = address  # 0x63 is the Si4713 default I2C address, 0x11 with SEN low
+    self.I2C = basicI2C(address, bus)
     self.totalCircularBuffers = 0
+    # When the RT last loaded will have been sent in full, see patchRDSData
+    self.rtSentTime = 0
+    # RT change waiting for rtSentTime, loaded by sendNextRDSGroup
+    self.rtPending = None
 
   # Si4713 Commands
   CMD_POWER_UP = 0x01
@@ -45,6 +53,14 @@ class Si4713(Transmitter):
 
   # Status bits
   STATUS_CTS = 0x80
+  STATUS_ERR = 0x40
+  STATUS_STCINT = 0x01
+
+  # Reset pulse and settle times, datasheet minimums are 100us
+  RESET_PULSE = 0.001
+  RESET_SETTLE = 0.001
+  # Crystal oscillator needs to settle after power up before tuning
+  CRYSTAL_SETTLE = 0.5
 
   def _wait_for_cts(self, timeout=100):
     iterations = timeout  # Each iteration is ~1ms
@@ -54,10 +70,23 @@ class Si4713(Transmitter):
       sleep(0.001)
     return False
 
+  def _wait_for_stc(self, timeout=0.5):
+    # Tune commands finish by setting STCINT, which is then cleared with TX_TUNE_STATUS INTACK
+    ready = self.waitUntil(self._stcSet, timeout, 0.001)
+    self._send_command(self.CMD_TX_TUNE_STATUS, [0x01])
+    return ready
+
+  def _stcSet(self):
+    # GET_INT_STATUS and its response under one lock, like every command with a response
+    with self.I2C.lock:
+      return self._send_command(self.CMD_GET_INT_STATUS) and self.I2C.read(0x00, 1)[0] & self.STATUS_STCINT
+
   def _send_command(self, cmd, args = None, isFatal = False):
+    # Commands that return a response hold self.I2C.lock until it is read, so the audio monitor can't cut in
     args = args or []
-    self.I2C.write(cmd, args, isFatal)
-    return self._wait_for_cts()
+    with self.I2C.lock:
+      self.I2C.write(cmd, args, isFatal)
+      return self._wait_for_cts()
 
   def _set_property(self, prop, value):
     """Set a property on the Si4713"""
@@ -72,73 +101,59 @@ class Si4713(Transmitter):
 
   def startup(self):
     logging.info('Starting Si4713 transmitter')
+    self.startPhases()
 
-    logging.info('Executing Reset with Pin %s', config['DynRDSSi4713GPIOReset'])
-    with DigitalOutputDevice(int(config['DynRDSSi4713GPIOReset'])) as resetPin:
+    logging.info('Executing Reset with Pin %s', self.config['DynRDSSi4713GPIOReset'])
+    from gpiozero import DigitalOutputDevice
+    with DigitalOutputDevice(int(self.config['DynRDSSi4713GPIOReset'])) as resetPin:
       resetPin.off()
-      sleep(0.01)
+      sleep(self.RESET_PULSE)
       resetPin.on()
-      sleep(0.11)
+      sleep(self.RESET_SETTLE)
+    self.markPhase('reset')
 
     # Power up in transmit mode (Crystal oscillator and Analog audio input)
     self.I2C.write(self.CMD_POWER_UP, [0b00010010, 0b01010000], True)
-    sleep(0.5) # Wait for power up
-    if not self._wait_for_cts():
+    crystalReady = monotonic() + self.CRYSTAL_SETTLE
+    if not self._wait_for_cts(600):
       logging.error('Si4713 failed to be read after power up')
       sys.exit(-1)
+    self.markPhase('powerUp')
 
     # Verify chip by getting revision
-    self._send_command(self.CMD_GET_REV, [], True)
-    revData = self.I2C.read(0x00, 9, True)
+    with self.I2C.lock:
+      self._send_command(self.CMD_GET_REV, [], True)
+      revData = self.I2C.read(0x00, 9, True)
     logging.info('Si47%02d - FW %d.%d - Chip Rev %d',
                  revData[1], revData[2], revData[3], revData[8])
     if revData[1] != 13:
       logging.error('Part Number value is %02d instead of 13. Is this a Si4713 chip?', revData[1])
       sys.exit(-1)
 
-    # TODO: Make a function to use in status?
-    self._send_command(self.CMD_TX_RDS_BUFF, [0, 0, 0, 0, 0, 0, 0], True)
-    rdsBuffData = self.I2C.read(0x00, 6, True)
-    logging.info('Circular Buffer: %d/%d, Fifo Buffer: %d/%d',
-                  rdsBuffData[3], rdsBuffData[2] + rdsBuffData[3],
-                  rdsBuffData[5], rdsBuffData[4] + rdsBuffData[5])
-    self.totalCircularBuffers = rdsBuffData[2] + rdsBuffData[3]
+    self._readRDSBuffers()
+    self._configureProperties()
+    self.markPhase('configure')
 
-    # Enable pilot, stereo, and RDS (if enabled)
-    if config['DynRDSEnableRDS'] == "1":
-      self._set_property(self.PROP_TX_COMPONENT_ENABLE, 0x0007)
-    else:
-      self._set_property(self.PROP_TX_COMPONENT_ENABLE, 0x0003)
-
-    # Set pre-emphasis
-    if config['DynRDSPreemphasis'] == "50us":
-      self._set_property(self.PROP_TX_PREEMPHASIS, 1)  # 50 us
-    else:
-      self._set_property(self.PROP_TX_PREEMPHASIS, 0)  # 75 us
-
-    # Configure RDS
-    self._set_property(self.PROP_TX_RDS_PS_MIX, 0x05)  # Mix mode
-    self._set_property(self.PROP_TX_RDS_PS_REPEAT_COUNT, 9)  # Repeat 3 times
-    # TODO: Timing guidance is needed
-    # MIX @ 5 and REPEAT @ 9 - PS ~4 sec, RT ~5.5 sec
-    # Lowering MIX still speed up RT refresh
-    # Lowering REP will speed up PS, Raising REP will slow down PS
-    # TODO: Decide on bit 11 - 0=FIFO and BUFFER use PTY and TP as when written, 1=Force to be this setting
-    self._set_property(self.PROP_TX_RDS_PS_MISC, 0b0001100000001000 | int(config['DynRDSPty'])<<5)
+    # Configuration above overlaps with the crystal settling, only tuning has to wait for it
+    if monotonic() < crystalReady:
+      sleep(crystalReady - monotonic())
+    self.markPhase('crystal')
 
     # Set frequency from config
-    tempFreq = int(float(config['DynRDSFrequency']) * 100)  # Convert to 10 kHz units
+    tempFreq = int(float(self.config['DynRDSFrequency']) * 100)  # Convert to 10 kHz units
     args = [
       0x00,  # Reserved
       (tempFreq >> 8) & 0xFF,  # Frequency high byte
       tempFreq & 0xFF  # Frequency low byte
     ]
     self._send_command(self.CMD_TX_TUNE_FREQ, args)
-    sleep(0.1)  # Wait for tune
+    if not self._wait_for_stc():
+      logging.warning('Si4713 tune did not complete within 500ms')
+    self.markPhase('tune')
 
     # Set transmission power
-    power = int(config['DynRDSSi4713ChipPower'])
-    antcap = int(config['DynRDSSi4713TuningCap'])
+    power = int(self.config['DynRDSSi4713ChipPower'])
+    antcap = int(self.config['DynRDSSi4713TuningCap'])
 
     args = [
       0x00,  # Reserved
@@ -147,14 +162,89 @@ class Si4713(Transmitter):
       antcap & 0xFF # Antenna cap (0 = auto)
     ]
     self._send_command(self.CMD_TX_TUNE_POWER, args)
-    sleep(0.02)
+    if not self._wait_for_stc():
+      logging.warning('Si4713 power did not complete within 500ms')
+    self.markPhase('power')
 
     # Set TX_RDS_PI
-    self._set_property(self.PROP_TX_RDS_PI, int(config['DynRDSPICode'], 16))
+    self._set_property(self.PROP_TX_RDS_PI, int(self.config['DynRDSPICode'], 16))
 
     self.update()
     super().startup()
     self.updateRDSData(self.PStext, self.RTtext)
+    self.markPhase('rds')
+    self.logPhases('si4713Startup')
+
+  def attach(self):
+    # Chip keeps transmitting while it has power, so after an Engine restart check it is tuned as configured
+    # and take it over with only the properties re-applied - No reset pin, power up, or retune
+    with self.I2C.lock:
+      probe = self.I2C.read(0x00, 1, attempts=1)
+      if not probe or not probe[0] & self.STATUS_CTS or not self._send_command(self.CMD_GET_REV):
+        return False
+      revData = self.I2C.read(0x00, 9)
+    if len(revData) < 9 or revData[0] & self.STATUS_ERR or revData[1] != 13:
+      logging.info('Si4713 not powered up, full startup needed')
+      return False
+
+    with self.I2C.lock:
+      self._send_command(self.CMD_TX_TUNE_STATUS, [0x00])
+      statusData = self.I2C.read(0x00, 8)
+    freq = statusData[2] << 8 | statusData[3]
+    if freq != int(float(self.config['DynRDSFrequency']) * 100) or statusData[5] != int(self.config['DynRDSSi4713ChipPower']):
+      logging.info('Si4713 is at %.2f MHz power %d, full startup needed', freq / 100.0, statusData[5])
+      return False
+
+    logging.info('Attaching to running Si4713 at %.2f MHz', freq / 100.0)
+    self.startPhases()
+    self._readRDSBuffers()
+    self._configureProperties()
+    self._set_property(self.PROP_TX_RDS_PI, int(self.config['DynRDSPICode'], 16))
+    self.markPhase('configure')
+    self.update()
+    super().startup()
+    self.updateRDSData(self.PStext, self.RTtext)
+    self.markPhase('rds')
+    self.logPhases('si4713Attach')
+    stats.count('warmAttaches')
+    return True
+
+  def _readRDSBuffers(self):
+    # TODO: Make a function to use in status?
+    with self.I2C.lock:
+      self._send_command(self.CMD_TX_RDS_BUFF, [0, 0, 0, 0, 0, 0, 0], True)
+      rdsBuffData = self.I2C.read(0x00, 6, True)
+    logging.info('Circular Buffer: %d/%d, Fifo Buffer: %d/%d',
+                  rdsBuffData[3], rdsBuffData[2] + rdsBuffData[3],
+                  rdsBuffData[5], rdsBuffData[4] + rdsBuffData[5])
+    self.totalCircularBuffers = rdsBuffData[2] + rdsBuffData[3]
+
+  def _configureProperties(self):
+    # Enable pilot, stereo, and RDS (if enabled)
+    if self.config['DynRDSEnableRDS'] == "1":
+      self._set_property(self.PROP_TX_COMPONENT_ENABLE, 0x0007)
+    else:
+      self._set_property(self.PROP_TX_COMPONENT_ENABLE, 0x0003)
+
+    # Set pre-emphasis
+    if self.config['DynRDSPreemphasis'] == "50us":
+      self._set_property(self.PROP_TX_PREEMPHASIS, 1)  # 50 us
+    else:
+      self._set_property(self.PROP_TX_PREEMPHASIS, 0)  # 75 us
+
+    # Configure RDS
+    self._set_property(self.PROP_TX_RDS_PS_MIX, 0x05)  # Mix mode
+    self._set_property(self.PROP_TX_RDS_PS_REPEAT_COUNT, 9)  # Repeat 3 times
+    # TODO: Timing guidance is needed
+    # MIX @ 5 and REPEAT @ 9 - PS ~4 sec, RT ~5.5 sec
+    # Lowering MIX still speed up RT refresh
+    # Lowering REP will speed up PS, Raising REP will slow down PS
+    # TODO: Decide on bit 11 - 0=FIFO and BUFFER use PTY and TP as when written, 1=Force to be this setting
+    self._set_property(self.PROP_TX_RDS_PS_MISC, self._psMisc())
+
+  def _psMisc(self, trafficAnnouncement=False):
+    # Stereo, forced PTY and TP, music - With a traffic announcement TP (bit 10) and TA (bit 4) are set
+    return 0b0001100000001000 | int(self.config['DynRDSPty'])<<5 | (0b10000010000 if trafficAnnouncement else 0)
 
   def update(self):
     # Si4713 doesn't have AGC or soft clipping settings like QN8066
@@ -167,19 +257,22 @@ class Si4713(Transmitter):
     self._send_command(self.CMD_POWER_DOWN, [])
     super().shutdown()
 
-  def reset(self, resetdelay=1):
-    # Used to restart the transmitter
+  def reset(self, resetdelay=0):
+    # Used to restart the transmitter - startup polls the chip itself, so no delay is needed by default
+    stats.count('transmitterResets')
     self.shutdown()
     del self.I2C
-    self.I2C = basicI2C(0x63)
-    sleep(resetdelay)
+    self.I2C = basicI2C(self.address, self.i2cBus)
+    if resetdelay:
+      sleep(resetdelay)
     self.startup()
 
   def status(self):
     # TODO: Review before Si4713 support is done
     # Get transmitter status
-    self._send_command(self.CMD_TX_TUNE_STATUS, [0x01])  # Clear interrupt
-    status_data = self.I2C.read(0x00, 8)
+    with self.I2C.lock:
+      self._send_command(self.CMD_TX_TUNE_STATUS, [0x01])  # Clear interrupt
+      status_data = self.I2C.read(0x00, 8)
 
     if status_data[0] & self.STATUS_CTS:
       freq = (status_data[2] << 8) | status_data[3]
@@ -192,17 +285,84 @@ class Si4713(Transmitter):
 
     super().status()
 
+  def audioLevel(self):
+    # TX_ASQ_STATUS with INTACK, so OVERMOD covers the time since the previous sample
+    with self.I2C.lock:
+      self._send_command(self.CMD_TX_ASQ_STATUS, [0x01])
+      asqData = self.I2C.read(0x00, 5)
+    if len(asqData) < 5:
+      return None
+    # Input level is a signed byte in dBfs
+    inLevel = asqData[4] - 256 if asqData[4] & 0x80 else asqData[4]
+    return inLevel, bool(asqData[1] & 0b100)
+
   def updateRDSData(self, PSdata='', RTdata=''):
     logging.debug('Si4713 updateRDSData')
+    self.rtPending = None
     super().updateRDSData(PSdata, RTdata)
-    if self.active:
+    if self.active and self.interruption is None:
       self._updatePS(PSdata)
-      self._updateRT(RTdata)
+      self._updateRT(RTdata, self.RTplus)
+      # The chip sends from its own buffers without per-group feedback, so loaded is as close to on air as can be seen
+      self.frameSent('PS')
+      self.frameSent('RT')
       # Initial burst of RT groups to get it displayed quickly
       logging.debug('RT group burst')
       self._set_property(self.PROP_TX_RDS_PS_MIX, 0x02)  # Mix mode
       Timer(1, lambda: [logging.debug('RT group burst done'), self._set_property(self.PROP_TX_RDS_PS_MIX, 0x05)]).start()
 
+  def patchRDSData(self, PSdata=None, RTdata=None):
+    # Only what changed is loaded, without the RT burst, and the RT A/B flags stay as they were loaded
+    # Loading the RT starts the circular buffer over, so an RT change waits until the last one has been sent in full
+    # and sendNextRDSGroup loads the latest one then - Otherwise a {R} every second would keep the end of the RT from being sent
+    PSdata = self.PStext if PSdata is None else PSdata
+    if RTdata is None:
+      RTdata = self.RTtext if self.rtPending is None else self.rtPending
+    psChanged = PSdata != self.PStext
+    rtChanged = RTdata != self.RTtext
+    self.rtPending = None
+    if rtChanged and monotonic() < self.rtSentTime:
+      self.rtPending = RTdata
+      rtChanged = False
+    if not psChanged and not rtChanged:
+      return
+    super().updateRDSData(PSdata, RTdata if rtChanged else self.RTtext)
+    if self.active and self.interruption is None:
+      if psChanged:
+        self._updatePS(PSdata)
+      if rtChanged:
+        self._updateRT(RTdata, self.RTplus)
+
+  def interrupt(self, PSdata=None, RTdata=None, trafficAnnouncement=False):
+    # The chip rotates its own buffers, so the message is loaded in place of the current data and restore loads it again
+    # A new message replaces the previous one, including going back to the current data for a part it doesn't have
+    previous = self.interruption or (False, False)
+    self.interruption = (PSdata is not None, RTdata is not None)
+    if not self.active:
+      return
+    self._set_property(self.PROP_TX_RDS_PS_MISC, self._psMisc(trafficAnnouncement))
+    if PSdata is not None or previous[0]:
+      self._updatePS(self.PStext if PSdata is None else PSdata)
+    if RTdata is not None:
+      self._updateRT(RTdata)
+    elif previous[1]:
+      self._updateRT(self.RTtext, self.RTplus)
+    logging.info('Interrupt started%s', ' with TA' if trafficAnnouncement else '')
+
+  def restore(self):
+    if self.interruption is None:
+      return
+    PSloaded, RTloaded = self.interruption
+    self.interruption = None
+    if not self.active:
+      return
+    self._set_property(self.PROP_TX_RDS_PS_MISC, self._psMisc())
+    if PSloaded:
+      self._updatePS(self.PStext)
+    if RTloaded:
+      self._updateRT(self.RTtext, self.RTplus)
+    logging.info('Interrupt ended')
+
   def _updatePS(self, psText):
     logging.debug('Si4713 _updatePS')
     if len(psText) > 96:
@@ -224,11 +384,15 @@ class Si4713(Transmitter):
 
     self._set_property(self.PROP_TX_RDS_PS_MESSAGE_COUNT, (len(psText) // 8))
 
-  def _updateRT(self, rtText):
+  def _updateRT(self, rtText, tags=()):
     logging.debug('Si4713 _updateRT')
 
     # Calculate max number of complete BCD groups * 4 chars per group, down to the nearest 32, back to characters
-    rtMaxLength = self.totalCircularBuffers // 3 * 4 // 32 * 32
+    # With RT+ tags, each 32 characters also take an 11A group and the buffer starts with a 3A group
+    if tags:
+      rtMaxLength = (self.totalCircularBuffers // 3 - 1) // 9 * 32
+    else:
+      rtMaxLength = self.totalCircularBuffers // 3 * 4 // 32 * 32
     logging.debug('RT length: %d, Abs Max Length: %d', len(rtText), rtMaxLength)
 
     if len(rtText) > rtMaxLength:
@@ -243,6 +407,9 @@ class Si4713(Transmitter):
 
     # Empty circular buffer
     self._send_command(self.CMD_TX_RDS_BUFF, [0b00000010, 0, 0, 0, 0, 0, 0])
+    if tags:
+      # Registers the RT+ ODA on 11A groups
+      self._send_command(self.CMD_TX_RDS_BUFF, [0b00000100, 0b00110000, RTPLUS_GROUP, 0, 0, RTPLUS_AID >> 8, RTPLUS_AID & 0xff])
 
     segmentOffset = 0
     ab_flag = True
@@ -254,11 +421,22 @@ class Si4713(Transmitter):
       rtBytes = [0b00000100, 0b00100000, ab_flag<<4 | segmentOffset]
       rtBytes.extend(list(rtText[i:i+4].encode('ascii')))
       # TODO: Can add to buffer twice as a way to slow down update speed
-      self._send_command(self.CMD_TX_RDS_BUFF, rtBytes)
-      rdsBuffData = self.I2C.read(0x00, 6)
+      with self.I2C.lock:
+        self._send_command(self.CMD_TX_RDS_BUFF, rtBytes)
+        rdsBuffData = self.I2C.read(0x00, 6)
       segmentOffset += 1
+
+      if tags and segmentOffset == 8:
+        # Title and artist positions follow the 32 characters they are in
+        segmentTags = fragmentTags(tags, i - 28, 32)
+        groupBits, blockC, blockD = rtPlusBlocks(self.RTplusToggle, int(bool(segmentTags)), segmentTags)
+        self._send_command(self.CMD_TX_RDS_BUFF, [0b00000100, 0b10110000, groupBits, blockC >> 8, blockC & 0xff, blockD >> 8, blockD & 0xff])
     logging.info('Circular Buffer: %d/%d', rdsBuffData[3], rdsBuffData[2] + rdsBuffData[3])
+    groups = len(rtText) // 4 + (len(rtText) // 32 + 1 if tags else 0)
+    self.rtSentTime = monotonic() + groups * GROUP_PERIOD / RT_SHARE
 
   def sendNextRDSGroup(self):
     logging.excessive('Si4713 sendNextRDSGroup')
+    if self.rtPending is not None and monotonic() >= self.rtSentTime:
+      self.patchRDSData(None, self.rtPending)
     sleep(0.25)
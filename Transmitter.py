@@ -1,8 +1,8 @@
 import logging
-from time import sleep
-from datetime import datetime
+from time import sleep, monotonic, perf_counter_ns
 
 from config import config
+from engineStats import stats
 
 # ===================
 # Transmitter Classes
@@ -22,17 +22,54 @@ from config import config
 #   PSBuffer (RDSBuffer)
 #   RTBuffer (RDSBuffer)
 
+# RDS specifications indicate 87.6ms to send a group
+GROUP_PERIOD = 0.0876
+GROUP_PERIOD_WEIGHT = 0.25
+
+# RadioText Plus - ODA application ID, registered with a 3A group for 11A groups
+RTPLUS_AID = 0x4BD7
+RTPLUS_GROUP = 0b10110
+
+def rtPlusBlocks(toggle, running, tags):
+  # 11A group as the low 5 bits of block B, block C, and block D for up to 2 (content type, start, length) tags
+  # Item toggle, item running, then type (6 bits), start (6 bits), and length - 1 (6 bits, 5 for the second tag)
+  (type1, start1, length1), (type2, start2, length2) = (list(tags[:2]) + [(0, 0, 1)] * 2)[:2]
+  bits = (toggle << 36 | running << 35 | type1 << 29 | start1 << 23 | (length1 - 1) << 17 |
+          type2 << 11 | start2 << 5 | min(length2 - 1, 0b11111))
+  return bits >> 32 & 0b11111, bits >> 16 & 0xffff, bits & 0xffff
+
+def fragmentTags(tags, start, size):
+  # Tags entirely inside the fragment at start, relative to it - Receivers would show a cut off title otherwise
+  return [(contentType, tagStart - start, length) for contentType, tagStart, length in tags
+          if tagStart >= start and tagStart + length <= start + size]
+
 class Transmitter:
-  def __init__(self):
-    # Common class init
+  def __init__(self, settings=None):
+    # Common class init - settings replaces the Engine config for a transmitter with its own settings
+    self.config = config if settings is None else settings
     self.active = False
     self.PStext = ''
     self.RTtext = ''
+    # Called with 'PS' or 'RT' once the first full frame of new data has been transmitted
+    self.frameCallback = None
+    self.phases = []
+    # Interrupt message on air instead of PStext and RTtext, None when there isn't one
+    self.interruption = None
+    # RadioText Plus tags for RTtext, and the item toggle that flips with each new item
+    self.RTplus = []
+    self.RTplusItems = []
+    self.RTplusToggle = 0
+    # Set while an audio monitor samples audioLevel, which then keeps track of the peak level
+    self.audioMonitored = False
 
   def startup(self):
     # Common elements for starting up the transmitter for broadcast
     self.active = True
 
+  def attach(self):
+    # Take over a transmitter that is already running as configured, without resetting it - Returns False when startup is needed
+    return False
+
   def update(self):
     # For settings that can be updated dynamically
     pass
@@ -51,15 +88,81 @@ class Transmitter:
     # Expected to be defined by child class
     pass
 
+  def currentFragments(self):
+    # PS and RT as on air right now - Chips that rotate fragments themselves only have the full text
+    return self.PStext[:8], self.RTtext[:64]
+
+  def audioLevel(self):
+    # Current audio level as (level, overloaded), for the audio monitor - None when the chip can't report it
+    return None
+
+  def reduceGain(self, maxReduction):
+    # Lowers the input gain one step, no more than maxReduction below the configured gain - Returns False if it can't
+    return False
+
   def updateRDSData(self, PSdata='', RTdata=''):
     # Expected to be defined by child class
     self.PStext = PSdata
     self.RTtext = RTdata
 
+  def updateRTPlus(self, RTdata, tags):
+    # RadioText Plus tags as (content type, start, length) in RTdata, set before RTdata is sent with updateRDSData
+    # or patchRDSData - Receivers treat a flipped item toggle as a new item, so it only flips when the tagged text changes
+    items = [(contentType, RTdata[start:start + length]) for contentType, start, length in tags]
+    if items != self.RTplusItems:
+      self.RTplusItems = items
+      self.RTplusToggle ^= 1
+    self.RTplus = list(tags)
+
+  def patchRDSData(self, PSdata=None, RTdata=None):
+    # Small changes to the current data (like a clock), None keeps that text - Child classes that can change only what
+    # differs, without restarting the rotation, override this
+    PSdata = self.PStext if PSdata is None else PSdata
+    RTdata = self.RTtext if RTdata is None else RTdata
+    if PSdata != self.PStext or RTdata != self.RTtext:
+      self.updateRDSData(PSdata, RTdata)
+
+  def interrupt(self, PSdata=None, RTdata=None, trafficAnnouncement=False):
+    # Sends an urgent message in place of the current data until restore, None leaves that part as it is
+    # Data updates while interrupted are kept for the restore - Expected to be defined by child class
+    logging.warning('Interrupt messages are not supported by this transmitter')
+
+  def restore(self):
+    # Ends an interrupt, going back to the current data - Expected to be defined by child class
+    self.interruption = None
+
   def sendNextRDSGroup(self):
     # Expected to be defined by child class
     pass
 
+  def waitUntil(self, check, timeout, interval=0.002):
+    # Polls check() until it is true, for readiness signals instead of fixed sleeps - Returns False on timeout
+    deadline = monotonic() + timeout
+    while not check():
+      if monotonic() >= deadline:
+        return False
+      sleep(interval)
+    return True
+
+  def startPhases(self):
+    self.phases = [('start', perf_counter_ns())]
+
+  def markPhase(self, name):
+    self.phases.append((name, perf_counter_ns()))
+
+  def logPhases(self, what):
+    # Logs how long each startup phase took, total goes to the stats
+    if len(self.phases) < 2:
+      return
+    times = [f'{name} {(ns - self.phases[i][1]) / 1e6:.0f}ms' for i, (name, ns) in enumerate(self.phases[1:])]
+    total = (self.phases[-1][1] - self.phases[0][1]) // 1000
+    stats.record(what, total)
+    logging.info('%s %.0fms - %s', what, total / 1000, ' - '.join(times))
+
+  def frameSent(self, kind):
+    if self.frameCallback is not None:
+      self.frameCallback(kind)
+
   # =============================================
   # RDS Buffer Class (Inner class of Transmitter)
   # =============================================
@@ -68,30 +171,75 @@ class Transmitter:
   # Data - Entire string to show on RDS Screen over time - updateData called once per track, resets all counters
   # Fragment - What's on a single RDS Screen - Holds 8 for PS or 32/64 chars for RT - sendNextGroup tracks time to determine when to move to next fragment
   # Group - Single RDS Data Packet - Holds 2 or 4 chars - sendNextGroup called multiple times per second
+  #
+  # Fragments rotate after a number of groups rather than by checking the clock on every group
+  # groupPeriod is the expected time between this buffer's groups (87.6ms per group on air, times how many buffers take turns)
+  # At each rotation the monotonic clock measures the real time per group and nudges groupPeriod toward it, so the
+  # delay stays accurate without being thrown off by wall clock changes
 
   class RDSBuffer:
-    def __init__(self, data='', frag_size=0, group_size=0, delay=4):
+    def __init__(self, data='', frag_size=0, group_size=0, delay=4, groupPeriod=GROUP_PERIOD, settings=None):
       logging.debug('RDSBuffer init')
+      settings = config if settings is None else settings
       self.frag_size = frag_size
       self.group_size = group_size
       self.delay = delay
-      self.pi_byte1 = int('0x' + config['DynRDSPICode'][0:2], 16)
-      self.pi_byte2 = int('0x' + config['DynRDSPICode'][2:4], 16)
-      self.pty = int(config['DynRDSPty'])
+      self.groupPeriod = groupPeriod
+      self.groupsPerFragment = max(round(delay / groupPeriod), 1)
+      self.pi_byte1 = int('0x' + settings['DynRDSPICode'][0:2], 16)
+      self.pi_byte2 = int('0x' + settings['DynRDSPICode'][2:4], 16)
+      self.pty = int(settings['DynRDSPty'])
       self.updateData(data)
       self.fragments = []
       self.currentFragment = 0
       self.lastFragmentTime = 0
+      self.fragmentGroups = 0
       self.currentGroup = 0
 
     def updateData(self, data):
       logging.debug('RDSBuffer updateData')
-      self.fragments = []
       self.currentFragment = 0
-      self.lastFragmentTime = datetime.now()
+      self.lastFragmentTime = monotonic()
+      self.fragmentGroups = 0
+      self.currentGroup = 0
+      self.newData = True
+      self.fragments = self.makeFragments(data)
+
+    def makeFragments(self, data):
+      # Child classes add their own padding or end markers
+      return [data[i : i + self.frag_size] for i in range(0, len(data), self.frag_size)]
+
+    def patchData(self, data):
+      # Swaps in fragments that changed, keeping the current fragment and group - Returns False when the number of
+      # fragments changed, which needs updateData
+      fragments = self.makeFragments(data)
+      if len(fragments) != len(self.fragments):
+        return False
+      for i, fragment in enumerate(fragments):
+        if fragment != self.fragments[i]:
+          self.fragments[i] = fragment
+          if i == self.currentFragment and self.currentGroup * self.group_size >= len(fragment):
+            # Current fragment got shorter than what has been sent of it
+            self.currentGroup = 0
+      return True
+
+    def resume(self, pausedSeconds):
+      # After an interrupt the current fragment starts over so receivers get all of it, the pause doesn't count toward its time
+      self.lastFragmentTime += pausedSeconds
       self.currentGroup = 0
-      for i in range(0, len(data), self.frag_size):
-        self.fragments.append(data[i : i + self.frag_size])
+
+    def fragmentDue(self):
+      # Called at the start of each fragment's groups, True when it is time to rotate to the next fragment
+      if self.fragmentGroups < self.groupsPerFragment:
+        return False
+      now = monotonic()
+      # Measured period is limited so a transmitter reset or a long stall only moves the estimate a little
+      measured = min(max((now - self.lastFragmentTime) / self.fragmentGroups, self.groupPeriod / 2), self.groupPeriod * 2)
+      self.groupPeriod += (measured - self.groupPeriod) * GROUP_PERIOD_WEIGHT
+      self.groupsPerFragment = max(round(self.delay / self.groupPeriod), 1)
+      self.lastFragmentTime = now
+      self.fragmentGroups = 0
+      return True
 
     def sendNextGroup(self):
       # Expected to be defined by child class
@@ -0,0 +1,111 @@
+import logging
+import threading
+from array import array
+from time import monotonic
+
+from engineStats import stats
+
+# ===================
+# Audio Monitor Class
+# ===================
+# Samples the transmitter's audio level on a background thread into a small ring buffer
+# QN8066 levels are aud_pk (0-15, target <= 14), Si4713 levels are the ASQ input level in dBfs - Both fit in a signed byte
+# Each track gets a summary (peak, mean, overloads) at the next L, which goes to the log, the Engine stats, and MQTT status
+# With auto gain, sustained overloads step the gain down, never more than AUTO_GAIN_RANGE below the configured gain
+# The configured gain comes back with the next settings update
+
+# About 10 minutes at the default interval
+RING_SIZE = 1200
+# Overloads in the last AUTO_GAIN_WINDOW samples needed to reduce the gain by 1 step
+AUTO_GAIN_WINDOW = 10
+AUTO_GAIN_OVERLOADS = 6
+AUTO_GAIN_RANGE = 6
+
+class audioMonitor:
+  def __init__(self, transmitter, interval=0.5, autoGain=False):
+    self.transmitter = transmitter
+    self.interval = interval
+    self.autoGain = autoGain
+    self.levels = array('b', bytes(RING_SIZE))
+    self.overloads = array('b', bytes(RING_SIZE))
+    self.samples = 0
+    self.trackStart = 0
+    self.trackTime = monotonic()
+    self.lastGainChange = 0
+    self.stopEvent = threading.Event()
+    self.thread = None
+
+  def start(self):
+    logging.info('Starting audio monitor, sampling every %ss%s', self.interval, ' with auto gain' if self.autoGain else '')
+    self.transmitter.audioMonitored = True
+    self.thread = threading.Thread(target=self._run, name='audioMonitor', daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    logging.info('Stopping audio monitor')
+    self.stopEvent.set()
+    if self.thread is not None:
+      self.thread.join(1)
+    self.transmitter.audioMonitored = False
+
+  def _run(self):
+    while not self.stopEvent.wait(self.interval):
+      if not self.transmitter.active:
+        continue
+      try:
+        sample = self.transmitter.audioLevel()
+      except Exception:
+        # The chip can be mid reset or recovery, the next sample will tell
+        logging.debug('Audio level sample failed', exc_info=True)
+        continue
+      if sample is None:
+        continue
+      self._add(*sample)
+
+  def _add(self, level, overload):
+    i = self.samples % RING_SIZE
+    self.levels[i] = max(-128, min(127, level))
+    self.overloads[i] = overload
+    self.samples += 1
+    stats.count('audioSamples')
+    if overload:
+      stats.count('audioOverloads')
+      if self.autoGain:
+        self._checkGain()
+
+  def _recent(self, start):
+    # Ring buffer entries from sample number start (oldest kept if it has been overwritten) to now
+    start = max(start, self.samples - RING_SIZE)
+    return [i % RING_SIZE for i in range(start, self.samples)]
+
+  def _checkGain(self):
+    # Sustained means most of the window, and a full window since the last change so each step gets heard first
+    if self.samples - self.lastGainChange < AUTO_GAIN_WINDOW:
+      return
+    overloads = sum(self.overloads[i] for i in self._recent(self.samples - AUTO_GAIN_WINDOW))
+    if overloads < AUTO_GAIN_OVERLOADS:
+      return
+    self.lastGainChange = self.samples
+    if self.transmitter.reduceGain(AUTO_GAIN_RANGE):
+      stats.count('autoGainReductions')
+
+  def newTrack(self):
+    # Summarizes the samples since the previous call - Returns None when there were none
+    indexes = self._recent(self.trackStart)
+    self.trackStart = self.samples
+    now = monotonic()
+    duration = now - self.trackTime
+    self.trackTime = now
+    if not indexes:
+      return None
+
+    levels = [self.levels[i] for i in indexes]
+    summary = {
+      'samples': len(levels),
+      'peak': max(levels),
+      'mean': round(sum(levels) / len(levels), 1),
+      'overloads': sum(self.overloads[i] for i in indexes),
+      'seconds': round(duration)
+    }
+    logging.info('Audio - Peak %s - Mean %s - Overloads %s of %s samples', summary['peak'], summary['mean'], summary['overloads'], summary['samples'])
+    return summary
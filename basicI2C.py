@@ -1,9 +1,11 @@
 import logging
 import os
 import sys
-from time import sleep
+import threading
+from time import sleep, perf_counter_ns
 
-import smbus2
+from traceBuffer import trace, TRACE_I2C_WRITE, TRACE_I2C_READ, TRACE_I2C_ERROR
+from engineStats import stats
 
 # ===============
 # Basic I2C Class
@@ -11,27 +13,42 @@ import smbus2
 # Used by the Transmitter child classes (if they are i2c), but could also be used on its own if needed
 # Assuming SMBus of 1 on most modern hardware - Can check /dev/i2c-* for available buses
 class basicI2C():
-  def __init__(self, address, bus=1):
+  # When set, called with (bus, address) to create the bus object instead of opening smbus2 - Used for simulated buses
+  busFactory = None
+
+  def __init__(self, address, bus=None):
     self.address = address
-    # Bus 1 is Modern RPis, Bus 2 is BBB, Bus 0 is older RPis
+    # Held around multi-transaction sequences (command then response) when more than one thread uses the chip
+    self.lock = threading.RLock()
+    if basicI2C.busFactory is not None:
+      self.bus = basicI2C.busFactory(bus, address)
+      return
+    # Bus 1 is Modern RPis, Bus 2 is BBB, Bus 0 is older RPis - Detected unless a bus is given
     # uEnv.txt indicates a BBB, so 2 would be ok. On single HDMI port RPi's i2c-2 can show up, but isn't what should be used
-    if os.path.exists('/boot/uEnv.txt') and (os.path.exists('/dev/i2c-2') or os.path.exists('/sys/class/i2c-2')):
-      bus = 2
-    elif os.path.exists('/dev/i2c-0') or os.path.exists('/sys/class/i2c-0'):
-      bus = 0
+    if bus is None:
+      bus = 1
+      if os.path.exists('/boot/uEnv.txt') and (os.path.exists('/dev/i2c-2') or os.path.exists('/sys/class/i2c-2')):
+        bus = 2
+      elif os.path.exists('/dev/i2c-0') or os.path.exists('/sys/class/i2c-0'):
+        bus = 0
     logging.info('Using i2c bus %s', bus)
     try:
+      import smbus2
       self.bus = smbus2.SMBus(bus)
     except Exception:
       logging.exception('SMBus2 Init Error')
 
   def write(self, address, values, isFatal = False):
     # Simple i2c write - Always takes an list, even for 1 byte
-    logging.excessive('I2C write at 0x%02x of %s', address, ' '.join(f'0x{b:02X}' for b in values))
+    trace.record(TRACE_I2C_WRITE, address, values)
     for i in range(8):
       try:
+        startTime = perf_counter_ns()
         self.bus.write_i2c_block_data(self.address, address, values)
+        stats.record('i2cWrite', (perf_counter_ns() - startTime) // 1000)
       except Exception:
+        trace.record(TRACE_I2C_ERROR, address, values)
+        stats.count('i2cErrors')
         logging.exception('write_i2c_block_data error')
         if i >= 1:
           sleep(i * .25)
@@ -40,17 +57,21 @@ class basicI2C():
         break
     else:
       logging.error('failed to write after multiple attempts')
+      stats.count('i2cFailures')
+      trace.dumpOnError()
       if isFatal:
         sys.exit(-1)
 
-  def read(self, address, num_bytes, isFatal = False):
+  def read(self, address, num_bytes, isFatal = False, attempts = 8):
     # Simple i2c read - Always returns a list
-    for i in range(8):
+    for i in range(attempts):
       try:
         retVal = self.bus.read_i2c_block_data(self.address, address, num_bytes)
-        logging.excessive('I2C read at 0x%02x of %s byte(s) returned %s', address, num_bytes, ' '.join(f'0x{b:02X}' for b in retVal))
+        trace.record(TRACE_I2C_READ, address, retVal)
         return retVal
       except Exception:
+        trace.record(TRACE_I2C_ERROR, address)
+        stats.count('i2cErrors')
         logging.exception('read_i2c_block_data error')
         if i >= 1:
           sleep(i * .25)
@@ -59,6 +80,8 @@ class basicI2C():
         break
     else:
       logging.error('failed to read after multiple attempts')
+      stats.count('i2cFailures')
+      trace.dumpOnError()
       if isFatal:
         sys.exit(-1)
       return []
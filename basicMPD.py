@@ -0,0 +1,115 @@
+import logging
+import os
+import socket
+import threading
+
+# ===============
+# Basic MPD Class
+# ===============
+# Persistent connection to MPD (used by the After Hours Music plugin) speaking the MPD protocol directly
+# A background thread waits on 'idle player', so song changes are pushed instead of polled
+# Connecting, reconnecting, and backoff all happen on that thread, never on the RDS path
+
+class basicMPD:
+  def __init__(self, host=None, port=None):
+    self.host = host or os.getenv('MPD_HOST', 'localhost')
+    self.port = port or int(os.getenv('MPD_PORT', '6600'))
+    self.sock = None
+    self.reader = None
+    self.lock = threading.Lock()
+    self.current = {}
+    self.changed = False
+    self.stopping = threading.Event()
+    self.thread = None
+
+  def start(self):
+    logging.info('Starting MPD client for %s:%s', self.host, self.port)
+    self.stopping.clear()
+    self.thread = threading.Thread(target=self._run, name='basicMPD', daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    logging.info('Stopping MPD client')
+    self.stopping.set()
+    self._close()
+
+  def latest(self):
+    # Returns the current song dict if it changed since the last call, otherwise None
+    with self.lock:
+      if not self.changed:
+        return None
+      self.changed = False
+      return self.current
+
+  def refresh(self):
+    # Makes the next latest() call return the current song even if it hasn't changed
+    with self.lock:
+      self.changed = True
+
+  def _run(self):
+    backoff = 1
+    while not self.stopping.is_set():
+      try:
+        self._connect()
+        backoff = 1
+        while not self.stopping.is_set():
+          self._setSong(self._command('currentsong'))
+          self._command('idle player')
+      except (OSError, EOFError, ValueError) as e:
+        self._close()
+        if self.stopping.is_set():
+          break
+        logging.warning('MPD connection lost (%s), retrying in %ss', e, backoff)
+        self.stopping.wait(backoff)
+        backoff = min(backoff * 2, 60)
+    # stop() can run while connecting, before there was a socket to close
+    self._close()
+
+  def _connect(self):
+    sock = socket.create_connection((self.host, self.port), timeout=5)
+    # Idle can legitimately wait for hours, so only the connect has a timeout
+    sock.settimeout(None)
+    self.reader = sock.makefile('r', encoding='UTF-8', errors='replace')
+    self.sock = sock
+    greeting = self.reader.readline()
+    if not greeting.startswith('OK MPD'):
+      raise ValueError(f'Unexpected MPD greeting {greeting.strip()!r}')
+    logging.info('Connected to %s', greeting.strip())
+
+  def _close(self):
+    sock, self.sock = self.sock, None
+    if sock is not None:
+      try:
+        # shutdown wakes up the thread blocked in idle
+        sock.shutdown(socket.SHUT_RDWR)
+      except OSError:
+        pass
+      sock.close()
+
+  def _command(self, command):
+    # Sends a command and returns the response as a dict, raises on ACK or a dropped connection
+    # stop() clears self.sock from the main thread, so this works from its own references
+    sock, reader = self.sock, self.reader
+    if sock is None:
+      raise EOFError('MPD connection closed')
+    sock.sendall(command.encode('UTF-8') + b'\n')
+    response = {}
+    while True:
+      line = reader.readline()
+      if line == '':
+        raise EOFError('MPD closed the connection')
+      line = line.rstrip('\n')
+      if line == 'OK':
+        return response
+      if line.startswith('ACK'):
+        raise ValueError(line)
+      key, _, value = line.partition(': ')
+      response[key] = value
+
+  def _setSong(self, song):
+    song = {'{T}': song.get('Title', ''), '{A}': song.get('Artist', ''), '{B}': song.get('Album', ''), '{N}': song.get('Track', '')}
+    with self.lock:
+      if song != self.current:
+        logging.debug('MPD song %s', song)
+        self.current = song
+        self.changed = True
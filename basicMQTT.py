@@ -2,8 +2,18 @@
 
 import logging
 import json
-from urllib.request import urlopen
-from urllib.parse import quote
+import threading
+import time
+
+from config import config
+
+# Inbound command topics under topicBase
+COMMAND_VALUES = 'TABGNLCP'
+COMMAND_VALUE_MAX = 256
+COMMAND_STYLES = {'set/style/ps': ('STYLEPS', 64), 'set/style/rt': ('STYLERT', 256)}
+COMMAND_INTERRUPT_MAX = 1024
+COMMAND_RATE = 10
+COMMAND_BURST = 20
 
 class basicMQTT:
   def __init__(self):
@@ -15,6 +25,21 @@ class basicMQTT:
   def publish(self, subtopic, value, qos=1, retain=True):
     pass
 
+  def publishStatus(self, status):
+    pass
+
+  def publishConfig(self, configValues):
+    pass
+
+  def publishContent(self, content):
+    pass
+
+  def setCommandHandler(self, handler):
+    pass
+
+  def setContentHandler(self, handler):
+    pass
+
   def disconnect(self):
     self.connected = False
 
@@ -23,26 +48,39 @@ class basicMQTT:
 
 class pahoMQTT(basicMQTT):
   # Command line to monitor: mosquitto_sub -v -d -h localhost -t "#"
-  def __init__(self):
+  def __init__(self, api=None):
     logging.info('Initializing pahoMQTT')
     global paho
     import paho.mqtt.client as paho
 
-    # Pull in FPP setting needed for MQTT via API
+    if api is None:
+      from fppAPI import fppAPI
+      api = fppAPI()
+    self.api = api
+
+    # Pull in FPP settings needed for MQTT with a single bulk API request
     self.MQTTSettings = {}
-    self.MQTTSettings['HostName'] = self.readAPISetting('HostName')['value']
+    fppSettings = self.api.getSettings()
+    if 'MQTTHost' in fppSettings:
+      for setting, value in fppSettings.items():
+        if setting == 'HostName' or setting.startswith('MQTT'):
+          self.MQTTSettings[setting] = str(value)
+    else:
+      # Older FPP or bulk request failed, fall back to one request per setting
+      logging.debug('Bulk settings unavailable, reading MQTT settings individually')
+      self.MQTTSettings['HostName'] = self.readAPISetting('HostName').get('value', '')
+      mqttInfo = self.readAPISetting('MQTTHost')
+      self.MQTTSettings['MQTTHost'] = mqttInfo.get('value', '')
+      for setting in mqttInfo.get('children', {}).get('*', []):
+        self.MQTTSettings[setting] = self.readAPISetting(setting).get('value', '')
 
-    mqttInfo = self.readAPISetting('MQTTHost')
-    self.MQTTSettings['MQTTHost'] = mqttInfo['value']
+    for setting in ('HostName', 'MQTTHost', 'MQTTPort', 'MQTTPrefix', 'MQTTUsername', 'MQTTPassword'):
+      self.MQTTSettings.setdefault(setting, '')
 
     if self.MQTTSettings['MQTTHost'] == '':
       logging.warning('MQTT Broker Host is not set. Check FPP Settings -> MQTT -> Broker Host value')
       raise Exception('Missing MQTT Host') # pylint: disable=broad-exception-raised
 
-    for setting in mqttInfo['children']['*']:
-      settingInfo = self.readAPISetting(setting)
-      self.MQTTSettings[setting] = settingInfo['value'] if 'value' in settingInfo else ''
-
     if self.MQTTSettings['MQTTPort'] == '':
       logging.warning('MQTT Port value is missing, using default of 1883')
       self.MQTTSettings['MQTTPort'] = '1883'
@@ -50,8 +88,27 @@ class pahoMQTT(basicMQTT):
     logging.debug('MQTT Settings %s', self.MQTTSettings)
 
     self.topicBase = f'falcon/player/{self.MQTTSettings["HostName"]}/plugin/Dynamic_RDS'
+    # Rendered RDS content shared by a leader with its followers, not tied to a host
+    self.syncTopic = f'falcon/Dynamic_RDS/sync/{config["DynRDSmqttSyncName"]}'
     if self.MQTTSettings["MQTTPrefix"] != '':
       self.topicBase = f'{self.MQTTSettings["MQTTPrefix"]}/{self.topicBase}'
+      self.syncTopic = f'{self.MQTTSettings["MQTTPrefix"]}/{self.syncTopic}'
+
+    # Status fields are serialized once, compared to what was last sent, and only changes are published
+    # Changes arriving faster than DynRDSmqttPublishInterval are coalesced into a single publish
+    self.statusLock = threading.Lock()
+    self.statusPublished = {}
+    self.statusPending = {}
+    self.statusPayload = ''
+    self.lastStatusTime = 0
+    self.statusTimer = None
+    self.configPublished = None
+
+    # Inbound commands - Token bucket refilled at COMMAND_RATE per second up to COMMAND_BURST
+    self.commandHandler = None
+    self.contentHandler = None
+    self.commandTokens = COMMAND_BURST
+    self.commandTokenTime = time.monotonic()
 
     self.client = paho.Client()
     self.client.enable_logger()
@@ -69,8 +126,54 @@ class pahoMQTT(basicMQTT):
   def publish(self, subtopic, value, qos=1, retain=True):
     self.client.publish(f'{self.topicBase}/{subtopic}', value, qos, retain)
 
+  def publishStatus(self, status):
+    with self.statusLock:
+      for field, value in status.items():
+        payload = json.dumps(value, separators=(',', ':'))
+        if self.statusPublished.get(field) != payload:
+          self.statusPending[field] = payload
+        else:
+          # Changed and changed back within the window, nothing to send
+          self.statusPending.pop(field, None)
+      if not self.statusPending or self.statusTimer is not None:
+        return
+      wait = self.lastStatusTime + float(config['DynRDSmqttPublishInterval']) - time.monotonic()
+      if wait > 0:
+        self.statusTimer = threading.Timer(wait, self._flushStatus)
+        self.statusTimer.daemon = True
+        self.statusTimer.start()
+        return
+    self._flushStatus()
+
+  def _flushStatus(self):
+    with self.statusLock:
+      pending, self.statusPending = self.statusPending, {}
+      self.statusTimer = None
+      self.lastStatusTime = time.monotonic()
+      self.statusPublished.update(pending)
+      if config['DynRDSmqttFullStatus'] == '1':
+        # Combined status is stitched from the already serialized fields rather than dumping everything again
+        self.statusPayload = '{' + ','.join(f'"{field}":{payload}' for field, payload in self.statusPublished.items()) + '}'
+    logging.debug('Publishing status fields %s', list(pending))
+    for field, payload in pending.items():
+      self.publish(f'status/{field}', payload)
+    if pending and config['DynRDSmqttFullStatus'] == '1':
+      self.publish('status', self.statusPayload)
+
+  def publishConfig(self, configValues):
+    payload = json.dumps(configValues, separators=(',', ':'))
+    if payload != self.configPublished:
+      self.configPublished = payload
+      self.publish('config', payload)
+
+  def publishContent(self, content):
+    # Retained, so a follower that connects later gets the current content straight away
+    self.client.publish(self.syncTopic, json.dumps(content, separators=(',', ':')), 1, True)
+
   def disconnect(self):
     logging.info('Disconnecting from broker')
+    if self.statusTimer is not None:
+      self.statusTimer.cancel()
     self.publish('ready', '0')
     self.client.loop_stop()
     self.client.disconnect()
@@ -83,14 +186,71 @@ class pahoMQTT(basicMQTT):
     logging.info('Connected to broker with pahoMQTT')
     # TODO: Deal with rc for failures
     super().connect()
+    # Subscribing here means a reconnect also restores the subscriptions
+    if self.commandHandler is not None:
+      self.client.subscribe([(f'{self.topicBase}/set/#', 1), (f'{self.topicBase}/update', 1),
+                             (f'{self.topicBase}/interrupt', 1), (f'{self.topicBase}/restore', 1)])
+    if self.contentHandler is not None:
+      self.client.subscribe(self.syncTopic, 1)
+
+  def setCommandHandler(self, handler):
+    # handler is called from the paho network thread with a single Engine command line
+    self.commandHandler = handler
+    self.client.on_message = self.on_message
+
+  def setContentHandler(self, handler):
+    # handler is called from the paho network thread with the leader's content as a JSON string
+    self.contentHandler = handler
+    self.client.on_message = self.on_message
+
+  def on_message(self, _client, _userdata, msg):
+    if msg.topic == self.syncTopic:
+      # Not rate limited - Content is versioned, so repeats and old messages are dropped by the Engine
+      if self.contentHandler is not None:
+        try:
+          self.contentHandler(msg.payload.decode('UTF-8'))
+        except UnicodeDecodeError:
+          logging.warning('MQTT sync content dropped, payload is not UTF-8')
+      return
+
+    command = msg.topic[len(self.topicBase) + 1:]
+    now = time.monotonic()
+    self.commandTokens = min(COMMAND_BURST, self.commandTokens + (now - self.commandTokenTime) * COMMAND_RATE)
+    self.commandTokenTime = now
+    if self.commandTokens < 1:
+      logging.warning('MQTT command %s dropped, rate limit exceeded', command)
+      return
+    self.commandTokens -= 1
+
+    try:
+      value = msg.payload.decode('UTF-8').replace('\r', '').replace('\n', '')
+    except UnicodeDecodeError:
+      logging.warning('MQTT command %s dropped, payload is not UTF-8', command)
+      return
+
+    line = None
+    if command == 'update':
+      line = 'RENDER'
+    elif command == 'interrupt':
+      if len(value) <= COMMAND_INTERRUPT_MAX:
+        line = 'INTERRUPT' + value
+    elif command == 'restore':
+      line = 'RESTORE'
+    elif command in COMMAND_STYLES:
+      if len(value) <= COMMAND_STYLES[command][1]:
+        line = COMMAND_STYLES[command][0] + value
+    elif command.startswith('set/{') and command[5:6] in COMMAND_VALUES and command[6:] == '}':
+      if command[5] != 'L' or value.isdigit():
+        line = command[5] + value[:COMMAND_VALUE_MAX]
+
+    if line is None:
+      logging.warning('MQTT command %s with value %s is not valid', command, value)
+      return
+    logging.debug('MQTT command %s', line)
+    self.commandHandler(line)
 
   def on_publish(self):
     pass
 
   def readAPISetting(self, settingName):
-    try:
-      with urlopen(f'http://localhost/api/settings/{quote(settingName)}') as response:
-        return json.loads(response.read())
-    except Exception:
-      logging.exception("readAPISetting %s", settingName)
-    return ''
+    return self.api.getSetting(settingName)
@@ -1,8 +1,10 @@
+import json
 import logging
 import os
 import re
-import subprocess
 import sys
+import threading
+from time import sleep, monotonic
 
 from config import config
 
@@ -12,29 +14,46 @@ PWM_FULL_RE = re.compile(
     re.IGNORECASE
 )
 
-def createPWM() -> 'basicPWM':
+# Pin to PWM channel lookups (which fork pinctrl) are cached here, keyed by boot so a changed overlay is picked up after reboot
+PWM_PIN_CACHE = os.path.dirname(os.path.abspath(__file__)) + '/Dynamic_RDS_pwm.cache'
+
+# Time between duty cycle steps while ramping
+RAMP_STEP = 0.02
+
+def createPWM(settings=config) -> 'basicPWM':
   # Check if PWM is enabled
-  if config['DynRDSQN8066PIPWM'] != '1':
-    return basicPWM()
+  if settings['DynRDSQN8066PIPWM'] != '1':
+    return basicPWM(settings)
 
   platform = os.getenv('FPPPLATFORM', '')
   match platform:
     case 'Raspberry Pi':
-      if ',' in config['DynRDSAdvPIPWMPin']:
-        logging.info('Using hardware PWM config: %s', config['DynRDSAdvPIPWMPin'])
-        return hardwarePWM(int(config['DynRDSAdvPIPWMPin'].split(',', 1)[0]))
-      logging.info('Using software PWM pin: %s', config['DynRDSAdvPIPWMPin'])
-      return softwarePWM(int(config['DynRDSAdvPIPWMPin']))
+      if ',' in settings['DynRDSAdvPIPWMPin']:
+        logging.info('Using hardware PWM config: %s', settings['DynRDSAdvPIPWMPin'])
+        return hardwarePWM(int(settings['DynRDSAdvPIPWMPin'].split(',', 1)[0]), settings)
+      logging.info('Using software PWM pin: %s', settings['DynRDSAdvPIPWMPin'])
+      return softwarePWM(int(settings['DynRDSAdvPIPWMPin']), settings)
     case 'BeagleBone Black':
-      logging.info('Using BBB hardware PWM config: %s', config['DynRDSAdvBBBPWMPin'])
-      return hardwareBBBPWM(config['DynRDSAdvBBBPWMPin'])
+      logging.info('Using BBB hardware PWM config: %s', settings['DynRDSAdvBBBPWMPin'])
+      return hardwareBBBPWM(settings['DynRDSAdvBBBPWMPin'], settings)
     case _:
       logging.warning('Unknown platform: %s, PWM disabled', platform)
-      return basicPWM()
+      return basicPWM(settings)
 
 class basicPWM:
-  def __init__(self):
+  # Duty cycle changes go through rampTo, which moves amp power over DynRDSQN8066AmpRamp seconds on a background thread
+  # Backends only have to implement _setDutyCycle
+  def __init__(self, settings=config):
+    self.settings = settings
     self.active = False
+    self.name = 'PWM'
+    self.dutyCycle = 0
+    self.rampFrom = 0
+    self.rampTarget = 0
+    self.rampStart = 0
+    self.rampTime = 0
+    self.rampLock = threading.Lock()
+    self.rampThread = None
 
   def startup(self, _period=10000, dutyCycle=0): # pylint: disable=unused-argument
     self.active = True
@@ -49,9 +68,124 @@ class basicPWM:
     # TODO: String about PWM status?
     pass
 
-class hardwarePWM(basicPWM):
-  def __init__(self, pwmGPIOPin=18):
-    pwmInfo = self._getPWMInfoFromPinctrl(pwmGPIOPin)
+  def _setDutyCycle(self, dutyCycle):
+    # Expected to be defined by child class
+    pass
+
+  def _applyDutyCycle(self, dutyCycle):
+    if dutyCycle != self.dutyCycle:
+      self._setDutyCycle(dutyCycle)
+      self.dutyCycle = dutyCycle
+
+  def rampTo(self, dutyCycle, wait=False):
+    # wait=True ramps on the calling thread, used on shutdown so the amp is at 0 before the PWM is disabled or closed
+    if dutyCycle == self.dutyCycle == self.rampTarget:
+      return
+    rampTime = float(self.settings['DynRDSQN8066AmpRamp'])
+    logging.info('Updating %s duty cycle from %s to %s over %ss', self.name, self.dutyCycle, dutyCycle, rampTime)
+    with self.rampLock:
+      self.rampFrom = self.dutyCycle
+      self.rampTarget = dutyCycle
+      self.rampStart = monotonic()
+      self.rampTime = rampTime
+      running = self.rampThread
+      if running is None and not wait and rampTime > 0:
+        self.rampThread = threading.Thread(target=self._ramp, daemon=True)
+        self.rampThread.start()
+        return
+    if running is not None and (wait or rampTime <= 0):
+      # A ramp running on its thread is finished first, so nothing is still writing once this returns
+      running.join()
+    if rampTime <= 0:
+      self._applyDutyCycle(dutyCycle)
+    elif wait:
+      self._ramp()
+    # Otherwise the running ramp thread picks up the new target
+
+  def _ramp(self):
+    while True:
+      with self.rampLock:
+        start = self.rampStart
+        progress = min((monotonic() - start) / self.rampTime, 1) if self.rampTime > 0 else 1
+        value = round(self.rampFrom + (self.rampTarget - self.rampFrom) * progress)
+      try:
+        self._applyDutyCycle(value)
+      except OSError:
+        logging.exception('Ramping %s', self.name)
+        progress = 1
+        start = None
+      if progress < 1:
+        sleep(RAMP_STEP)
+        continue
+      with self.rampLock:
+        # The thread only exits under the lock, so a target set while the last step was written starts another pass
+        if start is None or self.rampStart == start:
+          if self.rampThread is threading.current_thread():
+            self.rampThread = None
+          return
+
+class sysfsPWM(basicPWM):
+  # Shared by the hardware PWM backends - sysfs attribute files are opened once and kept open,
+  # and the last value written to each is cached so unchanged values aren't written again
+  def __init__(self, pwmPath, name, settings=config):
+    super().__init__(settings)
+    self.pwmPath = pwmPath
+    self.name = name
+    self.fds = {}
+    self.written = {}
+    # Pick up the current duty cycle, so after an Engine restart ramping starts from where the amp already is
+    try:
+      with open(f'{self.pwmPath}/duty_cycle', 'r', encoding='UTF-8') as p:
+        self.dutyCycle = int(p.read()) // 61
+    except (OSError, ValueError):
+      pass
+
+  def _write(self, attribute, value):
+    value = str(value)
+    if self.written.get(attribute) == value:
+      return
+    fd = self.fds.get(attribute)
+    if fd is None:
+      fd = self.fds[attribute] = os.open(f'{self.pwmPath}/{attribute}', os.O_WRONLY)
+    try:
+      os.pwrite(fd, f'{value}\n'.encode(), 0)
+    except OSError:
+      self.written.pop(attribute, None)
+      raise
+    self.written[attribute] = value
+
+  def close(self):
+    for fd in self.fds.values():
+      os.close(fd)
+    self.fds = {}
+    self.written = {}
+
+  def startup(self, period=18300, dutyCycle=0):
+    logging.debug('Starting %s with period of %s', self.name, period)
+    self._write('period', period)
+    self._write('duty_cycle', self.dutyCycle*61)
+    logging.info('Enabling %s', self.name)
+    self._write('enable', 1)
+    super().startup()
+    self.rampTo(dutyCycle)
+
+  def update(self, dutyCycle=0):
+    self.rampTo(dutyCycle)
+    super().update()
+
+  def shutdown(self):
+    logging.debug('Shutting down %s', self.name)
+    self.rampTo(0, wait=True)
+    logging.info('Disabling %s', self.name)
+    self._write('enable', 0)
+    super().shutdown()
+
+  def _setDutyCycle(self, dutyCycle):
+    self._write('duty_cycle', dutyCycle*61)
+
+class hardwarePWM(sysfsPWM):
+  def __init__(self, pwmGPIOPin=18, settings=config):
+    pwmInfo = self._getPWMInfo(pwmGPIOPin)
     if pwmInfo is None:
       logging.error('Unable to determine PWM channel for GPIO%s', pwmGPIOPin)
       sys.exit(-1)
@@ -67,9 +201,41 @@ class hardwarePWM(basicPWM):
       with open('/sys/class/pwm/pwmchip0/export', 'w', encoding='UTF-8') as p:
         p.write(f'{self.pwmToUse}\n')
 
-    super().__init__()
+    super().__init__(f'/sys/class/pwm/pwmchip0/pwm{self.pwmToUse}', f'hardware PWM channel {self.pwmToUse}', settings)
+
+  def _getPWMInfo(self, gpioPin=18):
+    # pinctrl is only run once per boot per pin, after that the cached channel is used
+    try:
+      with open('/proc/sys/kernel/random/boot_id', 'r', encoding='UTF-8') as f:
+        bootId = f.read().strip()
+    except OSError:
+      bootId = None
+
+    cache = {}
+    try:
+      with open(PWM_PIN_CACHE, 'r', encoding='UTF-8') as f:
+        cache = json.load(f)
+    except (OSError, ValueError):
+      pass
+    if bootId is not None and cache.get('bootId') == bootId and str(gpioPin) in cache.get('pins', {}):
+      logging.debug('Using cached PWM channel for GPIO%s', gpioPin)
+      return cache['pins'][str(gpioPin)]
+
+    pwmInfo = self._getPWMInfoFromPinctrl(gpioPin)
+    if pwmInfo is not None and bootId is not None:
+      if cache.get('bootId') != bootId:
+        cache = {'bootId': bootId, 'pins': {}}
+      cache['pins'][str(gpioPin)] = pwmInfo
+      try:
+        with open(PWM_PIN_CACHE, 'w', encoding='UTF-8') as f:
+          json.dump(cache, f)
+      except OSError:
+        logging.exception('Unable to save PWM pin cache')
+    return pwmInfo
 
   def _getPWMInfoFromPinctrl(self, gpioPin=18):
+    # Only run once per boot (the result is cached), so subprocess isn't loaded otherwise
+    import subprocess
     try:
       result = subprocess.run(
                  ["pinctrl", "get", str(gpioPin)],
@@ -87,32 +253,8 @@ class hardwarePWM(basicPWM):
     return m.group(2) or m.group(3)
     # "pwm": m.group(1).lower()
 
-  def startup(self, period=18300, dutyCycle=0):
-    logging.debug('Starting hardware PWM channel %s with period of %s', self.pwmToUse, period)
-    with open(f'/sys/class/pwm/pwmchip0/pwm{self.pwmToUse}/period', 'w', encoding='UTF-8') as p:
-      p.write(f'{period}\n')
-    self.update(dutyCycle)
-    logging.info('Enabling hardware PWM channel %s', self.pwmToUse)
-    with open(f'/sys/class/pwm/pwmchip0/pwm{self.pwmToUse}/enable', 'w', encoding='UTF-8') as p:
-      p.write('1\n')
-    super().startup()
-
-  def update(self, dutyCycle=0):
-    logging.info('Updating hardware PWM channel %s duty cycle to %s', self.pwmToUse, dutyCycle*61)
-    with open(f'/sys/class/pwm/pwmchip0/pwm{self.pwmToUse}/duty_cycle', 'w', encoding='UTF-8') as p:
-      p.write(f'{dutyCycle*61}\n')
-    super().update()
-
-  def shutdown(self):
-    logging.debug('Shutting down hardware PWM%s', self.pwmToUse)
-    self.update() #Duty Cycle to 0
-    logging.info('Disabling hardware PWM channel %s', self.pwmToUse)
-    with open(f'/sys/class/pwm/pwmchip0/pwm{self.pwmToUse}/enable', 'w', encoding='UTF-8') as p:
-      p.write('0\n')
-    super().shutdown()
-
 class softwarePWM(basicPWM):
-  def __init__(self, pinToUse=7):
+  def __init__(self, pinToUse=7, settings=config):
     logging.info('Initializing software PWM on GPIO pin %s (board pin %s)', self._board_to_bcm(pinToUse), pinToUse)
     global PWMLED
     from gpiozero import PWMLED
@@ -124,7 +266,8 @@ class softwarePWM(basicPWM):
 
     # Create PWMLED device (starts at 0% duty cycle, off)
     self.pwm = PWMLED(bcm_pin, initial_value=0)
-    super().__init__()
+    super().__init__(settings)
+    self.name = f'software PWM on GPIO {bcm_pin}'
 
   def _board_to_bcm(self, board_pin):
     """Convert board pin number to BCM GPIO number."""
@@ -148,27 +291,27 @@ class softwarePWM(basicPWM):
     frequency = 1_000_000 / period
     logging.debug('Starting software PWM on GPIO %s (board pin %s) with frequency %.2f Hz',self.bcm_pin, self.pinToUse, frequency)
     self.pwm.frequency = frequency
-    initial_value = (dutyCycle / 3) / 100
-    logging.info('Setting software PWM on GPIO %s initial duty cycle to %.2f%%', self.bcm_pin, dutyCycle / 3)
-    self.pwm.value = initial_value
     super().startup()
+    self.rampTo(dutyCycle)
 
   def update(self, dutyCycle=0):
-    value = (dutyCycle / 3) / 100
-    logging.info('Updating software PWM on GPIO %s duty cycle to %.2f%%', self.bcm_pin, dutyCycle / 3)
-    self.pwm.value = value
+    self.rampTo(dutyCycle)
     super().update()
 
   def shutdown(self):
     logging.debug('Shutting down software PWM on GPIO %s (board pin %s)', self.bcm_pin, self.pinToUse)
+    self.rampTo(0, wait=True)
     self.pwm.off()
     logging.info('Cleaning up software PWM on GPIO %s', self.bcm_pin)
     # gpiozero handles cleanup automatically, but explicitly close
     self.pwm.close()
     super().shutdown()
 
-class hardwareBBBPWM(basicPWM):
-  def __init__(self, pwmInfo='P9_16,1,B'):
+  def _setDutyCycle(self, dutyCycle):
+    self.pwm.value = (dutyCycle / 3) / 100
+
+class hardwareBBBPWM(sysfsPWM):
+  def __init__(self, pwmInfo='P9_16,1,B', settings=config):
     (self.pinToUse, self.pwmToUse, self.ABToUse) = pwmInfo.split(',', 2)
     logging.info('Initializing hardware PWM on pin %s', self.pinToUse)
     if self.pwmToUse == '0':
@@ -198,28 +341,4 @@ class hardwareBBBPWM(basicPWM):
       with open(f'/sys/class/pwm/{self.pwmToUse}/export', 'w', encoding='UTF-8') as p:
         p.write(f'{self.ABToUse}\n')
 
-    super().__init__()
-
-  def startup(self, period=18300, dutyCycle=0):
-    logging.debug('Starting hardware %s/pwm%s with period of %s', self.pwmToUse, self.ABToUse, period)
-    with open(f'/sys/class/pwm/{self.pwmToUse}/pwm{self.ABToUse}/period', 'w', encoding='UTF-8') as p:
-      p.write(f'{period}\n')
-    self.update(dutyCycle)
-    logging.info('Enabling hardware %s/pwm%s', self.pwmToUse, self.ABToUse)
-    with open(f'/sys/class/pwm/{self.pwmToUse}/pwm{self.ABToUse}/enable', 'w', encoding='UTF-8') as p:
-      p.write('1\n')
-    super().startup()
-
-  def update(self, dutyCycle=0):
-    logging.info('Updating hardware %s/pwm%s duty cycle to %s', self.pwmToUse, self.ABToUse, dutyCycle*61)
-    with open(f'/sys/class/pwm/{self.pwmToUse}/pwm{self.ABToUse}/duty_cycle', 'w', encoding='UTF-8') as p:
-      p.write(f'{dutyCycle*61}\n')
-    super().update()
-
-  def shutdown(self):
-    logging.debug('Shutting down hardware %s/pwm%s', self.pwmToUse, self.ABToUse)
-    self.update() #Duty Cycle to 0
-    logging.info('Disabling hardware %s/pwm%s', self.pwmToUse, self.ABToUse)
-    with open(f'/sys/class/pwm/{self.pwmToUse}/pwm{self.ABToUse}/enable', 'w', encoding='UTF-8') as p:
-      p.write('0\n')
-    super().shutdown()
+    super().__init__(f'/sys/class/pwm/{self.pwmToUse}/pwm{self.ABToUse}', f'hardware {self.pwmToUse}/pwm{self.ABToUse}', settings)
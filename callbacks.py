@@ -8,9 +8,14 @@ import subprocess
 import socket
 import sys
 import time
+import uuid
 
 from sys import argv
 from config import config,read_config_from_file
+from logSetup import setupLogging
+
+# Taken first so track change latency includes this script's own startup
+callbackStartNs = time.time_ns()
 
 def logUnhandledException(eType, eValue, eTraceback):
   logging.error('Unhandled exception', exc_info=(eType, eValue, eTraceback))
@@ -30,6 +35,10 @@ if len(argv) <= 1:
   print('   --update                            | Used by Dynamic_RDS.php to apply dynamic settings to the transmitter')
   print('   --reset                             | Used by Dynamic_RDS.php to reset the GPIO pin')
   print('   --exit                              | Used by FPPD or manually to shutdown Dynamic_RDS_Engine.py')
+  print('   --trace                             | Write recent I2C and RDS activity to Dynamic_RDS_trace.log')
+  print('   --stats                             | Print Engine latency histograms and counters')
+  print('   --interrupt \'{..json..}\'            | Send an urgent message, like {"rt": "Lot Full", "ta": true, "seconds": 300}')
+  print('   --restore                           | End an interrupt message and go back to the RDS Style Text')
   print('   --type media --data \'{..json..}\'    | Used by FPPD when a new items starts in a playlist')
   print('   --type playlist --data \'{..json..}\' | Used by FPPD when a playlist starts or stops')
   print('   --type lifecycle startup/shutdown   | Used by FPPD when it starts or stops')
@@ -38,7 +47,8 @@ if len(argv) <= 1:
 
 script_dir = os.path.dirname(os.path.abspath(argv[0]))
 
-logging.basicConfig(filename=script_dir + '/Dynamic_RDS_callbacks.log', level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s', datefmt='%H:%M:%S')
+# Short lived, so no need for the queued logging the Engine uses
+setupLogging(script_dir + '/Dynamic_RDS_callbacks.log', queued=False)
 
 read_config_from_file()
 
@@ -105,6 +115,12 @@ with open(fifo_path, 'w', encoding='UTF-8') as fifo:
     logging.info(' Engine restart detected, sending INIT')
     fifo.write('INIT\n')
 
+  if argv[1] == '--type' and argv[2] in ('media', 'playlist'):
+    # Correlation ID and start time so the Engine can measure how long until the change is on air
+    span_id = uuid.uuid4().hex[:8]
+    logging.debug('Span %s', span_id)
+    fifo.write(f'SPAN{span_id} {callbackStartNs}\n')
+
   if argv[1] == '--list':
     # Typically called first by FPPD and will block if read side isn't open
     fifo.write('INIT\n')
@@ -118,6 +134,34 @@ with open(fifo_path, 'w', encoding='UTF-8') as fifo:
     # Not used by FPPD, but used by Dynamic_RDS.php
     fifo.write('RESET\n')
 
+  elif argv[1] == '--stats':
+    # Manual troubleshooting - Engine exports its stats to a file, which is printed once it has been updated
+    stats_path = script_dir + '/Dynamic_RDS_stats.json'
+    lastExport = os.stat(stats_path).st_mtime_ns if os.path.exists(stats_path) else 0
+    fifo.write('STATS\n')
+    fifo.flush()
+
+    startTime = time.monotonic()
+    while time.monotonic() - startTime < 2:
+      if os.path.exists(stats_path) and os.stat(stats_path).st_mtime_ns != lastExport:
+        with open(stats_path, 'r', encoding='UTF-8') as statsFile:
+          print(json.dumps(json.load(statsFile), indent=2))
+        break
+      time.sleep(0.05)
+    else:
+      print('Engine did not export stats')
+
+  elif argv[1] == '--interrupt' and len(argv) >= 3:
+    # Scripting - The Engine checks the message
+    fifo.write('INTERRUPT' + argv[2].replace('\n', ' ') + '\n')
+
+  elif argv[1] == '--restore':
+    fifo.write('RESTORE\n')
+
+  elif argv[1] == '--trace':
+    # Manual troubleshooting - Engine decodes its trace buffer to a file
+    fifo.write('DUMPTRACE\n')
+
   elif argv[1] == '--exit' or (argv[1] == '--type' and argv[2] == 'lifecycle' and argv[3] == 'shutdown'):
     # Used by FPPD lifecycle shutdown. Also useful for testing or scripting
     fifo.write('EXIT\n')
@@ -0,0 +1,47 @@
+import logging
+import time
+
+# ======================
+# Command Recorder Class
+# ======================
+# Appends every command the Engine receives to a plain text recording for Dynamic_RDS_Replay.py
+# Each Engine start begins a session with a '#' line, then one '<ms> <command>' line per command,
+# where ms is monotonic time since the session started - Wall clock steps during a show don't affect it
+# Lines are small and only arrive a few times per track, so the file is line buffered
+
+class commandRecorder:
+  def __init__(self, path):
+    self.path = path
+    self.startTime = time.monotonic()
+    self.file = open(path, 'a', encoding='UTF-8', buffering=1) # pylint: disable=consider-using-with
+    self.file.write(f"# {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+    logging.info('Recording commands to %s', path)
+
+  def record(self, line, receivedTime=None):
+    receivedTime = time.monotonic() if receivedTime is None else receivedTime
+    try:
+      self.file.write(f'{round((receivedTime - self.startTime) * 1000)} {line}\n')
+    except OSError:
+      logging.exception('Command recording to %s', self.path)
+
+  def close(self):
+    logging.info('Stopped recording commands')
+    self.file.close()
+
+def readRecording(path):
+  # Yields (seconds, command) with sessions placed back to back, one second apart, so a whole season plays as one stream
+  offset = 0
+  last = 0
+  with open(path, 'r', encoding='UTF-8') as f:
+    for recLine in f:
+      recLine = recLine.rstrip('\n')
+      if recLine.startswith('#'):
+        offset = last + 1 if last else 0
+        continue
+      try:
+        ms, line = recLine.split(' ', 1)
+        last = offset + int(ms) / 1000
+      except ValueError:
+        logging.warning('Skipping invalid recording line %s', recLine)
+        continue
+      yield last, line
@@ -1,3 +1,4 @@
+import configparser
 import os
 import logging
 
@@ -8,6 +9,9 @@ config = {
 'DynRDSRTUpdateRate': '8',
 'DynRDSRTSize': '32',
 'DynRDSRTStyle': '{T}[ by {A}][|Track {P} of {C}  ]Merry Christmas!',
+'DynRDSShowEndTime': '',
+'DynRDSInterruptDuration': '60',
+'DynRDSRTPlus': '0',
 'DynRDSPty': '2',
 'DynRDSPICode': '819b',
 'DynRDSTransmitter': 'None',
@@ -20,6 +24,10 @@ config = {
 'DynRDSQN8066ChipPower': '122',
 'DynRDSQN8066PIPWM': '0',
 'DynRDSQN8066AmpPower': '0',
+'DynRDSQN8066AmpRamp': '1',
+'DynRDSQN8066AutoGain': '0',
+'DynRDSAudioMonitor': '0',
+'DynRDSAudioSampleInterval': '0.5',
 
 'DynRDSStart': 'FPPDStart',
 'DynRDSStop': 'Never',
@@ -29,7 +37,15 @@ config = {
 'DynRDSAdvPISoftwareI2C': '0',
 'DynRDSAdvPIPWMPin': '18,2',
 'DynRDSAdvBBBPWMPin': 'P9_16,1,B',
+'DynRDSAdvRecordCommands': '0',
+'DynRDSAdvRealtime': '0',
+'DynRDSAdvRealtimePriority': '10',
+'DynRDSAdvRealtimeCPU': '-1',
 'DynRDSmqttEnable': '0',
+'DynRDSmqttPublishInterval': '1',
+'DynRDSmqttFullStatus': '1',
+'DynRDSmqttRole': 'Standalone',
+'DynRDSmqttSyncName': 'show',
 
 'DynRDSSi4713GPIOReset': '4',
 'DynRDSSi4713TuningCap': '0',
@@ -48,3 +64,16 @@ def read_config_from_file():
     logging.warning('No config file found, using defaults.')
   except Exception:
     logging.exception('read_config')
+
+def read_transmitters_from_file():
+  # Additional transmitters, one [name] section each with the settings that differ from the main config
+  # Settings use the same names as plugin.Dynamic_RDS, plus DynRDSI2CBus and DynRDSI2CAddress
+  transmitterfile = os.getenv('CFGDIR', '/home/fpp/media/config') + '/Dynamic_RDS_transmitters.ini'
+  parser = configparser.ConfigParser(interpolation=None)
+  parser.optionxform = str
+  try:
+    parser.read(transmitterfile, encoding='UTF-8')
+  except configparser.Error:
+    logging.exception('read_transmitters_from_file')
+    return []
+  return [(name, dict(parser[name])) for name in parser.sections()]
@@ -0,0 +1,134 @@
+import logging
+import json
+import os
+import threading
+import time
+
+# ==================
+# Engine Stats Class
+# ==================
+# Lightweight latency histograms and counters for each stage of the Engine
+# Histograms are HDR style: exact below 16us, then 16 linear sub-buckets per power of two (~6% precision)
+# Recording is an index calculation and a list increment, so it is safe to leave on in the RDS path
+# Transmitter unit and audio monitor threads record too, so updates and the snapshot copy are done under a lock
+
+SUB_BUCKETS = 16
+OCTAVES = 34 # Up to ~2^37us, about 38 hours
+
+def residentMemory():
+  # Resident set size in KB from /proc, 0 where there isn't one
+  try:
+    with open('/proc/self/statm', 'r', encoding='UTF-8') as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+  except (OSError, ValueError, IndexError):
+    return 0
+
+class histogram:
+  def __init__(self):
+    self.counts = [0] * (SUB_BUCKETS * OCTAVES)
+    self.total = 0
+    self.sum = 0
+    self.min = None
+    self.max = 0
+
+  def record(self, us):
+    us = max(int(us), 0)
+    e = us.bit_length() - 4
+    idx = us if e <= 0 else min(SUB_BUCKETS * e + (us >> (e - 1)) - SUB_BUCKETS, len(self.counts) - 1)
+    self.counts[idx] += 1
+    self.total += 1
+    self.sum += us
+    self.max = max(self.max, us)
+    self.min = us if self.min is None else min(self.min, us)
+
+  @staticmethod
+  def bucketValue(idx):
+    # Lowest value that lands in bucket idx
+    e, sub = divmod(idx, SUB_BUCKETS)
+    return sub if e == 0 else (sub + SUB_BUCKETS) << (e - 1)
+
+  def percentile(self, pct):
+    if self.total == 0:
+      return 0
+    target = self.total * pct / 100
+    running = 0
+    for idx, count in enumerate(self.counts):
+      running += count
+      if count and running >= target:
+        return min(self.bucketValue(idx), self.max)
+    return self.max
+
+  def summary(self):
+    return {
+      'count': self.total,
+      'min': self.min or 0,
+      'mean': round(self.sum / self.total) if self.total else 0,
+      'p50': self.percentile(50),
+      'p90': self.percentile(90),
+      'p99': self.percentile(99),
+      'max': self.max
+    }
+
+class engineStats:
+  def __init__(self):
+    self.histograms = {}
+    self.counters = {}
+    self.lock = threading.Lock()
+    self.exportLock = threading.Lock()
+    self.startTime = time.monotonic()
+    self.rateTime = self.startTime
+    self.rateGroups = 0
+    # Import time, modules, and memory when the Engine started, set once by the Engine
+    self.startup = {}
+
+  def record(self, name, us):
+    with self.lock:
+      hist = self.histograms.get(name)
+      if hist is None:
+        hist = self.histograms[name] = histogram()
+      hist.record(us)
+
+  def count(self, name, n=1):
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + n
+
+  def snapshot(self):
+    # All values in microseconds, except groupsPerSecond which covers the time since the previous snapshot
+    # Summaries are worked out after the lock is released, so the RDS path never waits on the percentiles
+    with self.lock:
+      counters = dict(self.counters)
+      histograms = list(self.histograms.items())
+    now = time.monotonic()
+    groups = counters.get('rdsGroups', 0)
+    groupsPerSecond = (groups - self.rateGroups) / (now - self.rateTime) if now > self.rateTime else 0
+    self.rateTime = now
+    self.rateGroups = groups
+    return {
+      'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+      'uptime': round(now - self.startTime),
+      'groupsPerSecond': round(groupsPerSecond, 2),
+      'rssKB': residentMemory(),
+      'startup': self.startup,
+      'counters': counters,
+      'histograms': {name: hist.summary() for name, hist in histograms}
+    }
+
+  def export(self, path):
+    # Serialized here and written by a background thread, so the RDS loop never waits on the SD card
+    # Returns the serialized snapshot, which is also what gets published
+    payload = json.dumps(self.snapshot(), separators=(',', ':'))
+    threading.Thread(target=self._write, args=(path, payload), name='statsExport', daemon=True).start()
+    return payload
+
+  def _write(self, path, payload):
+    # Written to a temp file and renamed so readers never see a partial file
+    with self.exportLock:
+      try:
+        with open(path + '.tmp', 'w', encoding='UTF-8') as f:
+          f.write(payload)
+        os.replace(path + '.tmp', path)
+      except OSError:
+        logging.exception('Stats export to %s', path)
+
+# Shared by everything in the Engine process
+stats = engineStats()
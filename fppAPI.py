@@ -0,0 +1,98 @@
+import logging
+import json
+import threading
+import time
+import http.client
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+# ==================
+# FPP API Client
+# ==================
+# Shared client for the local FPP web API
+# Each thread keeps its own persistent (keep-alive) connection since http.client connections are not thread safe
+# Every request has a timeout, so a busy FPP web server can't hang the caller
+# submit() runs calls on a small worker pool and returns a Future, keeping API latency off the RDS path
+
+class fppAPI:
+  def __init__(self, host='localhost', port=80, timeout=2.0, settingsTTL=30, workers=2):
+    self.host = host
+    self.port = port
+    self.timeout = timeout
+    self.settingsTTL = settingsTTL
+    self.local = threading.local()
+    self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fppAPI')
+    self.settingsLock = threading.Lock()
+    self.settings = None
+    self.settingsTime = 0
+
+  def _connection(self):
+    conn = getattr(self.local, 'conn', None)
+    if conn is None:
+      conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+      self.local.conn = conn
+    return conn
+
+  def _close(self):
+    conn = getattr(self.local, 'conn', None)
+    if conn is not None:
+      conn.close()
+      self.local.conn = None
+
+  def get(self, path, timeout=None):
+    # Returns the decoded JSON response or None on any failure
+    # A stale keep-alive connection gets one retry on a fresh connection
+    for attempt in range(2):
+      conn = self._connection()
+      conn.timeout = timeout or self.timeout
+      if conn.sock is not None:
+        conn.sock.settimeout(conn.timeout)
+      try:
+        conn.request('GET', path, headers={'Connection': 'keep-alive'})
+        response = conn.getresponse()
+        data = response.read()
+        if response.status != 200:
+          logging.warning('FPP API %s returned %s', path, response.status)
+          return None
+        return json.loads(data)
+      except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError, http.client.CannotSendRequest):
+        self._close()
+        if attempt == 0:
+          logging.debug('FPP API connection dropped, reconnecting')
+          continue
+        logging.exception('FPP API %s', path)
+      except Exception:
+        self._close()
+        logging.exception('FPP API %s', path)
+        break
+    return None
+
+  def getSetting(self, settingName):
+    return self.get(f'/api/settings/{quote(settingName)}') or {}
+
+  def getSettings(self, force=False):
+    # All FPP settings in one request, cached for settingsTTL seconds
+    # Returns a dict of setting name to value, empty if the request failed
+    with self.settingsLock:
+      if not force and self.settings is not None and time.monotonic() - self.settingsTime < self.settingsTTL:
+        return self.settings
+      data = self.get('/api/settings')
+      settings = {}
+      if isinstance(data, dict):
+        for key, value in data.items():
+          settings[key] = value.get('value', '') if isinstance(value, dict) else value
+      if settings:
+        self.settings = settings
+        self.settingsTime = time.monotonic()
+      return settings
+
+  def submit(self, fn, *args, **kwargs):
+    return self.pool.submit(fn, *args, **kwargs)
+
+  def getAsync(self, path, timeout=None):
+    return self.submit(self.get, path, timeout)
+
+  def shutdown(self):
+    self.pool.shutdown(wait=False, cancel_futures=True)
+    self._close()
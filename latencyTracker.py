@@ -0,0 +1,64 @@
+import logging
+import time
+
+from engineStats import stats
+
+# ======================
+# Latency Tracker Class
+# ======================
+# Follows a track change from the callbacks.py invocation to the first complete PS frame and RT message on air
+# callbacks.py sends a correlation ID with its wall clock start time (SPAN line), then the Engine marks each stage:
+#   received - SPAN line read from the FIFO
+#   render   - New RDS data rendered, just before it is swapped into the transmitter buffers
+#   firstPS  - First full PS frame of the new data transmitted
+#   firstRT  - First full RT message of the new data transmitted
+# Latencies are measured from the callback start and recorded in stats as trackChange* histograms
+# Only one span is open at a time, a newer track change replaces an unfinished one
+
+SPAN_TIMEOUT = 60
+
+class latencyTracker:
+  def __init__(self):
+    self.spanId = None
+    self.startNs = 0
+    self.marks = {}
+
+  def begin(self, spanId, callbackNs):
+    if self.spanId is not None:
+      logging.debug('Track change %s superseded by %s', self.spanId, spanId)
+      stats.count('trackChangeSuperseded')
+    # Callback start is wall clock from another process, so convert it to this process's perf counter once
+    now = time.perf_counter_ns()
+    self.spanId = spanId
+    self.startNs = now - max(time.time_ns() - callbackNs, 0)
+    self.marks = {'received': now}
+
+  def mark(self, stage):
+    if self.spanId is None or stage in self.marks:
+      return
+    now = time.perf_counter_ns()
+    if (now - self.startNs) / 1e9 > SPAN_TIMEOUT:
+      logging.warning('Track change %s timed out before %s', self.spanId, stage)
+      stats.count('trackChangeTimeouts')
+      self.spanId = None
+      return
+    self.marks[stage] = now
+
+  def rendered(self):
+    self.mark('render')
+
+  def frameSent(self, kind):
+    # Called by the transmitter after the first full frame of new data, only counts once the span has rendered
+    if self.spanId is None or 'render' not in self.marks:
+      return
+    self.mark('first' + kind)
+    if 'firstPS' in self.marks and 'firstRT' in self.marks:
+      self._close()
+
+  def _close(self):
+    latency = {stage: (ns - self.startNs) // 1000 for stage, ns in self.marks.items()}
+    for stage, us in latency.items():
+      stats.record('trackChange' + stage[0].upper() + stage[1:], us)
+    logging.info('Track change %s - received %.0fms - render %.0fms - first PS %.0fms - first RT %.0fms', self.spanId,
+                 latency['received'] / 1000, latency['render'] / 1000, latency['firstPS'] / 1000, latency['firstRT'] / 1000)
+    self.spanId = None
@@ -0,0 +1,79 @@
+import logging
+import logging.handlers
+import queue
+import time
+
+# =============
+# Logging Setup
+# =============
+# Shared by the Engine and callbacks.py
+# Log files rotate by size so they stay small enough for the PHP log viewer and the support zip
+# With queued=True, callers only put records on a queue and a QueueListener thread does the file writes,
+# so an SD card stall can never hold up the RDS loop
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+LOG_DATEFMT = '%H:%M:%S'
+
+# Adding in excessive log level below debug for very noisy items
+# Allow for debug to be reasonable
+# Debug is as deep as most people would want
+EXCESSIVE = 5
+
+def excessive(msg, *args, **kwargs):
+  if logging.getLogger().isEnabledFor(EXCESSIVE):
+    logging.log(EXCESSIVE, msg, *args, **kwargs)
+
+logging.addLevelName(EXCESSIVE, 'EXCESSIVE')
+logging.EXCESSIVE = EXCESSIVE
+logging.excessive = excessive
+logging.Logger.excessive = excessive
+
+class duplicateFilter(logging.Filter):
+  # Lets the first of a repeated message through, drops repeats for window seconds,
+  # then tags the next one with how many were dropped - e.g. a burst of write_i2c_block_data errors
+  # Only warnings and above, routine info like PS/RT updates repeats legitimately on short tracks
+  def __init__(self, window=10):
+    super().__init__()
+    self.window = window
+    self.seen = {}
+
+  def filter(self, record):
+    if record.levelno < logging.WARNING:
+      return True
+    key = (record.levelno, record.getMessage())
+    now = time.monotonic()
+    entry = self.seen.get(key)
+    if entry is not None and now - entry[0] < self.window:
+      entry[1] += 1
+      return False
+
+    if entry is not None and entry[1] > 0:
+      record.msg = f'{key[1]} [{entry[1]} repeat(s) suppressed]'
+      record.args = None
+    self.seen[key] = [now, 0]
+
+    if len(self.seen) > 256:
+      self.seen = {k: v for k, v in self.seen.items() if now - v[0] < self.window}
+    return True
+
+def setupLogging(logPath, queued=True, maxBytes=1000000, backupCount=1):
+  # Returns the QueueListener when queued, which the caller must stop() on exit to flush remaining records
+  fileHandler = logging.handlers.RotatingFileHandler(logPath, maxBytes=maxBytes, backupCount=backupCount, encoding='UTF-8')
+  fileHandler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT))
+
+  listener = None
+  if queued:
+    logQueue = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(logQueue)
+    listener = logging.handlers.QueueListener(logQueue, fileHandler)
+    listener.start()
+  else:
+    handler = fileHandler
+  handler.addFilter(duplicateFilter())
+
+  root = logging.getLogger()
+  for oldHandler in root.handlers[:]:
+    root.removeHandler(oldHandler)
+  root.addHandler(handler)
+  root.setLevel(logging.INFO)
+  return listener
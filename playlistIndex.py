@@ -0,0 +1,59 @@
+import logging
+import json
+import os
+
+# ====================
+# Playlist Index Class
+# ====================
+# Reads playlist JSON files straight from the FPP playlists directory instead of asking the FPP API
+# Each playlist is keyed by name and validated by the file's mtime and size, so an unchanged file is never parsed twice
+# The index is only kept in memory - Every lookup stats the file anyway, so saving it would only spare one parse per
+# playlist after a restart, at the cost of an SD card write on the RDS thread for every miss
+
+# Only these keys are kept per entry - Enough for counts, durations, and names without holding the whole file
+ENTRY_KEYS = ('type', 'enabled', 'sequenceName', 'mediaName', 'name', 'duration', 'note')
+
+class playlistIndex:
+  def __init__(self, playlistDir=None):
+    self.playlistDir = playlistDir or os.getenv('MEDIADIR', '/home/fpp/media') + '/playlists'
+    self.playlists = {}
+
+  def lookup(self, name):
+    # Returns {'count': int, 'entries': [...]} for the playlist or None if it can't be found or read
+    path = f'{self.playlistDir}/{name}.json'
+    try:
+      st = os.stat(path)
+    except OSError:
+      logging.warning('Playlist file %s not found', path)
+      self.playlists.pop(name, None)
+      return None
+
+    cached = self.playlists.get(name)
+    if cached is not None and cached['mtime'] == st.st_mtime_ns and cached['size'] == st.st_size:
+      logging.debug('Playlist index hit for %s', name)
+      return cached
+
+    logging.debug('Playlist index miss for %s, reading %s', name, path)
+    try:
+      with open(path, 'r', encoding='UTF-8') as f:
+        mainPlaylist = json.load(f).get('mainPlaylist', [])
+    except Exception:
+      logging.exception('Reading playlist %s', path)
+      return None
+
+    cached = {
+      'mtime': st.st_mtime_ns,
+      'size': st.st_size,
+      'count': len(mainPlaylist),
+      'entries': [{k: e[k] for k in ENTRY_KEYS if k in e} for e in mainPlaylist]
+    }
+    self.playlists[name] = cached
+    return cached
+
+  def count(self, name):
+    entry = self.lookup(name)
+    return None if entry is None else entry['count']
+
+  def entries(self, name):
+    entry = self.lookup(name)
+    return [] if entry is None else entry['entries']
@@ -0,0 +1,123 @@
+import ctypes
+import logging
+import os
+import threading
+import time
+
+from engineStats import stats
+
+# ========================
+# Real-time Schedule Class
+# ========================
+# Optional real-time mode for the RDS pump, so fppd's channel output can't preempt it mid group
+# enable() raises the calling thread to SCHED_FIFO and pins it to a core - Threads it starts later are reset to normal
+# priority by SCHED_RESET_ON_FORK, but Linux has them inherit the core, so unpinThreads() moves them back to any core
+# sleepUntil() sleeps to an absolute CLOCK_MONOTONIC deadline with clock_nanosleep and counts how late each wakeup was
+# Without privileges (or ctypes/libc) everything falls back to normal scheduling and time.sleep
+
+CLOCK_MONOTONIC = 1
+TIMER_ABSTIME = 1
+EINTR = 4
+
+# Waking later than this counts as a deadline miss
+DEADLINE_TOLERANCE = 0.002
+# Seconds between checks for new threads to unpin
+UNPIN_INTERVAL = 1
+
+class timespec(ctypes.Structure):
+  _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+class rtSchedule:
+  def __init__(self):
+    self.realtime = False
+    self.pinned = False
+    self.defaultAffinity = None
+    self.unpinnedThreads = set()
+    self.nextUnpinTime = 0
+    self.clockNanosleep = None
+    try:
+      self.clockNanosleep = self._libc().clock_nanosleep
+      self.clockNanosleep.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(timespec), ctypes.POINTER(timespec)]
+      self.clockNanosleep.restype = ctypes.c_int
+    except (OSError, AttributeError):
+      logging.warning('clock_nanosleep not available, using time.sleep for RDS timing')
+
+  @staticmethod
+  def _libc():
+    # glibc by name first - find_library runs ldconfig in a subprocess, so it is only used when that isn't there
+    try:
+      return ctypes.CDLL('libc.so.6', use_errno=True)
+    except OSError:
+      from ctypes.util import find_library
+      return ctypes.CDLL(find_library('c'), use_errno=True)
+
+  def enable(self, priority, cpu=-1):
+    # Applies to the calling thread only, which should be the one sending RDS groups
+    try:
+      if self.defaultAffinity is None:
+        self.defaultAffinity = os.sched_getaffinity(0)
+      os.sched_setscheduler(0, os.SCHED_FIFO | os.SCHED_RESET_ON_FORK, os.sched_param(priority))
+      if cpu >= 0:
+        os.sched_setaffinity(0, {cpu})
+        self.pinned = True
+        self.unpinThreads()
+      else:
+        # CPU changed back to any while real-time was already on
+        os.sched_setaffinity(0, self.defaultAffinity)
+        self.pinned = False
+    except (PermissionError, OSError, AttributeError) as e:
+      logging.warning('Unable to enable real-time scheduling (priority %s, CPU %s): %s', priority, cpu, e)
+      self.disable()
+      return False
+    self.realtime = True
+    logging.info('Real-time scheduling enabled - SCHED_FIFO priority %s, CPU %s', priority, cpu if cpu >= 0 else 'any')
+    return True
+
+  def disable(self):
+    try:
+      os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+      if self.defaultAffinity is not None:
+        os.sched_setaffinity(0, self.defaultAffinity)
+    except (PermissionError, OSError, AttributeError):
+      logging.exception('Unable to restore normal scheduling')
+    if self.realtime:
+      logging.info('Real-time scheduling disabled')
+    self.realtime = False
+    self.pinned = False
+
+  def unpinThreads(self):
+    # Every other thread in the process goes back to the default cores, at most once per UNPIN_INTERVAL
+    # Called from the main loop, so threads started since (MQTT, MPD, monitor, units, recovery) only briefly share the core
+    if not self.pinned or time.monotonic() < self.nextUnpinTime:
+      return
+    self.nextUnpinTime = time.monotonic() + UNPIN_INTERVAL
+    try:
+      threadIds = {int(tid) for tid in os.listdir('/proc/self/task')}
+    except OSError:
+      return
+    self.unpinnedThreads &= threadIds
+    for tid in threadIds - self.unpinnedThreads - {threading.get_native_id()}:
+      try:
+        os.sched_setaffinity(tid, self.defaultAffinity)
+      except OSError:
+        pass # Thread ended in between
+      self.unpinnedThreads.add(tid)
+
+  def sleepUntil(self, deadline):
+    # deadline is in time.monotonic() seconds, which is CLOCK_MONOTONIC on Linux
+    if self.clockNanosleep is not None:
+      target = timespec(int(deadline), int(deadline % 1 * 1e9))
+      while self.clockNanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, ctypes.byref(target), None) == EINTR:
+        pass
+    else:
+      remaining = deadline - time.monotonic()
+      if remaining > 0:
+        time.sleep(remaining)
+
+    lateness = time.monotonic() - deadline
+    stats.record('deadlineLateness', max(lateness, 0) * 1e6)
+    if lateness > DEADLINE_TOLERANCE:
+      stats.count('deadlineMisses')
+
+# Shared by everything in the Engine process
+scheduler = rtSchedule()
@@ -0,0 +1,78 @@
+import logging
+
+# =====================
+# Simulated I2C Classes
+# =====================
+# Stand-ins for smbus2.SMBus that answer like a QN8066 or Si4713, used by the benchmark and replay tools
+# Install with basicI2C.busFactory = simulatedBus so no hardware or smbus2 is needed
+# Every transaction is counted, which is what the benchmarks compare for the Si4713 buffer loads
+
+class simulatedQN8066:
+  # Only the registers the Engine reads back are modeled
+  def __init__(self):
+    self.registers = [0] * 0x80
+    self.registers[0x06] = 0b1101 << 2 # Chip ID
+    self.registers[0x0a] = 10 << 4 # FSM state TX
+    # Set above 0 to have that many groups stall, for exercising RDS recovery
+    self.stallGroups = 0
+    self.writes = 0
+    self.reads = 0
+
+  def write_i2c_block_data(self, _address, register, values):
+    self.writes += 1
+    if register == 0x01 and (values[0] ^ self.registers[0x01]) & 0b10:
+      # RDS send toggle flipped, the group is "sent" immediately by flipping the sent status toggle
+      if self.stallGroups > 0:
+        self.stallGroups -= 1
+      else:
+        self.registers[0x1a] ^= 0b100
+    for i, value in enumerate(values):
+      self.registers[(register + i) % len(self.registers)] = value
+    if register == 0x00:
+      # Reset completes immediately and the FSM follows the TX request bit
+      self.registers[0x00] &= 0b01111111
+      self.registers[0x0a] = (10 if values[0] & 0b1000 else 0) << 4
+
+  def read_i2c_block_data(self, _address, register, num_bytes):
+    self.reads += 1
+    return [self.registers[(register + i) % len(self.registers)] for i in range(num_bytes)]
+
+class simulatedSi4713:
+  CIRCULAR_BUFFERS = 203
+  FIFO_BUFFERS = 0
+
+  def __init__(self):
+    self.command = None
+    self.circularUsed = 0
+    self.writes = 0
+    self.reads = 0
+    self.commands = {}
+
+  def write_i2c_block_data(self, _address, command, values):
+    self.writes += 1
+    self.command = command
+    self.commands[command] = self.commands.get(command, 0) + 1
+    if command == 0x35: # TX_RDS_BUFF
+      if values and values[0] & 0b10:
+        self.circularUsed = 0
+      elif values and values[0] & 0b100:
+        self.circularUsed = min(self.circularUsed + 1, self.CIRCULAR_BUFFERS)
+
+  def read_i2c_block_data(self, _address, _register, num_bytes):
+    self.reads += 1
+    if self.command == 0x10: # GET_REV
+      response = [0x80, 13, ord('3'), ord('0'), 0, 0, 0, 0, 3]
+    elif self.command == 0x35:
+      response = [0x80, 0, self.CIRCULAR_BUFFERS - self.circularUsed, self.circularUsed, self.FIFO_BUFFERS, 0]
+    elif self.command in (0x14, 0x30, 0x31): # GET_INT_STATUS after TX_TUNE_FREQ or TX_TUNE_POWER, tune is complete
+      response = [0x81]
+    else:
+      response = [0x80]
+    return (response + [0] * num_bytes)[:num_bytes]
+
+SIMULATED_CHIPS = {0x21: simulatedQN8066, 0x63: simulatedSi4713, 0x11: simulatedSi4713}
+
+def simulatedBus(_bus, address):
+  # Matches the basicI2C.busFactory signature
+  logging.info('Using simulated i2c bus for address 0x%02X', address)
+  return SIMULATED_CHIPS[address]()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+# ==================
+# Status Block Class
+# ==================
+# Fixed layout Engine status in a memory-mapped file under /dev/shm, updated in place
+# The PHP status page and external monitors read it directly - No process spawns, nothing asked of the Engine
+# Writers bump sequence to odd before a change and back to even after, readers retry until they see the same even value
+# on both sides of their copy (a seqlock), so a read never mixes two updates
+#
+# Read: python3 statusBlock.py  (prints the block as JSON)
+
+STATUS_PATH = '/dev/shm/Dynamic_RDS_status'
+STATUS_MAGIC = b'DRDS'
+STATUS_VERSION = 1
+
+# Layout is shared with Dynamic_RDS.php - Change both (and STATUS_VERSION) together
+# magic, version, state, pid, sequence, reserved,
+# startTime, heartbeat, errorTime, rdsGroups, rdsStalls, i2cErrors, transmitterResets, reserved,
+# transmitter, psFragment, rtFragment, lastError (UTF-8, zero padded)
+STATUS_FORMAT = '<4sHHIII ddd QIIII 16s32s256s256s'
+STATUS_SIZE = struct.calcsize(STATUS_FORMAT)
+SEQUENCE_OFFSET = 12
+SEQUENCE_FORMAT = '<I'
+
+# state bits
+STATE_RUNNING = 1
+STATE_TRANSMITTING = 2
+STATE_PLAYLIST = 4
+
+# A heartbeat older than this means the Engine is not running
+HEARTBEAT_STALE = 10
+
+FIELDS = ('magic', 'version', 'state', 'pid', 'sequence', 'reserved',
+          'startTime', 'heartbeat', 'errorTime', 'rdsGroups', 'rdsStalls', 'i2cErrors', 'transmitterResets', 'reserved2',
+          'transmitter', 'psFragment', 'rtFragment', 'lastError')
+TEXT_FIELDS = ('transmitter', 'psFragment', 'rtFragment', 'lastError')
+TEXT_SIZES = (16, 32, 256, 256)
+
+def _text(value, size):
+  # Truncated on a character boundary so the reader always gets valid UTF-8
+  return value.encode('UTF-8')[:size].decode('UTF-8', 'ignore').encode('UTF-8')
+
+class statusBlock:
+  def __init__(self, path=STATUS_PATH):
+    self.path = path
+    self.lock = threading.Lock()
+    self.values = dict.fromkeys(FIELDS, 0)
+    self.values.update(magic=STATUS_MAGIC, version=STATUS_VERSION, state=STATE_RUNNING, pid=os.getpid(), startTime=time.time(),
+                       transmitter='', psFragment='', rtFragment='', lastError='')
+    self.sizes = dict(zip(TEXT_FIELDS, TEXT_SIZES))
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+      os.ftruncate(fd, STATUS_SIZE)
+      self.map = mmap.mmap(fd, STATUS_SIZE)
+    finally:
+      os.close(fd)
+    self._write()
+
+  def update(self, **fields):
+    with self.lock:
+      self.values.update(fields)
+      self._write()
+
+  def _write(self):
+    # Odd sequence first, then the fields, then the even sequence last
+    self.values['sequence'] += 1
+    struct.pack_into(SEQUENCE_FORMAT, self.map, SEQUENCE_OFFSET, self.values['sequence'])
+    values = [_text(self.values[field], self.sizes[field]) if field in TEXT_FIELDS else self.values[field] for field in FIELDS]
+    struct.pack_into(STATUS_FORMAT, self.map, 0, *values)
+    self.values['sequence'] += 1
+    struct.pack_into(SEQUENCE_FORMAT, self.map, SEQUENCE_OFFSET, self.values['sequence'])
+
+  def close(self):
+    # The file stays so the last state can still be read, with the heartbeat showing it is stale
+    with self.lock:
+      self.values['state'] = 0
+      self._write()
+      self.map.close()
+
+class statusErrorHandler(logging.Handler):
+  # Keeps the last error logged in the status block
+  def __init__(self, block):
+    super().__init__(logging.ERROR)
+    self.block = block
+
+  def emit(self, record):
+    try:
+      self.block.update(lastError=record.getMessage(), errorTime=record.created)
+    except Exception: # pylint: disable=broad-exception-caught
+      self.handleError(record)
+
+def readStatus(path=STATUS_PATH, attempts=10):
+  # Returns the block as a dict, or None if there isn't a valid one
+  try:
+    with open(path, 'rb') as f:
+      for _ in range(attempts):
+        f.seek(0)
+        data = f.read(STATUS_SIZE)
+        if len(data) < STATUS_SIZE:
+          return None
+        sequence = struct.unpack_from(SEQUENCE_FORMAT, data, SEQUENCE_OFFSET)[0]
+        f.seek(SEQUENCE_OFFSET)
+        if sequence % 2 == 0 and struct.unpack(SEQUENCE_FORMAT, f.read(4))[0] == sequence:
+          break
+        time.sleep(0.001)
+      else:
+        return None
+  except OSError:
+    return None
+
+  status = dict(zip(FIELDS, struct.unpack(STATUS_FORMAT, data)))
+  if status['magic'] != STATUS_MAGIC or status['version'] != STATUS_VERSION:
+    return None
+  for field in TEXT_FIELDS:
+    status[field] = status[field].rstrip(b'\0').decode('UTF-8', 'replace')
+  for field in ('magic', 'reserved', 'reserved2'):
+    del status[field]
+  status['transmitting'] = bool(status['state'] & STATE_TRANSMITTING)
+  status['playlist'] = bool(status['state'] & STATE_PLAYLIST)
+  status['running'] = bool(status['state'] & STATE_RUNNING) and time.time() - status['heartbeat'] < HEARTBEAT_STALE
+  return status
+
+if __name__ == '__main__':
+  engineStatus = readStatus(sys.argv[1] if len(sys.argv) > 1 else STATUS_PATH)
+  print(json.dumps(engineStatus, indent=2))
+  sys.exit(0 if engineStatus is not None else 1)
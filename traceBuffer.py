@@ -0,0 +1,93 @@
+import logging
+import struct
+import threading
+import time
+
+# ==================
+# Trace Buffer Class
+# ==================
+# Fixed-size ring of binary trace records for the I2C and RDS hot paths
+# Recording is a single struct.pack_into with no string formatting, so it is cheap enough to leave on all the time
+# Records are only decoded to text when dumped, either on request or after an error
+# Dumps after an error are written from a copy of the ring on a background thread, so the I2C and RDS paths never wait on the file
+
+TRACE_I2C_WRITE = 1
+TRACE_I2C_READ = 2
+TRACE_I2C_ERROR = 3
+TRACE_RDS_GROUP = 4
+TRACE_RDS_STALL = 5
+TRACE_MARK = 6
+
+TRACE_NAMES = {
+  TRACE_I2C_WRITE: 'I2C write',
+  TRACE_I2C_READ: 'I2C read',
+  TRACE_I2C_ERROR: 'I2C error',
+  TRACE_RDS_GROUP: 'RDS group',
+  TRACE_RDS_STALL: 'RDS stall',
+  TRACE_MARK: 'Mark'
+}
+
+# Monotonic ns, event code, register, data length, up to 16 data bytes
+TRACE_RECORD = struct.Struct('<QBBB16s')
+
+class traceBuffer:
+  def __init__(self, records=4096, dumpPath=None, dumpInterval=10):
+    self.records = records
+    self.buffer = bytearray(TRACE_RECORD.size * records)
+    self.index = 0
+    self.written = 0
+    self.dumpPath = dumpPath
+    self.dumpInterval = dumpInterval
+    self.lastDumpTime = None
+    # Recovery, audio monitor, and unit threads record too, so each slot is reserved under the lock
+    self.lock = threading.Lock()
+
+  def record(self, event, register=0, data=b''):
+    with self.lock:
+      index = self.index
+      self.index = (index + 1) % self.records
+      self.written += 1
+      TRACE_RECORD.pack_into(self.buffer, index * TRACE_RECORD.size, time.monotonic_ns(), event, register & 0xFF, len(data), bytes(data[:16]))
+
+  def snapshot(self):
+    with self.lock:
+      return bytes(self.buffer), self.index, self.written
+
+  def entries(self, snapshot=None):
+    # Yields (monotonic ns, event, register, data bytes) oldest to newest, from a snapshot() if given
+    buffer, index, written = snapshot or (self.buffer, self.index, self.written)
+    count = min(written, self.records)
+    start = (index - count) % self.records
+    for i in range(count):
+      ns, event, register, length, data = TRACE_RECORD.unpack_from(buffer, (start + i) % self.records * TRACE_RECORD.size)
+      yield ns, event, register, data[:min(length, 16)]
+
+  def dump(self, path=None, snapshot=None):
+    path = path or self.dumpPath
+    if path is None:
+      return False
+    written = snapshot[2] if snapshot else self.written
+    # Monotonic times are converted to wall clock using the offset at dump time
+    offset = time.time() - time.monotonic_ns() / 1e9
+    try:
+      with open(path, 'w', encoding='UTF-8') as f:
+        for ns, event, register, data in self.entries(snapshot):
+          stamp = ns / 1e9 + offset
+          f.write(f"{time.strftime('%H:%M:%S', time.localtime(stamp))}.{int(stamp % 1 * 1e6):06d} "
+                  f"{TRACE_NAMES.get(event, event)} 0x{register:02X} {' '.join(f'0x{b:02X}' for b in data)}\n")
+    except OSError:
+      logging.exception('Trace dump to %s', path)
+      return False
+    self.lastDumpTime = time.monotonic()
+    logging.info('Dumped %s trace records to %s', min(written, self.records), path)
+    return True
+
+  def dumpOnError(self):
+    # Errors tend to come in bursts, so only dump once per dumpInterval
+    if self.dumpPath is None or (self.lastDumpTime is not None and time.monotonic() - self.lastDumpTime < self.dumpInterval):
+      return
+    self.lastDumpTime = time.monotonic()
+    threading.Thread(target=self.dump, args=(None, self.snapshot()), name='traceDump', daemon=True).start()
+
+# Shared by everything in the Engine process
+trace = traceBuffer()
@@ -0,0 +1,97 @@
+import logging
+import queue
+import threading
+from collections import ChainMap
+
+from config import config, read_transmitters_from_file
+
+# ======================
+# Transmitter Unit Class
+# ======================
+# An additional transmitter run by the same Engine, from a section of Dynamic_RDS_transmitters.ini
+# Its settings are the section's values over the Engine config, so only what differs (frequency, bus, styles) is needed
+# Each unit has its own thread that sends its RDS groups, and everything else the Engine asks of it is queued to that
+# thread with call() - The transmitter is only ever touched by one thread, so the chip classes need no changes for it
+
+# Settings that would clash between units unless a section asks for them
+UNIT_DEFAULTS = {
+  'DynRDSQN8066PIPWM': '0',
+  'DynRDSI2CBus': '',
+  'DynRDSI2CAddress': ''
+}
+# Seconds stop() waits for the calls already queued, like a shutdown, to finish
+UNIT_STOP_TIMEOUT = 10
+
+class transmitterUnit:
+  def __init__(self, name, settings):
+    self.name = name
+    self.config = ChainMap(settings, UNIT_DEFAULTS, config)
+    bus = int(self.config['DynRDSI2CBus']) if self.config['DynRDSI2CBus'] else None
+    logging.info('Initializing transmitter %s', name)
+    # Chip modules are loaded as needed, like the Engine's own transmitter
+    if self.config['DynRDSTransmitter'] == 'QN8066':
+      from QN8066 import QN8066
+      self.transmitter = QN8066(self.config, bus)
+    elif self.config['DynRDSTransmitter'] == 'Si4713':
+      from Si4713 import Si4713
+      address = int(self.config['DynRDSI2CAddress'], 16) if self.config['DynRDSI2CAddress'] else 0x63
+      self.transmitter = Si4713(self.config, bus, address)
+    else:
+      raise ValueError(f"Unknown transmitter type {self.config['DynRDSTransmitter']}")
+    self.commands = queue.SimpleQueue()
+    self.thread = None
+
+  def start(self):
+    self.thread = threading.Thread(target=self._run, name='transmitter ' + self.name, daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    # Queued calls run before the thread ends - Returns False if it is still running them after UNIT_STOP_TIMEOUT
+    self.commands.put(None)
+    if self.thread is not None:
+      self.thread.join(UNIT_STOP_TIMEOUT)
+      if self.thread.is_alive():
+        logging.warning('Transmitter %s did not stop within %ss', self.name, UNIT_STOP_TIMEOUT)
+        return False
+    return True
+
+  def call(self, func, *args):
+    # Runs func(*args) on the unit's thread between RDS groups
+    self.commands.put((func, args))
+
+  def startTransmitter(self):
+    if not self.transmitter.attach():
+      self.transmitter.startup()
+
+  def _run(self):
+    while True:
+      sending = self.transmitter.active and self.config['DynRDSEnableRDS'] == '1'
+      try:
+        command = self.commands.get_nowait() if sending else self.commands.get(timeout=1)
+      except queue.Empty:
+        command = False
+
+      if command is None:
+        return
+      try:
+        if command:
+          func, args = command
+          func(*args)
+        elif sending:
+          self.transmitter.sendNextRDSGroup()
+      except (Exception, SystemExit):
+        # startup exits when the chip can't be found, which would only end this thread
+        logging.exception('Transmitter %s', self.name)
+
+def loadUnits(skip=()):
+  # skip has the names of units that are still stopping, which keep their chip until the next INIT
+  units = []
+  for name, settings in read_transmitters_from_file():
+    if name in skip:
+      logging.error('Transmitter %s is still stopping, skipped until the next INIT', name)
+      continue
+    try:
+      units.append(transmitterUnit(name, settings))
+    except (ValueError, KeyError):
+      logging.exception('Transmitter %s', name)
+  return units